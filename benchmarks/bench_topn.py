@@ -0,0 +1,80 @@
+"""
+Бенчмарк слияния top-N последних событий на пользователя:
+старый dict-of-lists аккумулятор против TopNAccumulator из src/scan.py.
+
+python -m benchmarks.bench_topn --files 30 --rows 200000 --users 50000 --n 50
+"""
+import argparse
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+
+from src.scan import TopNAccumulator
+
+
+def synthetic_tracker_files(n_files, rows, n_users, n_items, seed=0):
+    """Файлы от старых к новым; timestamp с шагом в минуту, чтобы были равные значения"""
+    rng = np.random.default_rng(seed)
+    start = datetime(2025, 5, 1)
+    files = []
+    for i in range(n_files):
+        day = start + timedelta(days=i)
+        minutes = rng.integers(0, 24 * 60, rows).astype('timedelta64[m]')
+        files.append(pl.DataFrame({
+            'user_id': rng.zipf(1.3, rows) % n_users,
+            'item_id': rng.zipf(1.2, rows) % n_items,
+            'timestamp': np.datetime64(day, 'us') + minutes,
+        }))
+    return files
+
+
+def legacy_top_n(files, n):
+    """Старая логика генераторов: group_by + iter_rows + сортировка списка на каждого пользователя"""
+    state = defaultdict(list)
+    for df in reversed(files):
+        grouped = df.group_by('user_id').agg(pl.col('timestamp'), pl.col('item_id'))
+        for row in grouped.iter_rows(named=True):
+            combined = state[row['user_id']] + list(zip(row['timestamp'], row['item_id']))
+            combined.sort(key=lambda x: x[0], reverse=True)
+            state[row['user_id']] = combined[:n]
+    return pl.DataFrame({
+        'user_id': list(state.keys()),
+        'item_id': [[item for _, item in events] for events in state.values()]
+    })
+
+
+def columnar_top_n(files, n):
+    acc = TopNAccumulator(n, 'timestamp')
+    for df in reversed(files):
+        acc.update(df)
+    return acc.result()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=30)
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--items', type=int, default=100_000)
+    parser.add_argument('--n', type=int, default=50)
+    args = parser.parse_args()
+
+    files = synthetic_tracker_files(args.files, args.rows, args.users, args.items)
+    total_rows = sum(df.height for df in files)
+
+    results = {}
+    for name, fn in [('legacy', legacy_top_n), ('columnar', columnar_top_n)]:
+        start = time.perf_counter()
+        results[name] = fn(files, args.n)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>9}: {elapsed:8.2f} s  {total_rows / elapsed:14,.0f} rows/sec')
+
+    same = results['legacy'].sort('user_id').equals(results['columnar'].sort('user_id'))
+    print(f'одинаковые списки: {same}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Нагрузочный тест онлайн-сервиса src/serving.py: concurrency клиентов шлют requests запросов
+/recommend по случайным пользователям из состояния, по keep-alive соединениям.
+Без --url сервер поднимается в этом же процессе на свободном порту; --in-process - без HTTP,
+напрямую RecommendationService (задержка самой пачки и очереди).
+Печатает p50 / p90 / p99 / max задержки в мс, запросы в секунду и средний размер пачки.
+
+python -m benchmarks.load_test --artifacts serving --requests 20000 --concurrency 64
+python -m benchmarks.load_test --artifacts serving --url http://127.0.0.1:8000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.serving import Recommender, RecommendationService, start_server
+
+
+async def http_client(host, port, user_ids, n, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for user_id in user_ids:
+            start = time.perf_counter()
+            writer.write(f'GET /recommend?user_id={user_id}&n={n} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            body = await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if not status.startswith(b'HTTP/1.1 200') or len(json.loads(body)['items']) != n:
+                raise RuntimeError(f'bad response for user {user_id}: {status!r} {body[:200]!r}')
+    finally:
+        writer.close()
+
+async def service_client(service, user_ids, n, latencies):
+    for user_id in user_ids:
+        start = time.perf_counter()
+        items = await service.recommend(user_id, n)
+        latencies.append(time.perf_counter() - start)
+        if len(items) != n:
+            raise RuntimeError(f'user {user_id}: {len(items)} items')
+
+async def run_load(args, user_ids):
+    """Задержки запросов (секунды), общее время и размеры пачек сервиса (если он в этом процессе)"""
+    server, service = None, None
+    if args.in_process:
+        service = RecommendationService(Recommender(args.artifacts), args.max_batch, args.max_wait_ms)
+        await service.start()
+    elif args.url is None:
+        server, service = await start_server(args.artifacts, '127.0.0.1', 0, args.max_batch, args.max_wait_ms)
+    if args.url is not None:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port
+    elif server is not None:
+        host, port = server.sockets[0].getsockname()[:2]
+
+    latencies = []
+    chunks = np.array_split(user_ids, args.concurrency)
+    start = time.perf_counter()
+    if args.in_process:
+        clients = [service_client(service, chunk.tolist(), args.n, latencies) for chunk in chunks]
+    else:
+        clients = [http_client(host, port, chunk.tolist(), args.n, latencies) for chunk in chunks]
+    await asyncio.gather(*clients)
+    elapsed = time.perf_counter() - start
+
+    batch_sizes = service.batch_sizes if service is not None else []
+    if service is not None:
+        await service.stop()
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    return np.array(latencies), elapsed, batch_sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест src/serving.py')
+    parser.add_argument('--artifacts', default='serving', help='артефакты build_serving_artifacts (пользователи для запросов)')
+    parser.add_argument('--url', default=None, help='уже запущенный сервис, например http://127.0.0.1:8000')
+    parser.add_argument('--in-process', action='store_true', help='RecommendationService без HTTP')
+    parser.add_argument('--requests', type=int, default=10_000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--n', type=int, default=100)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=1.0)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON с результатами')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    users = Recommender(args.artifacts).user_ids()
+    if args.warmup:
+        asyncio.run(run_load(argparse.Namespace(**{**vars(args), 'concurrency': 1}), rng.choice(users, args.warmup)))
+    latencies, elapsed, batch_sizes = asyncio.run(run_load(args, rng.choice(users, args.requests)))
+
+    latencies_ms = latencies * 1000
+    report = {
+        'requests': len(latencies),
+        'concurrency': args.concurrency,
+        'mode': 'in_process' if args.in_process else 'http',
+        'rps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p90_ms': float(np.percentile(latencies_ms, 90)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'max_ms': float(latencies_ms.max()),
+        'mean_batch': float(np.mean(batch_sizes)) if batch_sizes else None,
+    }
+    print(
+        f"{report['requests']} запросов, {report['concurrency']} клиентов ({report['mode']}): "
+        f"{report['rps']:,.0f} req/s  p50 {report['p50_ms']:.2f} мс  p90 {report['p90_ms']:.2f} мс  "
+        f"p99 {report['p99_ms']:.2f} мс  max {report['max_ms']:.2f} мс"
+        + (f"  средняя пачка {report['mean_batch']:.1f}" if batch_sizes else '')
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+Сквозной бенчмарк пайплайна на синтетических данных (src/synthetic.py): генераторы кандидатов,
+co-occurrence, unite_candidates и calculate_metrics_for_all_users в режиме train (как experiments.ipynb).
+Для каждого этапа - время, rows/sec и пиковый RSS; результат в JSON для сравнения между коммитами.
+
+python -m benchmarks.run_benchmarks --workdir bench_data --users 20000 --items 20000 --output bench.json
+python -m benchmarks.run_benchmarks --workdir bench_data --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.synthetic import SyntheticConfig, generate_dataset
+
+
+class PeakRSS:
+    """
+    Пиковый RSS процесса внутри блока with: фоновый поток читает /proc/self/statm каждые interval секунд.
+    Без /proc (не Linux) - ru_maxrss, то есть пик за все время процесса
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self._has_proc = os.path.exists('/proc/self/statm')
+
+    def _current(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * self._page_size
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self._has_proc:
+            self.peak = self._current()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._has_proc:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, self._current())
+        else:
+            # ru_maxrss: килобайты в Linux, байты в macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def output_rows(result):
+    if hasattr(result, 'shape'):
+        return int(result.shape[0])
+    if isinstance(result, (list, tuple, dict)):
+        return len(result)
+    return None
+
+def run_stage(stages, name, fn, rows, repeat=1):
+    """Лучшее время из repeat запусков, максимальный пик памяти; rows - входные строки этапа"""
+    best, peak, result = None, 0, None
+    for _ in range(repeat):
+        with PeakRSS() as memory:
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        peak = max(peak, memory.peak)
+    stages[name] = {
+        'seconds': round(best, 4),
+        'rows': int(rows),
+        'rows_per_sec': round(rows / best, 1) if best > 0 else None,
+        'peak_rss_mb': round(peak / 2**20, 1),
+        'output_rows': output_rows(result),
+    }
+    print(f'{name:>46}: {best:8.2f} s  {stages[name]["rows_per_sec"] or 0:14,.0f} rows/sec  {stages[name]["peak_rss_mb"]:9,.1f} MB', flush=True)
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare_data(workdir, config, regenerate=False):
+    """Генерация в workdir/data; повторный запуск с тем же конфигом переиспользует данные"""
+    data_root = os.path.join(workdir, 'data')
+    config_path = os.path.join(data_root, 'synthetic_config.json')
+    config_dict = json.loads(json.dumps(asdict(config)))
+    if not regenerate and os.path.exists(config_path):
+        with open(config_path) as f:
+            saved = json.load(f)
+        if saved['config'] == config_dict:
+            return saved['counts']
+    counts = generate_dataset(data_root, config)
+    with open(config_path, 'w') as f:
+        json.dump({'config': config_dict, 'counts': counts}, f, indent=1)
+    return counts
+
+
+#################
+def run_pipeline(workdir, counts, repeat=1, telemetry_path=None):
+    """Этапы experiments.ipynb / gen_candidates.ipynb на данных workdir/data"""
+    if telemetry_path:
+        from src.telemetry import configure_telemetry
+        configure_telemetry(path=telemetry_path)
+    from src import gen_cand_utils as g
+    from src.cache import configure_cache
+    from src.datasets import configure_datasets
+    from src.cooccurrence import build_cooccurrence_neighbors
+    from src.metrics import calculate_metrics_for_all_users
+    configure_cache(enabled=False)
+    configure_datasets(os.path.join(workdir, 'data'))
+
+    stages = {}
+    orders = (
+        pl.scan_parquet(g.order_files, extra_columns='ignore')
+        .filter(pl.col('last_status') == 'delivered_orders')
+        .select('user_id', 'item_id', 'created_timestamp')
+        .collect()
+    )
+    # отсечка как в gen_candidates.ipynb: последние 3 доставленных заказа пользователя - валидация
+    user_cutoff_time = orders.sort(['user_id', 'created_timestamp']).group_by('user_id').agg(
+        pl.col('created_timestamp').tail(3).min().alias('cutoff_time')
+    )
+    val_n_orders = (
+        orders.join(user_cutoff_time, on='user_id')
+        .filter(pl.col('created_timestamp') >= pl.col('cutoff_time'))
+        .sort(['user_id', 'created_timestamp'])
+        .group_by('user_id')
+        .agg(pl.col('item_id').alias('item_ids'))
+    )
+    train = dict(mode='train', user_cutoff_time=user_cutoff_time)
+    tracker_rows, order_rows = counts['tracker'], counts['orders']
+
+    favorite = run_stage(stages, 'get_last_favorite_items', lambda: g.get_last_favorite_items(**train), tracker_rows, repeat)
+    viewed_def = run_stage(stages, 'get_last_viewed_def_items', lambda: g.get_last_viewed_def_items(**train), tracker_rows, repeat)
+    last_viewed = run_stage(stages, 'get_last_viewed_items', lambda: g.get_last_viewed_items(n=7, **train), tracker_rows, repeat)
+    processed = run_stage(stages, 'get_processed_items', lambda: g.get_processed_items(**train), order_rows, repeat)
+    popular = run_stage(stages, 'get_popular_items', lambda: g.get_popular_items(n=400), order_rows, repeat)
+
+    neighbors_path = os.path.join(workdir, 'cooccurrence_neighbors.parquet')
+    cooccurrence = run_stage(
+        stages, 'build_cooccurrence_neighbors',
+        lambda: build_cooccurrence_neighbors(g.order_files, neighbors_path), order_rows, repeat
+    )
+    cooccur = run_stage(
+        stages, 'get_cooccur_neighbors_of_last_delivered_items',
+        lambda: g.get_cooccur_neighbors_of_last_delivered_items(cooccurrence, **train), order_rows, repeat
+    )
+    # таблица соседей в формате nearest_neighbors - из co-occurrence, каталог для этого не нужен
+    nn_df = cooccurrence.select(
+        'item_id', pl.col('neighbors').alias('neighbor_item_id'),
+        pl.int_ranges(1, pl.col('neighbors').list.len() + 1).alias('rank')
+    ).explode(['neighbor_item_id', 'rank'], empty_as_null=False)
+    k_values = {f'item_{i}': k for i, k in enumerate([10, 8, 6, 4, 3, 2, 2], start=1)}
+    viewed_neighbors = run_stage(
+        stages, 'get_neighbors_of_viewed_items',
+        lambda: g.get_neighbors_of_viewed_items(last_viewed, nn_df, k_values, mode='train'), last_viewed.height, repeat
+    )
+
+    dfs_to_merge = [favorite, processed, viewed_def, viewed_neighbors, cooccur]
+    candidate_rows = sum(int(df['item_id'].list.len().sum()) for df in dfs_to_merge)
+    candidates = run_stage(stages, 'unite_candidates', lambda: g.unite_candidates(dfs_to_merge, popular, n=300), candidate_rows, repeat)
+
+    validation_df = val_n_orders.to_pandas().merge(candidates, on='user_id', how='left').rename(
+        columns={'item_ids': 'true_items', 'item_id': 'predicted_items'}
+    )
+    predicted_rows = int(sum(len(items) for items in validation_df['predicted_items'] if isinstance(items, (list, np.ndarray))))
+    run_stage(stages, 'calculate_metrics_for_all_users', lambda: calculate_metrics_for_all_users(validation_df), predicted_rows, repeat)
+    return stages
+
+def compare(stages, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f'\nсравнение с {baseline_path} ({baseline.get("commit")}):')
+    for name, stage in stages.items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            continue
+        print(f'{name:>46}: time x{stage["seconds"] / old["seconds"]:.2f}  peak RSS x{stage["peak_rss_mb"] / old["peak_rss_mb"]:.2f}')
+
+
+def main():
+    defaults = SyntheticConfig()
+    parser = argparse.ArgumentParser(description='Бенчмарк пайплайна на синтетических данных')
+    parser.add_argument('--workdir', default='bench_data')
+    parser.add_argument('--users', type=int, default=defaults.n_users)
+    parser.add_argument('--items', type=int, default=defaults.n_items)
+    parser.add_argument('--days', type=int, default=defaults.n_days)
+    parser.add_argument('--sessions-per-user-day', type=float, default=defaults.sessions_per_user_day)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--output', default=None, help='JSON с результатами')
+    parser.add_argument('--baseline', default=None, help='JSON предыдущего запуска для сравнения')
+    parser.add_argument('--telemetry', default=None, help='JSON lines с телеметрией этапов (src/telemetry.py)')
+    args = parser.parse_args()
+
+    config = SyntheticConfig(
+        n_users=args.users, n_items=args.items, n_days=args.days,
+        sessions_per_user_day=args.sessions_per_user_day, seed=args.seed,
+    )
+    workdir = os.path.abspath(args.workdir)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    telemetry_path = os.path.abspath(args.telemetry) if args.telemetry else None
+
+    counts = prepare_data(workdir, config, args.regenerate)
+    stages = run_pipeline(workdir, counts, args.repeat, telemetry_path)
+    report = {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'cpu_count': os.cpu_count(),
+        'config': asdict(config),
+        'data': counts,
+        'stages': stages,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    if baseline:
+        compare(stages, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+import glob
+import json
+import os
+
+import numpy as np
+import polars as pl
+from scipy.sparse import csr_matrix
+from tqdm import tqdm
+
+from src.cache import files_fingerprint
+from src.cooccurrence import list_column
+
+INDEX_ARRAYS = ['centroids', 'list_offsets', 'item_ids', 'vectors', 'groups', 'id_order']
+# catalogid до стольких items ищутся точно (один кластер)
+EXACT_SEARCH_MAX_ITEMS = 20_000
+
+
+#################
+def normalize_rows(vectors):
+    """Векторы единичной длины (float32): косинусная близость = скалярное произведение"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def assign_lists(vectors, centroids, batch_size=65_536):
+    """Номер ближайшего центроида для каждого вектора, батчами"""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        labels[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+    return labels
+
+def spherical_kmeans(vectors, n_clusters, n_iter=10, seed=0):
+    """k-means по косинусной близости; vectors уже нормированы"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = assign_lists(vectors, centroids)
+        one_hot = csr_matrix(
+            (np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+            shape=(n_clusters, len(labels))
+        )
+        sums = np.asarray(one_hot @ vectors)
+        empty = np.asarray(one_hot.sum(axis=1)).ravel() == 0
+        # пустые кластеры заново инициализируем случайными точками
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+#################
+class IVFIndex:
+    """
+    Приближенный поиск соседей по косинусной близости (inverted file index).
+    Векторы разбиты на n_lists кластеров spherical k-means; запрос сравнивается только
+    с векторами из n_probe ближайших кластеров.
+    Хранение - плоские массивы, векторы лежат подряд по кластерам:
+    векторы кластера l - vectors[list_offsets[l]:list_offsets[l+1]], их item_ids и groups - там же.
+    groups (например catalogid) - соседи ищутся только внутри группы запроса.
+    """
+    def __init__(self, centroids, list_offsets, item_ids, vectors, groups=None, id_order=None, path=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.item_ids = item_ids
+        self.vectors = vectors
+        self.groups = groups
+        self.id_order = np.argsort(item_ids, kind='stable') if id_order is None else id_order
+        self.path = path
+
+    @classmethod
+    def build(cls, vectors, item_ids, groups=None, n_lists=None, n_iter=10, sample_size=200_000, seed=0):
+        """
+        vectors - (n, dim), строки с NaN пропускаются.
+        n_lists - число кластеров (по умолчанию 4 * sqrt(n)), центроиды обучаются на sample_size векторах
+        """
+        vectors = np.asarray(vectors)
+        valid = ~np.isnan(vectors).any(axis=1)
+        vectors = normalize_rows(vectors[valid])
+        item_ids = np.asarray(item_ids)[valid]
+        groups = None if groups is None else np.asarray(groups)[valid]
+
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(vectors))))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(seed)
+        sample = vectors if len(vectors) <= sample_size else vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        centroids = spherical_kmeans(sample, min(n_lists, len(sample)), n_iter, seed)
+        return cls._from_labels(centroids, assign_lists(vectors, centroids), item_ids, vectors, groups)
+
+    @classmethod
+    def _from_labels(cls, centroids, labels, item_ids, vectors, groups):
+        order = np.argsort(labels, kind='stable')
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=list_offsets[1:])
+        return cls(
+            centroids,
+            list_offsets,
+            item_ids[order],
+            vectors[order],
+            None if groups is None else groups[order],
+        )
+
+    def add(self, vectors, item_ids, groups=None):
+        """
+        Новые items раскладываются по существующим кластерам без переобучения центроидов.
+        Возвращает новый индекс (массивы текущего могут быть открыты через memory map)
+        """
+        vectors = np.asarray(vectors)
+        valid = ~np.isnan(vectors).any(axis=1)
+        vectors = normalize_rows(vectors[valid])
+        labels = np.concatenate([
+            np.repeat(np.arange(len(self.centroids), dtype=np.int32), np.diff(self.list_offsets)),
+            assign_lists(vectors, self.centroids),
+        ])
+        all_groups = None
+        if self.groups is not None:
+            all_groups = np.concatenate([self.groups, np.asarray(groups)[valid]])
+        return self._from_labels(
+            self.centroids,
+            labels,
+            np.concatenate([self.item_ids, np.asarray(item_ids)[valid]]),
+            np.concatenate([self.vectors, vectors]),
+            all_groups,
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(f'{path}/{name}.npy', getattr(self, name))
+        with open(f'{path}/meta.json', 'w') as f:
+            json.dump({'n_items': len(self.item_ids), 'dim': self.vectors.shape[1], 'n_lists': len(self.centroids)}, f)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        """Массивы открываются через memory map и не читаются в память целиком"""
+        arrays = {
+            name: np.load(f'{path}/{name}.npy', mmap_mode='r') if os.path.exists(f'{path}/{name}.npy') else None
+            for name in INDEX_ARRAYS
+        }
+        return cls(**arrays, path=path)
+
+    def fingerprint(self):
+        """Для ключа кэша: сохраненный индекс - по mtime/размеру файлов, иначе по содержимому"""
+        if self.path is not None:
+            return f'IVFIndex({files_fingerprint([f"{self.path}/{name}.npy" for name in INDEX_ARRAYS if getattr(self, name) is not None])})'
+        return None
+
+    def rows_of(self, items):
+        """Позиции items в self.vectors; -1 для отсутствующих"""
+        items = np.asarray(items)
+        if len(self.item_ids) == 0:
+            return np.full(len(items), -1, dtype=np.int64)
+        sorted_ids = self.item_ids[self.id_order]
+        pos = np.minimum(np.searchsorted(sorted_ids, items), len(sorted_ids) - 1)
+        return np.where(sorted_ids[pos] == items, self.id_order[pos], -1)
+
+    def search(self, queries, k=50, n_probe=8, query_groups=None, exclude_ids=None, batch_size=1024):
+        """
+        Top-k соседей для батча запросов (nq, dim).
+        query_groups - группа каждого запроса (соседи только из нее), exclude_ids - item, который не возвращать (сам товар).
+        Возвращает (ids, scores) формы (nq, k); недостающие позиции - id -1 и score -inf
+        """
+        queries = normalize_rows(queries)
+        n_probe = min(n_probe, len(self.centroids))
+        ids = np.full((len(queries), k), -1, dtype=self.item_ids.dtype)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        for start in range(0, len(queries), batch_size):
+            q = queries[start:start + batch_size]
+            probe = np.argpartition(-(q @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+            # пары (запрос, кластер), сгруппированные по кластеру: один матричный продукт на кластер
+            pair_query = np.repeat(np.arange(len(q)), n_probe)
+            pair_list = probe.ravel()
+            order = np.argsort(pair_list, kind='stable')
+            pair_query, pair_list = pair_query[order], pair_list[order]
+            bounds = np.append(np.flatnonzero(np.diff(pair_list)) + 1, len(pair_list))
+
+            cand_query, cand_rows, cand_scores = [], [], []
+            lo_pair = 0
+            for hi_pair in bounds:
+                qs = pair_query[lo_pair:hi_pair]
+                lo, hi = self.list_offsets[pair_list[lo_pair]], self.list_offsets[pair_list[lo_pair] + 1]
+                lo_pair = hi_pair
+                if hi == lo:
+                    continue
+
+                s = q[qs] @ self.vectors[lo:hi].T
+                if self.groups is not None and query_groups is not None:
+                    s[self.groups[lo:hi][None, :] != query_groups[start + qs][:, None]] = -np.inf
+                if exclude_ids is not None:
+                    s[self.item_ids[lo:hi][None, :] == exclude_ids[start + qs][:, None]] = -np.inf
+
+                kk = min(k, hi - lo)
+                top = np.argpartition(-s, kk - 1, axis=1)[:, :kk]
+                cand_query.append(np.repeat(qs, kk))
+                cand_rows.append((lo + top).ravel())
+                cand_scores.append(np.take_along_axis(s, top, axis=1).ravel())
+
+            if not cand_query:
+                continue
+            cand_query = np.concatenate(cand_query)
+            cand_rows = np.concatenate(cand_rows)
+            cand_scores = np.concatenate(cand_scores)
+            keep = np.isfinite(cand_scores)
+            cand_query, cand_rows, cand_scores = cand_query[keep], cand_rows[keep], cand_scores[keep]
+
+            # слияние кандидатов из разных кластеров: по убыванию score внутри запроса
+            order = np.lexsort((-cand_scores, cand_query))
+            cand_query, cand_rows, cand_scores = cand_query[order], cand_rows[order], cand_scores[order]
+            counts = np.bincount(cand_query, minlength=len(q))
+            rank = np.arange(len(cand_query)) - np.repeat(np.cumsum(counts) - counts, counts)
+            keep = rank < k
+            ids[start + cand_query[keep], rank[keep]] = self.item_ids[cand_rows[keep]]
+            scores[start + cand_query[keep], rank[keep]] = cand_scores[keep]
+
+        return ids, scores
+
+    def neighbors_frame(self, items, k=50, n_probe=8, batch_size=1024):
+        """
+        Соседи для items (без самого товара, в его группе): pl.DataFrame(item_id, neighbors: list).
+        Items, которых нет в индексе, получают пустой список
+        """
+        items = np.unique(np.asarray(items))
+        rows = self.rows_of(items)
+        found = rows >= 0
+        ids = np.full((len(items), k), -1, dtype=self.item_ids.dtype)
+        if found.any():
+            found_rows = rows[found]
+            ids[found], _ = self.search(
+                self.vectors[found_rows], k, n_probe,
+                query_groups=None if self.groups is None else self.groups[found_rows],
+                exclude_ids=self.item_ids[found_rows],
+                batch_size=batch_size,
+            )
+
+        valid = ids >= 0
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=offsets[1:])
+        return pl.DataFrame({
+            'item_id': items,
+            'neighbors': list_column(offsets, ids[valid]),
+        })
+
+
+#################
+def load_catalog_vectors(vectors_dir, catalog_id):
+    """
+    Векторы одного catalogid из result_vectors (Content-Based preprocessing.ipynb): (vectors, item_ids).
+    Большие catalogid - {cid}_vectors.npy + _item_ids.npy + _metadata.json (memory map),
+    небольшие - {cid}_vectors.parquet (item_id, vector: list)
+    """
+    metadata_path = f'{vectors_dir}/{catalog_id}_metadata.json'
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        vectors = np.memmap(f'{vectors_dir}/{catalog_id}_vectors.npy', dtype=metadata['dtype'], mode='r',
+                            shape=(metadata['n_samples'], metadata['n_features']))
+        item_ids = np.memmap(f'{vectors_dir}/{catalog_id}_item_ids.npy', dtype='int64', mode='r',
+                             shape=(metadata['n_samples'],))
+        return vectors, item_ids
+    df = pl.read_parquet(f'{vectors_dir}/{catalog_id}_vectors.parquet', columns=['item_id', 'vector'])
+    vectors = df['vector'].explode().to_numpy().reshape(df.height, -1) if df.height else np.zeros((0, 1))
+    return vectors, df['item_id'].to_numpy()
+
+def result_vector_catalogs(vectors_dir):
+    """catalogid в result_vectors в обоих форматах ноутбука"""
+    suffixes = ('_metadata.json', '_vectors.parquet')
+    return sorted({
+        name[:-len(suffix)] for name in os.listdir(vectors_dir) for suffix in suffixes if name.endswith(suffix)
+    })
+
+
+class CatalogIVFIndex:
+    """
+    Отдельный IVFIndex на каждый catalogid. Векторы catalogid построены независимо (своя SVD / PCA
+    и стандартизация, своя размерность) и между собой не сравнимы, поэтому и центроиды у каждого свои.
+    Запрос идет в индекс catalogid своего item: item_ids (по возрастанию) -> item_catalogs (позиция в catalog_ids).
+    Небольшие catalogid (до exact_max_items) - один кластер, то есть точный поиск,
+    у остальных по умолчанию sqrt(n) кластеров: меньше кластеров - выше recall при том же n_probe.
+    path/catalog=<id>/ - IVFIndex.save, path/item_ids.npy + item_catalogs.npy + catalogs.json - маршрутизация
+    """
+    def __init__(self, indexes, item_ids, item_catalogs, path=None):
+        self.indexes = indexes
+        self.catalog_ids = list(indexes)
+        self.item_ids = item_ids
+        self.item_catalogs = item_catalogs
+        self.path = path
+
+    @classmethod
+    def build(cls, catalogs, output_path, n_lists=None, n_iter=10, exact_max_items=EXACT_SEARCH_MAX_ITEMS):
+        """
+        catalogs - итерируемое (catalog_id, vectors, item_ids), например из memory map:
+        в памяти одновременно векторы только одного catalogid, готовый индекс сразу пишется на диск
+        """
+        catalog_ids = []
+        for catalog_id, vectors, item_ids in catalogs:
+            vectors = np.asarray(vectors)
+            n_valid = int((~np.isnan(vectors).any(axis=1)).sum()) if len(vectors) else 0
+            if n_valid == 0:
+                continue
+            if n_valid <= exact_max_items:
+                catalog_lists = 1
+            else:
+                catalog_lists = n_lists or max(1, int(np.sqrt(n_valid)))
+            index = IVFIndex.build(vectors, item_ids, n_lists=catalog_lists, n_iter=n_iter)
+            index.save(f'{output_path}/catalog={catalog_id}')
+            catalog_ids.append(str(catalog_id))
+            del index
+
+        item_ids = [np.load(f'{output_path}/catalog={catalog_id}/item_ids.npy', mmap_mode='r') for catalog_id in catalog_ids]
+        item_catalogs = np.repeat(np.arange(len(catalog_ids), dtype=np.int32), [len(ids) for ids in item_ids])
+        item_ids = np.concatenate(item_ids) if item_ids else np.zeros(0, dtype=np.int64)
+        order = np.argsort(item_ids, kind='stable')
+        np.save(f'{output_path}/item_ids.npy', item_ids[order])
+        np.save(f'{output_path}/item_catalogs.npy', item_catalogs[order])
+        with open(f'{output_path}/catalogs.json', 'w') as f:
+            json.dump(catalog_ids, f)
+        return cls.load(output_path)
+
+    @classmethod
+    def from_item_vectors(cls, item_vectors, output_path, catalog_ids=None, n_lists=None, n_iter=10):
+        """Индекс по src.item_vectors.ItemVectors: диапазон строк каждого catalogid - срез общего vectors.npy"""
+        catalogs = item_vectors.catalogs if catalog_ids is None else {str(c): item_vectors.catalogs[str(c)] for c in catalog_ids}
+        return cls.build(
+            (
+                (catalog_id, item_vectors.vectors[start:end], item_vectors.item_ids[start:end])
+                for catalog_id, (start, end) in tqdm(catalogs.items(), desc='Build catalog indexes')
+            ),
+            output_path, n_lists=n_lists, n_iter=n_iter,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Индексы catalogid и маршрутизация открываются через memory map"""
+        with open(f'{path}/catalogs.json') as f:
+            catalog_ids = json.load(f)
+        return cls(
+            {catalog_id: IVFIndex.load(f'{path}/catalog={catalog_id}') for catalog_id in catalog_ids},
+            np.load(f'{path}/item_ids.npy', mmap_mode='r'),
+            np.load(f'{path}/item_catalogs.npy', mmap_mode='r'),
+            path=path,
+        )
+
+    def fingerprint(self):
+        """Для ключа кэша: mtime/размер всех файлов сохраненного индекса"""
+        if self.path is not None:
+            return f'CatalogIVFIndex({files_fingerprint(glob.glob(f"{self.path}/**/*.npy", recursive=True))})'
+        return None
+
+    def catalogs_of(self, items):
+        """Позиция catalogid в catalog_ids для items; -1 для отсутствующих"""
+        items = np.asarray(items)
+        if len(self.item_ids) == 0:
+            return np.full(len(items), -1, dtype=np.int32)
+        pos = np.minimum(np.searchsorted(self.item_ids, items), len(self.item_ids) - 1)
+        return np.where(self.item_ids[pos] == items, self.item_catalogs[pos], -1)
+
+    def add(self, catalog_id, vectors, item_ids):
+        """Новые items одного catalogid (IVFIndex.add, новый catalogid - точный индекс); возвращает новый индекс в памяти"""
+        catalog_id = str(catalog_id)
+        indexes = dict(self.indexes)
+        if catalog_id in indexes:
+            indexes[catalog_id] = indexes[catalog_id].add(vectors, item_ids)
+        else:
+            indexes[catalog_id] = IVFIndex.build(vectors, item_ids, n_lists=1)
+        ids = [np.asarray(index.item_ids) for index in indexes.values()]
+        item_catalogs = np.repeat(np.arange(len(ids), dtype=np.int32), [len(part) for part in ids])
+        item_ids = np.concatenate(ids)
+        order = np.argsort(item_ids, kind='stable')
+        return CatalogIVFIndex(indexes, item_ids[order], item_catalogs[order])
+
+    def neighbors_frame(self, items, k=50, n_probe=8, batch_size=1024):
+        """
+        Соседи для items внутри их catalogid (без самого товара): pl.DataFrame(item_id, neighbors: list),
+        как IVFIndex.neighbors_frame. Items, которых нет в индексе, получают пустой список
+        """
+        items = np.unique(np.asarray(items))
+        catalogs = self.catalogs_of(items)
+        frames = [
+            self.indexes[self.catalog_ids[position]].neighbors_frame(items[catalogs == position], k, n_probe, batch_size)
+            for position in np.unique(catalogs[catalogs >= 0])
+        ]
+        missing = items[catalogs < 0]
+        frames.append(pl.DataFrame({
+            'item_id': missing,
+            'neighbors': list_column(np.zeros(len(missing) + 1, dtype=np.int64), np.zeros(0, dtype=self.item_ids.dtype)),
+        }))
+        return pl.concat(frames).sort('item_id')
+
+def build_ivf_index(vectors_dir, output_path='ann_index', catalog_ids=None, n_lists=None, n_iter=10):
+    """
+    CatalogIVFIndex по result_vectors: свой индекс на каждый catalogid (оба формата ноутбука),
+    векторы читаются по одному catalogid.
+    vectors_dir с результатом src.item_vectors (vectors.npy + catalog_ids.npy) - через from_item_vectors
+    """
+    if os.path.exists(f'{vectors_dir}/vectors.npy') and os.path.exists(f'{vectors_dir}/catalog_ids.npy'):
+        from src.item_vectors import ItemVectors
+        return CatalogIVFIndex.from_item_vectors(ItemVectors(vectors_dir), output_path, catalog_ids, n_lists, n_iter)
+    if catalog_ids is None:
+        catalog_ids = result_vector_catalogs(vectors_dir)
+    catalogs = (
+        (catalog_id, *load_catalog_vectors(vectors_dir, catalog_id))
+        for catalog_id in tqdm(catalog_ids, desc='Build catalog indexes')
+    )
+    return CatalogIVFIndex.build(catalogs, output_path, n_lists=n_lists, n_iter=n_iter)
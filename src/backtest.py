@@ -0,0 +1,229 @@
+"""
+Rolling-origin бэктест генераторов кандидатов по сетке (min_date, cutoff, параметры), как переборы
+min_date в experiments.ipynb, но без повторного чтения файлов на каждую точку: события каждого источника
+читаются один раз под самое широкое окно сетки в отсортированный по времени буфер, окно точки - срез буфера.
+Метрики всех точек считаются ranking_metrics в пуле потоков, результат - одна таблица.
+
+points = backtest_grid('last_items', 'tracker', date_range('2025-05-01', '2025-06-25', 5), actions=[['to_cart'], ['favorite']])
+points += backtest_grid('popular', 'orders', date_range('2025-04-15', '2025-06-25', 5), n=[100])
+results = run_backtest(points, test_orders_true, k_values=[100])
+"""
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from itertools import product
+
+import polars as pl
+
+from src import telemetry
+from src.datasets import datasets
+from src.event_store import SOURCES
+from src.metrics import explode_ranked, ranking_metrics
+
+
+@dataclass
+class BacktestPoint:
+    """
+    Точка сетки: generator из GENERATORS на событиях source ('tracker' / 'orders')
+    в окне (min_date, cutoff) - строго после min_date и до cutoff; params - аргументы генератора
+    """
+    generator: str
+    source: str
+    min_date: str
+    cutoff: str = '2025-07-01'
+    params: dict = field(default_factory=dict)
+
+def date_range(start, end, step_days=5):
+    """['2025-04-15', '2025-04-20', ...] от start до end включительно"""
+    current, end = date.fromisoformat(start), date.fromisoformat(end)
+    dates = []
+    while current <= end:
+        dates.append(current.isoformat())
+        current += timedelta(days=step_days)
+    return dates
+
+def backtest_grid(generator, source, min_dates, cutoffs=('2025-07-01',), **param_values):
+    """Декартово произведение min_dates x cutoffs x значений каждого параметра (списки)"""
+    names = list(param_values)
+    return [
+        BacktestPoint(generator, source, min_date, cutoff, dict(zip(names, values)))
+        for min_date, cutoff in product(min_dates, cutoffs)
+        for values in product(*(param_values[name] for name in names))
+    ]
+
+
+#################
+def action_filter(type_col, actions, type_codes=None):
+    """Выражение-фильтр по значениям action_type / last_status (с учетом кодов EventStore)"""
+    if type_codes is not None:
+        actions = [type_codes[action] for action in actions if action in type_codes]
+    return pl.col(type_col).is_in(list(actions))
+
+class EventBuffer:
+    """
+    События источника (user_id, item_id, type_col, time_col), отсортированные по time_col.
+    window(min_date, cutoff) - срез по search_sorted без копирования данных.
+    type_codes - {action: код}, если type_col закодирован (EventStore);
+    actions - действия, которые есть в буфере (None - все)
+    """
+    def __init__(self, events, type_col, time_col, type_codes=None, actions=None):
+        self.events = events
+        self.type_col = type_col
+        self.time_col = time_col
+        self.type_codes = type_codes
+        self.actions = actions
+
+    @classmethod
+    def load(cls, files, source, min_date, cutoff, type_codes=None, actions=None):
+        """actions - читать только эти действия: фильтр в скане, до collect"""
+        type_col, time_col = SOURCES[source]['type_col'], SOURCES[source]['time_col']
+        events = (
+            pl.scan_parquet(files, extra_columns='ignore')
+            .select('user_id', 'item_id', type_col, time_col)
+            .filter(
+                (pl.col(time_col) > datetime.fromisoformat(min_date)) &
+                (pl.col(time_col) < datetime.fromisoformat(cutoff))
+            )
+        )
+        if actions is not None:
+            events = events.filter(action_filter(type_col, actions, type_codes))
+        events = events.sort(time_col, maintain_order=True).collect(engine='streaming')
+        return cls(events, type_col, time_col, type_codes, actions)
+
+    def window(self, min_date, cutoff):
+        times = self.events[self.time_col]
+        start = times.search_sorted(datetime.fromisoformat(min_date), 'right')
+        end = times.search_sorted(datetime.fromisoformat(cutoff), 'left')
+        return self.events.slice(start, max(end - start, 0))
+
+    def is_action(self, actions):
+        return action_filter(self.type_col, actions, self.type_codes)
+
+    def covers(self, actions):
+        """Есть ли в буфере все события, нужные точке (actions из point_actions)"""
+        return self.actions is None or (actions is not None and actions <= self.actions)
+
+
+def popular_candidates(buffer, window, n=100, actions=('delivered_orders',), user_actions=None):
+    """
+    Top-n items окна по числу событий actions - один список для всех пользователей окна
+    (пользователи с любыми событиями или только user_actions), как popular_items в experiments.ipynb
+    """
+    top = (
+        window.filter(buffer.is_action(actions))
+        .group_by('item_id')
+        .len()
+        .sort(['len', 'item_id'], descending=[True, False])
+        .head(n)['item_id']
+    )
+    users = window if user_actions is None else window.filter(buffer.is_action(user_actions))
+    return users.select(pl.col('user_id').unique()).with_columns(pl.lit(top.to_list(), dtype=pl.List(top.dtype)).alias('item_id'))
+
+def last_items_candidates(buffer, window, actions, n=None):
+    """Items событий actions каждого пользователя от новых к старым, n - ограничение длины списка"""
+    items = pl.col('item_id') if n is None else pl.col('item_id').head(n)
+    return (
+        window.filter(buffer.is_action(actions))
+        .reverse()
+        .group_by('user_id', maintain_order=True)
+        .agg(items)
+    )
+
+# generator -> функция (buffer, window, **params) -> pl.DataFrame(user_id, item_id: list)
+GENERATORS = {
+    'popular': popular_candidates,
+    'last_items': last_items_candidates,
+}
+
+
+# параметры генераторов со списками действий
+ACTION_PARAMS = ('actions', 'user_actions')
+
+
+#################
+def point_actions(point):
+    """
+    Действия, события которых читает генератор точки (с учетом значений по умолчанию);
+    None - нужны все события (например popular без user_actions берет пользователей с любыми действиями)
+    """
+    defaults = {
+        name: parameter.default for name, parameter in inspect.signature(GENERATORS[point.generator]).parameters.items()
+        if parameter.default is not inspect.Parameter.empty
+    }
+    params = {**defaults, **point.params}
+    actions = set()
+    for name in ACTION_PARAMS:
+        if name in params:
+            if params[name] is None:
+                return None
+            actions.update(params[name])
+    return actions
+
+def load_buffers(points, store=None):
+    """
+    Один EventBuffer на источник под самое широкое окно точек этого источника.
+    В буфер читаются только действия, нужные точкам источника (объединение point_actions).
+    store - EventStore (партиции и коды), по умолчанию сырые файлы из datasets()
+    """
+    buffers = {}
+    for source in sorted({point.source for point in points}):
+        source_points = [point for point in points if point.source == source]
+        min_date = min(point.min_date for point in source_points)
+        cutoff = max(point.cutoff for point in source_points)
+        point_sets = [point_actions(point) for point in source_points]
+        actions = None if any(point_set is None for point_set in point_sets) else set().union(*point_sets)
+        if store is not None:
+            files, type_codes = store.files(source, min_date=min_date, max_date=cutoff), store.type_codes(source)
+        else:
+            files, type_codes = datasets().files(source), None
+        buffers[source] = EventBuffer.load(files, source, min_date, cutoff, type_codes, actions)
+    return buffers
+
+def score_point(point, buffer, predictions_users, truth, k_values):
+    window = buffer.window(point.min_date, point.cutoff)
+    candidates = GENERATORS[point.generator](buffer, window, **point.params)
+    aggregated, _ = ranking_metrics(explode_ranked(candidates, 'item_id'), truth, k_values, users=predictions_users)
+    return {
+        'generator': point.generator,
+        'source': point.source,
+        'min_date': point.min_date,
+        'cutoff': point.cutoff,
+        **{name: str(value) if isinstance(value, (list, tuple)) else value for name, value in point.params.items()},
+        'window_events': window.height,
+        'n_users': candidates.height,
+        **aggregated,
+    }
+
+@telemetry.instrumented()
+def run_backtest(points, val_n_orders, k_values=[100], n_workers=4, store=None, buffers=None):
+    """
+    points - список BacktestPoint (backtest_grid), val_n_orders - user_id, item_ids: list (pandas или polars),
+    метрики по всем пользователям val_n_orders, как validate_recommendations.
+    С EventStore (store) user_id / item_id в val_n_orders должны быть кодами хранилища.
+    buffers - уже загруженные load_buffers, чтобы не читать события повторно между вызовами.
+    Возвращает pl.DataFrame: строка на точку - generator, source, min_date, cutoff, параметры, P/R/HR/MRR/nDCG@k
+    """
+    if not isinstance(val_n_orders, pl.DataFrame):
+        val_n_orders = pl.from_pandas(val_n_orders[['user_id', 'item_ids']])
+    truth = (
+        val_n_orders
+        .select('user_id', pl.col('item_ids').alias('item_id'))
+        .explode('item_id')
+        .drop_nulls('item_id')
+    )
+    users = val_n_orders.select('user_id')
+    if buffers is None:
+        buffers = load_buffers(points, store)
+    for point in points:
+        if not buffers[point.source].covers(point_actions(point)):
+            raise ValueError(f'в буфере {point.source} нет событий для точки {point}: загрузите buffers под все точки')
+
+    with ThreadPoolExecutor(n_workers) as executor:
+        rows = list(executor.map(
+            lambda point: score_point(point, buffers[point.source], users, truth, k_values), points
+        ))
+    results = pl.DataFrame(rows, infer_schema_length=None)
+    params = list(dict.fromkeys(name for point in points for name in point.params))
+    leading = ['generator', 'source', 'min_date', 'cutoff', *params, 'window_events', 'n_users']
+    return results.select(leading + [col for col in results.columns if col not in leading])
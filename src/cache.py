@@ -0,0 +1,130 @@
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+# Настройки кэша кандидатов; меняются через configure_cache
+CACHE_SETTINGS = {
+    'cache_dir': 'candidate_cache',
+    'max_bytes': 50 * 2**30,
+    'enabled': True,
+}
+CACHE_FILE_PATTERN = re.compile(r'.+-[0-9a-f]{16}\.parquet$')
+
+
+def configure_cache(cache_dir=None, max_bytes=None, enabled=None):
+    if cache_dir is not None:
+        CACHE_SETTINGS['cache_dir'] = cache_dir
+    if max_bytes is not None:
+        CACHE_SETTINGS['max_bytes'] = max_bytes
+    if enabled is not None:
+        CACHE_SETTINGS['enabled'] = enabled
+
+
+#################
+def fingerprint(value):
+    """Стабильная строка-отпечаток аргумента генератора"""
+    if isinstance(value, pl.DataFrame):
+        rows_hash = hashlib.sha1(value.hash_rows(seed=0).to_numpy().tobytes()).hexdigest()
+        return f'pl.DataFrame({value.schema}, {value.height}, {rows_hash})'
+    if isinstance(value, pd.DataFrame):
+        return fingerprint(pl.from_pandas(value))
+    if isinstance(value, np.ndarray):
+        return f'ndarray({value.dtype}, {value.shape}, {hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()})'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(fingerprint(v) for v in value) + ']'
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{k!r}: {fingerprint(v)}' for k, v in sorted(value.items())) + '}'
+    if callable(getattr(value, 'fingerprint', None)) and value.fingerprint() is not None:
+        return value.fingerprint()  # например индекс на диске - по файлам, без хэширования массивов
+    if hasattr(value, '__dict__') and not isinstance(value, type):
+        return f'{type(value).__name__}({fingerprint(vars(value))})'
+    return repr(value)
+
+def files_fingerprint(files):
+    """Путь, mtime и размер каждого входного файла"""
+    parts = []
+    for path in sorted(files):
+        stat = os.stat(path)
+        parts.append(f'{path}:{stat.st_mtime_ns}:{stat.st_size}')
+    return '\n'.join(parts)
+
+def cache_key(name, params, files=()):
+    """name - имя генератора, params - его аргументы, files - входные parquet"""
+    digest = hashlib.sha1()
+    digest.update(name.encode())
+    digest.update(fingerprint(params).encode())
+    digest.update(files_fingerprint(files).encode())
+    return f'{name}-{digest.hexdigest()[:16]}'
+
+
+#################
+def load_cached(key):
+    """DataFrame (memory map) или список из кэша; None, если записи нет"""
+    if not CACHE_SETTINGS['enabled']:
+        return None
+    path = os.path.join(CACHE_SETTINGS['cache_dir'], f'{key}.parquet')
+    if not os.path.exists(path):
+        return None
+    os.utime(path)  # mtime = время последнего обращения для LRU
+    df = pl.read_parquet(path, memory_map=True)
+    if df.columns == ['__list__']:
+        return df['__list__'].to_list()
+    return df
+
+def save_cached(key, result):
+    if not CACHE_SETTINGS['enabled']:
+        return
+    os.makedirs(CACHE_SETTINGS['cache_dir'], exist_ok=True)
+    path = os.path.join(CACHE_SETTINGS['cache_dir'], f'{key}.parquet')
+    if isinstance(result, list):
+        result = pl.DataFrame({'__list__': result})
+    result.write_parquet(path)
+    evict_cache()
+
+def evict_cache():
+    """Удаляем самые давние по обращению записи, пока кэш больше max_bytes"""
+    paths = [
+        path for path in glob.glob(os.path.join(CACHE_SETTINGS['cache_dir'], '*.parquet'))
+        if CACHE_FILE_PATTERN.match(os.path.basename(path))
+    ]
+    stats = sorted(((os.stat(path), path) for path in paths), key=lambda x: x[0].st_mtime_ns)
+    total = sum(stat.st_size for stat, _ in stats)
+    for stat, path in stats:
+        if total <= CACHE_SETTINGS['max_bytes']:
+            break
+        os.remove(path)
+        total -= stat.st_size
+
+
+#################
+def cached(input_files=None):
+    """
+    Кэширует результат генератора (pl.DataFrame или list) на диск.
+    Ключ - имя функции, все аргументы (DataFrame по хэшу строк) и mtime/размер input_files().
+    input_files - функция без аргументов, возвращающая список входных файлов.
+    use_cache=False в вызове - пересчитать и перезаписать запись
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, use_cache=True, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            files = input_files() if input_files is not None else ()
+            key = cache_key(func.__name__, dict(bound.arguments), files)
+
+            result = load_cached(key) if use_cache else None
+            if result is None:
+                result = func(*args, **kwargs)
+                save_cached(key, result)
+            return result
+        return wrapper
+    return decorator
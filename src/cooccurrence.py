@@ -0,0 +1,545 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from scipy.sparse import coo_matrix, csr_matrix, load_npz, save_npz
+from tqdm import tqdm
+
+from src.scan import file_time_ranges, parse_date
+from src import telemetry
+
+# Суммы весов корзин округляются до WEIGHT_DECIMALS знаков перед float32: одни и те же корзины, сложенные
+# в другом порядке (полный пересчет и дозагрузка CooccurrenceModel), дают одинаковые значения и порядок соседей
+WEIGHT_DECIMALS = 6
+
+
+#################
+def load_delivered_orders(order_files, min_date='2025-05-21', delivered_status='delivered_orders'):
+    """
+    Доставленные заказы после min_date: user_id, item_id, created_timestamp.
+    delivered_status - код статуса для файлов EventStore (store.type_codes('orders')['delivered_orders'])
+    """
+    return (
+        pl.scan_parquet(order_files, extra_columns='ignore')
+        .filter(
+            (pl.col('last_status') == delivered_status) &
+            (pl.col('created_timestamp') > parse_date(min_date))
+        )
+        .select(['user_id', 'item_id', 'created_timestamp'])
+        .collect(engine='streaming')
+    )
+
+def build_baskets(orders, window_days=1):
+    """
+    Корзины - уникальные items пользователя в одном временном окне window_days дней.
+    Оставляем только корзины из 2+ items
+    """
+    return (
+        orders
+        .with_columns(window_start=pl.col('created_timestamp').dt.truncate(f'{window_days}d'))
+        .group_by(['user_id', 'window_start'])
+        .agg(items=pl.col('item_id').unique())
+        .filter(pl.col('items').list.len() > 1)
+    )
+
+def inverse_basket_size_weights():
+    """Вес пары 1 / (размер корзины - 1): большие корзины не доминируют"""
+    def weights(baskets):
+        return 1.0 / (baskets['items'].list.len().to_numpy() - 1)
+    return weights
+
+def time_decay_weights(half_life_days=7, ref_time=None):
+    """Вес пары 0.5 ** (возраст корзины в днях / half_life_days) относительно ref_time (по умолчанию - самая свежая корзина)"""
+    def weights(baskets):
+        window_start = baskets['window_start']
+        ref = window_start.max() if ref_time is None else ref_time
+        age_days = (ref - window_start).dt.total_seconds().to_numpy() / 86400
+        return 0.5 ** (age_days / half_life_days)
+    return weights
+
+def basket_pairs(codes, sizes):
+    """
+    Все упорядоченные пары (i != j) внутри каждой корзины без цикла по корзинам.
+    codes - плоский массив кодов items, sizes - размеры корзин подряд.
+    Возвращает (rows, cols, basket) - basket[j] номер корзины пары j
+    """
+    starts = np.cumsum(sizes) - sizes
+    elem_basket = np.repeat(np.arange(len(sizes)), sizes)
+    elem_sizes = sizes[elem_basket]
+
+    pair_basket = np.repeat(elem_basket, elem_sizes)
+    row_pos = np.repeat(np.arange(len(codes)), elem_sizes)
+    col_pos = starts[pair_basket] + (
+        np.arange(elem_sizes.sum()) - np.repeat(np.cumsum(elem_sizes) - elem_sizes, elem_sizes)
+    )
+    mask = row_pos != col_pos
+    return codes[row_pos[mask]], codes[col_pos[mask]], pair_basket[mask]
+
+def build_cooccurrence_matrix(baskets, basket_weights=None, max_pairs_per_chunk=50_000_000, n_items=None):
+    """
+    Симметричная матрица co-occurrence items по корзинам из build_baskets.
+    basket_weights - None (счетчики, как раньше) или функция baskets -> вес каждой корзины,
+    например inverse_basket_size_weights() / time_decay_weights(7).
+    Корзины обрабатываются чанками примерно по max_pairs_per_chunk пар, чтобы ограничить пиковую память.
+    n_items - items уже плотные коды 0..n_items-1 (IdDictionary), тогда они сразу индексы матрицы.
+    Возвращает (csr, item_ids): строка / столбец i соответствует item_ids[i]
+    """
+    if n_items is None:
+        item_ids = np.unique(baskets['items'].explode().to_numpy())
+    else:
+        item_ids = np.arange(n_items, dtype=np.int32)
+    num_items = len(item_ids)
+    dtype = np.int32 if basket_weights is None else np.float64
+
+    sizes = baskets['items'].list.len().to_numpy().astype(np.int64)
+    weights = None if basket_weights is None else np.asarray(basket_weights(baskets), dtype=dtype)
+
+    # границы чанков по накопленному числу пар (с запасом sizes ** 2)
+    chunk_ids = (np.cumsum(sizes ** 2) - 1) // max_pairs_per_chunk
+    chunk_ends = np.append(np.flatnonzero(np.diff(chunk_ids)) + 1, len(sizes))
+
+    cooccurrence_csr = csr_matrix((num_items, num_items), dtype=dtype)
+    start = 0
+    for end in tqdm(chunk_ends, desc='Build cooccurrence matrix'):
+        codes = baskets['items'].slice(start, end - start).explode().to_numpy()
+        if n_items is None:
+            codes = np.searchsorted(item_ids, codes)
+        rows, cols, pair_basket = basket_pairs(codes, sizes[start:end])
+
+        if weights is None:
+            data = np.ones(len(rows), dtype=dtype)
+        else:
+            data = weights[start:end][pair_basket]
+
+        cooccurrence_csr += coo_matrix((data, (rows, cols)), shape=(num_items, num_items)).tocsr()
+        start = end
+
+    if basket_weights is not None:
+        cooccurrence_csr = round_weights(cooccurrence_csr)
+    return cooccurrence_csr, item_ids
+
+def round_weights(csr):
+    """float64 суммы весов -> float32 csr, округленный до WEIGHT_DECIMALS знаков"""
+    return csr_matrix((np.round(csr.data, WEIGHT_DECIMALS).astype(np.float32), csr.indices, csr.indptr), shape=csr.shape)
+
+def _descending_order(rows, vals):
+    """
+    Порядок: строки по возрастанию, внутри строки значения по убыванию.
+    Для 32-битных значений строка и значение упаковываются в один uint64-ключ - это быстрее lexsort
+    """
+    if vals.dtype == np.float32:
+        bits = vals.view(np.uint32)
+        bits = np.where(bits & 0x80000000, ~bits, bits | 0x80000000)
+    elif vals.dtype.kind in 'iu' and vals.dtype.itemsize <= 4:
+        bits = (vals.astype(np.int64) + 2**31).astype(np.uint32)
+    else:
+        return np.lexsort((-vals, rows))
+    key = (rows.astype(np.uint64) << np.uint64(32)) | (~bits).astype(np.uint64)
+    return np.argsort(key, kind='stable')
+
+def _topk_block(csr, row_start, row_end, k, exclude_diagonal):
+    """Top-k по строкам [row_start, row_end): (counts, columns, values)"""
+    lo, hi = csr.indptr[row_start], csr.indptr[row_end]
+    rows = np.repeat(np.arange(row_start, row_end), np.diff(csr.indptr[row_start:row_end + 1]))
+    cols = csr.indices[lo:hi]
+    vals = csr.data[lo:hi]
+
+    if exclude_diagonal:
+        mask = cols != rows
+        rows, cols, vals = rows[mask], cols[mask], vals[mask]
+
+    # сортировка внутри каждой строки по убыванию значения, строки остаются подряд
+    order = _descending_order(rows - row_start, vals)
+    rows, cols, vals = rows[order], cols[order], vals[order]
+
+    counts = np.bincount(rows - row_start, minlength=row_end - row_start)
+    rank = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = rank < k
+    return np.minimum(counts, k), cols[keep], vals[keep]
+
+def topk_csr_rows(csr, k, n_threads=1, block_rows=200_000, exclude_diagonal=True):
+    """
+    Top-k элементов каждой строки csr по убыванию значения, без цикла по строкам.
+    Строки обрабатываются блоками по block_rows, блоки - в n_threads потоках.
+    Возвращает (offsets, columns, values): top-k строки i - columns[offsets[i]:offsets[i+1]]
+    """
+    bounds = [(start, min(start + block_rows, csr.shape[0])) for start in range(0, csr.shape[0], block_rows)]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        blocks = list(pool.map(lambda b: _topk_block(csr, b[0], b[1], k, exclude_diagonal), bounds))
+
+    offsets = np.zeros(csr.shape[0] + 1, dtype=np.int64)
+    if blocks:
+        np.cumsum(np.concatenate([counts for counts, _, _ in blocks]), out=offsets[1:])
+        columns = np.concatenate([cols for _, cols, _ in blocks])
+        values = np.concatenate([vals for _, _, vals in blocks])
+    else:
+        columns = np.zeros(0, dtype=csr.indices.dtype)
+        values = np.zeros(0, dtype=csr.data.dtype)
+    return offsets, columns, values
+
+def list_column(offsets, values):
+    """Arrow list-колонка из offsets и плоского массива, без python-списков"""
+    return pl.from_arrow(pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(values)))
+
+def cooccurrence_neighbors(cooccurrence_csr, item_ids, k=15, n_threads=1):
+    """Top-k соседей каждого item по строкам матрицы: pl.DataFrame(item_id, neighbors); items без соседей пропускаются"""
+    offsets, columns, _ = topk_csr_rows(cooccurrence_csr, k, n_threads)
+    return pl.DataFrame({
+        'item_id': item_ids,
+        'neighbors': list_column(offsets, item_ids[columns]),
+    }).filter(pl.col('neighbors').list.len() > 0)
+
+@telemetry.instrumented()
+def build_cooccurrence_neighbors(order_files, output_path='cooccurrence_neighbors.parquet', min_date='2025-05-21',
+                                 window_days=1, k=15, basket_weights=None, n_threads=1, store=None):
+    """
+    Полный пересчет cooccurrence_neighbors.parquet из заказов.
+    store - EventStore: order_files - его партиции, item_id в таблице - коды словаря items
+    """
+    delivered_status, n_items = 'delivered_orders', None
+    if store is not None:
+        delivered_status = store.type_codes('orders')['delivered_orders']
+        n_items = len(store.items) if store.items is not None else None
+    st = telemetry.current_stage()
+    with st.timer('load'):
+        orders = load_delivered_orders(order_files, min_date, delivered_status)
+        baskets = build_baskets(orders, window_days)
+    with st.timer('matrix'):
+        cooccurrence_csr, item_ids = build_cooccurrence_matrix(baskets, basket_weights, n_items=n_items)
+    with st.timer('topk'):
+        neighbors_df = cooccurrence_neighbors(cooccurrence_csr, item_ids, k, n_threads)
+    st.record(rows_in=orders.height, baskets=baskets.height, nnz=cooccurrence_csr.nnz)
+    neighbors_df.write_parquet(output_path)
+    return neighbors_df
+
+
+#################
+def basket_pair_counts(baskets, basket_weights=None):
+    """
+    Пары корзин в long-формате без матрицы: pl.DataFrame(item_id, neighbor_id, value) с суммой по корзинам.
+    value - счетчик (Int32) или сумма весов basket_weights (Float64)
+    """
+    sizes = baskets['items'].list.len().to_numpy().astype(np.int64)
+    rows, cols, pair_basket = basket_pairs(baskets['items'].explode().to_numpy(), sizes)
+    if basket_weights is None:
+        data = np.ones(len(rows), dtype=np.int32)
+    else:
+        data = np.asarray(basket_weights(baskets), dtype=np.float64)[pair_basket]
+    return (
+        pl.DataFrame({'item_id': rows, 'neighbor_id': cols, 'value': data})
+        .group_by(['item_id', 'neighbor_id'])
+        .agg(pl.col('value').sum())
+    )
+
+class CooccurrenceModel:
+    """
+    Co-occurrence с дозагрузкой новых партиций заказов вместо полного пересчета build_cooccurrence_neighbors.
+    Счетчики пар хранятся по корзинам времени (window_start из build_baskets), матрица - сумма корзин окна:
+    ingest пересчитывает только корзины, которых касаются новые файлы, корзины старше horizon_days
+    вычитаются из матрицы, top-k обновляется только для строк, которые изменились.
+
+    path/
+      meta.json - параметры, обработанные файлы с (min_ts, max_ts), список корзин
+      buckets/YYYY-MM-DD.parquet - пары корзины (item_id, neighbor_id, value)
+      matrix.npz, item_ids.npy - сумма корзин окна, строка i соответствует item_ids[i]
+      neighbors.parquet - (item_id, neighbors), как cooccurrence_neighbors.parquet
+
+    basket_weights - None (счетчики) или вес, зависящий только от самой корзины (inverse_basket_size_weights):
+    time_decay_weights меняет веса всех корзин с каждым днем и инкрементально не обновляется.
+    Функция весов не сохраняется - в open передается та же, что в create.
+
+    model = CooccurrenceModel.create('cooccurrence_model', min_date='2025-05-21', horizon_days=41)
+    model.ingest(order_files, output_path='cooccurrence_neighbors.parquet')
+    """
+    def __init__(self, path, meta, basket_weights=None, n_threads=1):
+        self.path = path
+        self.meta = meta
+        self.basket_weights = basket_weights
+        self.n_threads = n_threads
+        self.window = timedelta(days=meta['window_days'])
+        dtype = np.int32 if basket_weights is None else np.float64
+        if os.path.exists(f'{path}/matrix.npz'):
+            self.matrix = load_npz(f'{path}/matrix.npz').astype(dtype).tocsr()
+            self.item_ids = np.load(f'{path}/item_ids.npy')
+            self.neighbors = pl.read_parquet(f'{path}/neighbors.parquet')
+        else:
+            self.matrix = csr_matrix((0, 0), dtype=dtype)
+            self.item_ids = np.zeros(0, dtype=np.int64)
+            self.neighbors = None
+
+    @classmethod
+    def create(cls, path, min_date='2025-05-21', window_days=1, horizon_days=None, k=15,
+               basket_weights=None, n_threads=1, store=None):
+        """
+        Пустая модель в path. min_date - заказы строго после min_date (как в build_cooccurrence_neighbors),
+        horizon_days - сколько дней корзин держать в матрице от самой свежей (None - без вытеснения).
+        store - EventStore: код статуса delivered_orders
+        """
+        meta = {
+            'min_date': min_date,
+            'window_days': window_days,
+            'horizon_days': horizon_days,
+            'k': k,
+            'delivered_status': 'delivered_orders' if store is None else store.type_codes('orders')['delivered_orders'],
+            'files': {},
+            'buckets': [],
+        }
+        os.makedirs(f'{path}/buckets', exist_ok=True)
+        with open(f'{path}/meta.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        return cls(path, meta, basket_weights, n_threads)
+
+    @classmethod
+    def open(cls, path, basket_weights=None, n_threads=1):
+        with open(f'{path}/meta.json') as f:
+            meta = json.load(f)
+        return cls(path, meta, basket_weights, n_threads)
+
+    def _bucket_path(self, window_start):
+        return f'{self.path}/buckets/{window_start:%Y-%m-%d}.parquet'
+
+    def _read_bucket(self, window_start):
+        return pl.read_parquet(self._bucket_path(window_start))
+
+    def _window_starts(self, min_ts, max_ts):
+        """Корзины (window_start), которые пересекает интервал [min_ts, max_ts]"""
+        first, last = pl.Series([min_ts, max_ts]).dt.truncate(f"{self.meta['window_days']}d").to_list()
+        starts = []
+        while first <= last:
+            starts.append(first)
+            first += self.window
+        return starts
+
+    def _file_ranges(self, files, time_ranges):
+        ranges = dict(time_ranges) if time_ranges is not None else file_time_ranges(files, 'created_timestamp')
+        for file_path in files:
+            if ranges.get(file_path, (None, None))[0] is None:
+                ranges[file_path] = pl.scan_parquet(file_path).select(
+                    pl.col('created_timestamp').min().alias('min_ts'), pl.col('created_timestamp').max().alias('max_ts')
+                ).collect().row(0)
+        return {file_path: ranges[file_path] for file_path in files}
+
+    def _load_orders(self, files, start, end):
+        """Доставленные заказы [start, end) строго после min_date"""
+        return (
+            pl.scan_parquet(files, extra_columns='ignore')
+            .filter(
+                (pl.col('last_status') == self.meta['delivered_status']) &
+                (pl.col('created_timestamp') > datetime.fromisoformat(self.meta['min_date'])) &
+                (pl.col('created_timestamp') >= start) &
+                (pl.col('created_timestamp') < end)
+            )
+            .select(['user_id', 'item_id', 'created_timestamp'])
+            .collect(engine='streaming')
+        )
+
+    def _apply(self, delta):
+        """Добавляет delta (item_id, neighbor_id, value) к матрице; возвращает индексы измененных строк"""
+        ids = delta['item_id'].to_numpy()
+        new_ids = np.union1d(self.item_ids, ids).astype(ids.dtype)
+        if len(new_ids) != len(self.item_ids):
+            coo = self.matrix.tocoo()
+            remap = np.searchsorted(new_ids, self.item_ids)
+            self.matrix = csr_matrix(
+                (coo.data, (remap[coo.row], remap[coo.col])), shape=(len(new_ids), len(new_ids)), dtype=self.matrix.dtype
+            )
+            self.item_ids = new_ids
+        rows = np.searchsorted(self.item_ids, ids)
+        cols = np.searchsorted(self.item_ids, delta['neighbor_id'].to_numpy())
+        data = delta['value'].to_numpy().astype(self.matrix.dtype)
+        self.matrix = (self.matrix + coo_matrix((data, (rows, cols)), shape=self.matrix.shape).tocsr()).tocsr()
+        if self.matrix.dtype.kind == 'f':
+            # остатки вычитания весов корзин; матрица хранит неокругленные float64 суммы
+            self.matrix.data[np.abs(self.matrix.data) < 1e-9] = 0
+        self.matrix.eliminate_zeros()
+        self.matrix.sort_indices()
+        return np.unique(rows)
+
+    def _refresh_neighbors(self, changed):
+        """
+        Top-k заново только для строк changed, остальные строки таблицы соседей не трогаются.
+        Веса округляются как в build_cooccurrence_matrix - порядок соседей совпадает с полным пересчетом
+        """
+        rows = self.matrix[changed]
+        if rows.dtype.kind == 'f':
+            rows = round_weights(rows)
+        offsets, columns, _ = topk_csr_rows(rows, self.meta['k'], self.n_threads, exclude_diagonal=False)
+        refreshed = pl.DataFrame({
+            'item_id': self.item_ids[changed],
+            'neighbors': list_column(offsets, self.item_ids[columns]),
+        }).filter(pl.col('neighbors').list.len() > 0)
+        if self.neighbors is None:
+            self.neighbors = refreshed
+        else:
+            self.neighbors = pl.concat([
+                self.neighbors.filter(~pl.col('item_id').is_in(pl.Series(self.item_ids[changed]))),
+                refreshed.cast(self.neighbors.schema),
+            ]).sort('item_id')
+
+    @telemetry.instrumented()
+    def ingest(self, order_files, time_ranges=None, output_path=None):
+        """
+        Добавляет новые файлы заказов (уже обработанные пропускаются).
+        Корзины, которых касаются новые файлы, пересчитываются целиком по всем файлам, пересекающим их
+        (сырые дневные файлы немного заходят за полночь), и заменяют старые счетчики этих корзин.
+        time_ranges - {файл: (min_ts, max_ts)}, например store.time_ranges('orders'), иначе футеры parquet.
+        Возвращает таблицу соседей; output_path - куда еще ее записать (cooccurrence_neighbors.parquet)
+        """
+        st = telemetry.current_stage()
+        new_files = [file_path for file_path in order_files if file_path not in self.meta['files']]
+        files = {
+            file_path: tuple(map(datetime.fromisoformat, bounds)) for file_path, bounds in self.meta['files'].items()
+        }
+        files.update(self._file_ranges(new_files, time_ranges))
+        buckets = set(map(datetime.fromisoformat, self.meta['buckets']))
+        min_start = pl.Series([datetime.fromisoformat(self.meta['min_date'])]).dt.truncate(f"{self.meta['window_days']}d")[0]
+        touched = sorted({
+            window_start
+            for file_path in new_files
+            for window_start in self._window_starts(*files[file_path])
+            if window_start >= min_start
+        })
+
+        # вытеснение: корзины, которые целиком старше horizon_days от конца самой свежей
+        expire_before = None
+        if self.meta['horizon_days'] is not None and (buckets or touched):
+            expire_before = max(buckets | set(touched)) + self.window - timedelta(days=self.meta['horizon_days'])
+            touched = [window_start for window_start in touched if window_start >= expire_before]
+
+        deltas = []
+        with st.timer('buckets'):
+            if touched:
+                start, end = touched[0], touched[-1] + self.window
+                read_files = [file_path for file_path, (lo, hi) in files.items() if hi >= start and lo < end]
+                orders = self._load_orders(read_files, start, end)
+                baskets = build_baskets(orders, self.meta['window_days'])
+                st.record(rows_in=orders.height, baskets=baskets.height, files_read=len(read_files))
+                for window_start in touched:
+                    pairs = basket_pair_counts(
+                        baskets.filter(pl.col('window_start') == window_start), self.basket_weights
+                    )
+                    if window_start in buckets:
+                        deltas.append(self._read_bucket(window_start).with_columns(-pl.col('value')))
+                    if pairs.height:
+                        pairs.write_parquet(self._bucket_path(window_start))
+                        deltas.append(pairs)
+                        buckets.add(window_start)
+                    elif window_start in buckets:
+                        os.remove(self._bucket_path(window_start))
+                        buckets.discard(window_start)
+            expired = sorted(window_start for window_start in buckets if expire_before is not None and window_start < expire_before)
+            for window_start in expired:
+                deltas.append(self._read_bucket(window_start).with_columns(-pl.col('value')))
+                os.remove(self._bucket_path(window_start))
+                buckets.discard(window_start)
+
+        changed = np.zeros(0, dtype=np.int64)
+        if deltas:
+            delta = (
+                pl.concat([df.with_columns(pl.col('value').cast(pl.Float64)) for df in deltas])
+                .group_by(['item_id', 'neighbor_id'])
+                .agg(pl.col('value').sum())
+                .filter(pl.col('value') != 0)
+            )
+            with st.timer('matrix'):
+                changed = self._apply(delta)
+            with st.timer('topk'):
+                self._refresh_neighbors(changed)
+        if self.neighbors is None:
+            self.neighbors = cooccurrence_neighbors(csr_matrix((0, 0), dtype=self.matrix.dtype), self.item_ids)
+        st.record(
+            new_files=len(new_files), touched_buckets=len(touched), expired_buckets=len(expired),
+            changed_items=len(changed), nnz=self.matrix.nnz
+        )
+
+        self.meta['files'] = {file_path: [lo.isoformat(), hi.isoformat()] for file_path, (lo, hi) in files.items()}
+        self.meta['buckets'] = [window_start.isoformat() for window_start in sorted(buckets)]
+        self.save()
+        if output_path is not None:
+            self.neighbors.write_parquet(output_path)
+        return self.neighbors
+
+    def save(self):
+        save_npz(f'{self.path}/matrix.npz', self.matrix)
+        np.save(f'{self.path}/item_ids.npy', self.item_ids)
+        self.neighbors.write_parquet(f'{self.path}/neighbors.parquet')
+        with open(f'{self.path}/meta.json', 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+
+#################
+class CooccurNeighborIndex:
+    """
+    Таблица соседей item_id -> neighbors в виде трех массивов:
+    item_ids (отсортированы), offsets (len = n_items + 1), neighbors (плоский массив).
+    Соседи item_ids[i] - это neighbors[offsets[i]:offsets[i+1]] в порядке убывания близости.
+    """
+    def __init__(self, item_ids, offsets, neighbors):
+        self.item_ids = item_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+
+    @classmethod
+    def from_frame(cls, neighbors_df):
+        """neighbors_df - pl.DataFrame(item_id, neighbors: list), например cooccurrence_neighbors.parquet"""
+        neighbors_df = neighbors_df.select('item_id', 'neighbors').sort('item_id')
+        lengths = neighbors_df['neighbors'].list.len().fill_null(0).to_numpy()
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        neighbors = (
+            neighbors_df.filter(pl.col('neighbors').list.len() > 0)
+            .get_column('neighbors')
+            .explode()
+            .to_numpy()
+        )
+        return cls(neighbors_df['item_id'].to_numpy(), offsets, neighbors)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/item_ids.npy', self.item_ids)
+        np.save(f'{path}/offsets.npy', self.offsets)
+        np.save(f'{path}/neighbors.npy', self.neighbors)
+
+    @classmethod
+    def load(cls, path):
+        """Массивы открываются через memory map и не читаются в память целиком"""
+        return cls(
+            np.load(f'{path}/item_ids.npy', mmap_mode='r'),
+            np.load(f'{path}/offsets.npy', mmap_mode='r'),
+            np.load(f'{path}/neighbors.npy', mmap_mode='r'),
+        )
+
+    def lookup(self, items, k=None):
+        """
+        Соседи для массива items (первые k каждого).
+        Возвращает (rows, neighbors): neighbors[j] - сосед items[rows[j]]
+        """
+        items = np.asarray(items)
+        if len(self.item_ids) == 0 or len(items) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.neighbors.dtype)
+
+        pos = np.minimum(np.searchsorted(self.item_ids, items), len(self.item_ids) - 1)
+        found = self.item_ids[pos] == items
+        starts = np.where(found, self.offsets[pos], 0)
+        lengths = np.where(found, self.offsets[pos + 1] - starts, 0)
+        if k is not None:
+            lengths = np.minimum(lengths, k)
+
+        rows = np.repeat(np.arange(len(items)), lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return rows, self.neighbors[np.repeat(starts, lengths) + within]
+
+
+@lru_cache(maxsize=None)
+def load_cooccur_index(path):
+    """Индекс загружается один раз на процесс и переиспользуется между вызовами"""
+    return CooccurNeighborIndex.load(path)
+
+
+def save_cooccur_index(neighbors_df, path):
+    CooccurNeighborIndex.from_frame(neighbors_df).save(path)
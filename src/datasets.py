@@ -0,0 +1,60 @@
+"""
+Ленивый реестр исходных данных: списки parquet tracker / orders и тестовые пользователи.
+Ничего не читается при импорте - файлы ищутся и тестовые пользователи загружаются при первом обращении
+и кэшируются на процесс. Корень данных задается configure_datasets.
+
+configure_datasets('data')
+datasets().files('tracker'), datasets().test_user_ids
+"""
+import functools
+import glob
+import os
+
+import polars as pl
+
+from src.event_store import SOURCES
+
+TEST_USERS_FILE = 'ml_ozon_recsys_test.snappy.parquet'
+
+
+class DatasetRegistry:
+    """
+    Данные под data_root. files(source) - отсортированный список parquet источника ('tracker' / 'orders'),
+    test_user_ids - отсортированный pl.Series тестовых user_id (Arrow: is_in и передача в процессы без python set)
+    """
+    def __init__(self, data_root='data'):
+        self.data_root = data_root
+        self._files = {}
+
+    @property
+    def test_users_path(self):
+        return os.path.join(self.data_root, TEST_USERS_FILE)
+
+    def files(self, source):
+        if source not in self._files:
+            self._files[source] = sorted(glob.glob(os.path.join(self.data_root, SOURCES[source]['pattern'])))
+        return self._files[source]
+
+    @property
+    def tracker_files(self):
+        return self.files('tracker')
+
+    @property
+    def order_files(self):
+        return self.files('orders')
+
+    @functools.cached_property
+    def test_user_ids(self):
+        return pl.read_parquet(self.test_users_path, columns=['user_id'])['user_id'].unique().sort()
+
+_REGISTRY = DatasetRegistry()
+
+
+def configure_datasets(data_root='data'):
+    """Новый корень данных; списки файлов и тестовые пользователи перечитаются при следующем обращении"""
+    global _REGISTRY
+    _REGISTRY = DatasetRegistry(data_root)
+    return _REGISTRY
+
+def datasets():
+    return _REGISTRY
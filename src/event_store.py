@@ -0,0 +1,221 @@
+"""
+Компактное хранилище событий: tracker и заказы переписываются один раз
+в партиции по дате, внутри партиции строки отсортированы по user_id.
+user_id / item_id заменены плотными Int32 кодами общих словарей ids/*.npy (src/id_dict.py),
+исходные id возвращаются только при выгрузке сабмита (EventStore.decode_ids).
+
+python -m src.event_store --data-root data --store-root event_store
+"""
+import argparse
+import glob
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+from src.id_dict import IdDictionary
+
+SOURCES = {
+    'tracker': {
+        'pattern': 'final_apparel_tracker_data_08_action_widget/*/*.parquet',
+        'type_col': 'action_type',
+        'time_col': 'timestamp',
+    },
+    'orders': {
+        'pattern': 'final_apparel_orders_data_07/*/*.parquet',
+        'type_col': 'last_status',
+        'time_col': 'created_timestamp',
+    },
+}
+MANIFEST = 'manifest.json'
+ID_DICTIONARIES = {'user_id': 'ids/user_id.npy', 'item_id': 'ids/item_id.npy'}
+
+
+#################
+def ingest_source(raw_files, store_root, source, users, items):
+    """
+    Переписываем один источник: партиция date=YYYY-MM-DD на каждый день,
+    type_col -> UInt8 код по словарю, user_id / item_id -> Int32 коды IdDictionary users / items.
+    Рядом пишется activity.parquet - число событий каждого типа у пользователя по дням (для пропуска файлов в scan_events).
+    Возвращает раздел манифеста для источника
+    """
+    type_col = SOURCES[source]['type_col']
+    time_col = SOURCES[source]['time_col']
+    columns = ['user_id', 'item_id', type_col, time_col]
+    raw = pl.scan_parquet(raw_files, extra_columns='ignore').select(columns)
+
+    stats = raw.select(
+        pl.col(time_col).min().alias('min_ts'),
+        pl.col(time_col).max().alias('max_ts'),
+    ).collect(engine='streaming').row(0, named=True)
+    dictionary = sorted(
+        raw.select(pl.col(type_col).unique()).collect(engine='streaming')[type_col].drop_nulls().to_list()
+    )
+
+    files, activity = [], []
+    day = stats['min_ts'].date()
+    days = [day + timedelta(days=i) for i in range((stats['max_ts'].date() - day).days + 1)]
+    for day in tqdm(days, desc=f'Ingest {source}'):
+        day_start = pl.datetime(day.year, day.month, day.day)
+        next_day = day + timedelta(days=1)
+        partition = (
+            raw.filter(
+                (pl.col(time_col) >= day_start) &
+                (pl.col(time_col) < pl.datetime(next_day.year, next_day.month, next_day.day))
+            )
+            .with_columns(
+                pl.col(type_col).replace_strict(dictionary, list(range(len(dictionary))), return_dtype=pl.UInt8),
+            )
+            .collect(engine='streaming')
+        )
+        if partition.height == 0:
+            continue
+        partition = items.encode_columns(users.encode_columns(partition, ['user_id']), ['item_id'])
+        partition = partition.sort(['user_id', time_col])
+        activity.append(partition.group_by('user_id', type_col).agg(pl.len().alias('events')).with_columns(date=pl.lit(day)))
+
+        rel_path = f'{source}/date={day.isoformat()}/part-0.parquet'
+        os.makedirs(os.path.dirname(os.path.join(store_root, rel_path)), exist_ok=True)
+        partition.write_parquet(os.path.join(store_root, rel_path), statistics=True)
+        files.append({
+            'path': rel_path,
+            'date': day.isoformat(),
+            'rows': partition.height,
+            'min_ts': partition[time_col].min().isoformat(),
+            'max_ts': partition[time_col].max().isoformat(),
+        })
+
+    activity_path = f'{source}/activity.parquet'
+    pl.concat(activity).sort('user_id', 'date').write_parquet(os.path.join(store_root, activity_path))
+    return {
+        'type_col': type_col,
+        'time_col': time_col,
+        'dictionary': dictionary,
+        'files': files,
+        'activity': activity_path,
+    }
+
+def load_id_dictionaries(store_root):
+    """(users, items) хранилища; пустые словари, если их еще нет"""
+    dictionaries = []
+    for column in ('user_id', 'item_id'):
+        path = os.path.join(store_root, ID_DICTIONARIES[column])
+        dictionaries.append(IdDictionary.load(path) if os.path.exists(path) else IdDictionary(np.zeros(0, dtype=np.int64)))
+    return dictionaries
+
+def build_event_store(data_root='data', store_root='event_store', sources=('tracker', 'orders'),
+                      test_users_path='data/ml_ozon_recsys_test.snappy.parquet'):
+    """
+    Пересборка источников sources из сырых parquet и запись manifest.json.
+    Словари user_id / item_id общие для всех источников и только дополняются,
+    тестовые пользователи из test_users_path тоже получают коды
+    """
+    manifest_path = os.path.join(store_root, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    users, items = load_id_dictionaries(store_root)
+    raw_files = {source: sorted(glob.glob(os.path.join(data_root, SOURCES[source]['pattern']))) for source in sources}
+    for source in sources:
+        ids = pl.scan_parquet(raw_files[source], extra_columns='ignore').select('user_id', 'item_id')
+        users.extend(ids.select(pl.col('user_id').unique()).collect(engine='streaming')['user_id'].drop_nulls().to_numpy())
+        items.extend(ids.select(pl.col('item_id').unique()).collect(engine='streaming')['item_id'].drop_nulls().to_numpy())
+    if test_users_path is not None and os.path.exists(test_users_path):
+        users.extend(pl.read_parquet(test_users_path, columns=['user_id'])['user_id'].to_numpy())
+    users.save(os.path.join(store_root, ID_DICTIONARIES['user_id']))
+    items.save(os.path.join(store_root, ID_DICTIONARIES['item_id']))
+    manifest['id_dictionaries'] = ID_DICTIONARIES
+
+    for source in sources:
+        manifest[source] = ingest_source(raw_files[source], store_root, source, users, items)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+#################
+class EventStore:
+    """Чтение хранилища: список партиций под окно дат и коды action_type / last_status"""
+    def __init__(self, store_root='event_store'):
+        self.store_root = store_root
+        with open(os.path.join(store_root, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.users, self.items = None, None
+        if 'id_dictionaries' in self.manifest:
+            self.users, self.items = load_id_dictionaries(store_root)
+
+    def files(self, source, min_date=None, max_date=None):
+        """
+        Партиции источника от старых к новым, пересекающиеся с окном (min_date, max_date).
+        min_date / max_date - строки 'YYYY-MM-DD'
+        """
+        files = []
+        for entry in self.manifest[source]['files']:
+            if min_date is not None and entry['max_ts'] <= min_date:
+                continue
+            if max_date is not None and entry['min_ts'] >= max_date:
+                continue
+            files.append(os.path.join(self.store_root, entry['path']))
+        return files
+
+    def time_ranges(self, source):
+        """{путь партиции: (min_ts, max_ts)} из манифеста - scan_events не читает футеры parquet"""
+        return {
+            os.path.join(self.store_root, entry['path']): (datetime.fromisoformat(entry['min_ts']), datetime.fromisoformat(entry['max_ts']))
+            for entry in self.manifest[source]['files']
+        }
+
+    def activity(self, source):
+        """pl.DataFrame(user_id, type_col, events, date) - события по дням; None для хранилища, собранного без activity"""
+        path = self.manifest[source].get('activity')
+        if path is None:
+            return None
+        return pl.read_parquet(os.path.join(self.store_root, path))
+
+    def type_codes(self, source):
+        """{'to_cart': 3, ...} для фильтрации по закодированной колонке"""
+        return {value: code for code, value in enumerate(self.manifest[source]['dictionary'])}
+
+    def decode_types(self, source):
+        """Выражение, возвращающее строковые значения type_col"""
+        type_col = self.manifest[source]['type_col']
+        dictionary = self.manifest[source]['dictionary']
+        return pl.col(type_col).replace_strict(list(range(len(dictionary))), dictionary, return_dtype=pl.String)
+
+    def encode_items(self, df, columns=('item_id',)):
+        """
+        Внешняя таблица с исходными item_id (nearest_neighbors, соседи из каталога) -> коды.
+        Items, которых не было в событиях, дописываются в словарь хранилища
+        """
+        for column in columns:
+            values = df[column].explode() if df.schema[column] == pl.List else df[column]
+            if self.items.extend(values.drop_nulls().to_numpy()):
+                self.items.save(os.path.join(self.store_root, ID_DICTIONARIES['item_id']))
+        return self.items.encode_columns(df, list(columns))
+
+    def decode_ids(self, df, user_cols=('user_id',), item_cols=('item_id',)):
+        """Коды user_id / item_id (в том числе list-колонки) -> исходные id; для выгрузки сабмита"""
+        if self.users is None:
+            return df
+        df = self.users.decode_columns(df, [col for col in user_cols if col in df.columns])
+        return self.items.decode_columns(df, [col for col in item_cols if col in df.columns])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сборка компактного хранилища событий')
+    parser.add_argument('--data-root', default='data')
+    parser.add_argument('--store-root', default='event_store')
+    parser.add_argument('--sources', nargs='+', default=['tracker', 'orders'], choices=list(SOURCES))
+    parser.add_argument('--test-users', default='data/ml_ozon_recsys_test.snappy.parquet')
+    args = parser.parse_args()
+    build_event_store(args.data_root, args.store_root, args.sources, args.test_users)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+Хранилище фичей для ранкера: user / user-item статистики за окна (взвешенные
+счетчики, давность, конверсии) считаются одним group_by по (user_id, item_id), item статистики -
+по всем пользователям на срез каждого пользователя; все сохраняется версионированными parquet-таблицами.
+
+store = build_features(tracker_files, order_files, 'features', user_cutoff_time=user_cutoff_time)
+train = store.join(candidates_exploded, features=FEATURE_COLS)
+"""
+import json
+import os
+import shutil
+
+import polars as pl
+
+from src.cache import cache_key
+from src.scan import parse_date
+from src import telemetry
+
+# Веса действий как в catboostv2.ipynb; действия не из словаря - 0
+ACTION_WEIGHTS = {
+    'delivered_orders': 6.0,
+    'proccesed_orders': 4.0,
+    'to_cart': 3.0,
+    'favorite': 2.0,
+    'view_description': 1.5,
+    'review_view': 1.5,
+    'page_view': 1.0,
+    'unfavorite': -0.5,
+    'remove': -1.0,
+    'canceled_orders': -1.0,
+}
+EXCLUDED_ACTIONS = ['page_view', 'unfavorite', 'remove', 'canceled_orders']
+ORDER_ACTION = 'delivered_orders'
+CART_ACTION = 'to_cart'
+# Окна в днях до момента отсечки; None - вся история
+WINDOWS = {'7d': 7, '14d': 14, 'all': None}
+# Меняется вместе с определениями фичей - старые версии таблиц не переиспользуются
+FEATURE_SCHEMA_VERSION = 2
+# item - на срез item_ref; item_refs - срез каждого пользователя, по нему join выбирает строку item
+BLOCK_KEYS = {
+    'ui': ['user_id', 'item_id'], 'user': ['user_id'], 'item': ['item_id', 'item_ref'], 'item_refs': ['user_id', 'item_ref'],
+}
+ITEM_COUNTERS = ['actions', 'orders', 'cart', 'total_weight']
+
+
+#################
+def event_frame(files, type_col, time_col, type_codes=None, min_date=None):
+    """
+    LazyFrame(user_id, item_id, action, timestamp, weight) одного источника.
+    type_codes - {значение: код} для закодированной колонки EventStore
+    """
+    action = pl.col(type_col)
+    if type_codes is not None:
+        action = action.replace_strict(list(type_codes.values()), list(type_codes.keys()), return_dtype=pl.String)
+    lf = pl.scan_parquet(list(files), extra_columns='ignore').select(
+        'user_id', 'item_id', action.alias('action'), pl.col(time_col).alias('timestamp')
+    ).filter(~pl.col('action').is_in(EXCLUDED_ACTIONS))
+    if min_date is not None:
+        lf = lf.filter(pl.col('timestamp') > parse_date(min_date))
+    return lf.with_columns(
+        pl.col('action').replace_strict(
+            list(ACTION_WEIGHTS), list(ACTION_WEIGHTS.values()), default=0.0, return_dtype=pl.Float32
+        ).alias('weight')
+    )
+
+def window_aggs(prefix, ref, upper, windows):
+    """
+    Агрегаты по (user_id, item_id) для каждого окна: события в [ref - days, ref), ref - выражение.
+    upper - условие попадания события в блок (отсечка)
+    """
+    time = pl.col('timestamp')
+    aggs = []
+    for suffix, days in windows.items():
+        in_window = upper if days is None else upper & (time >= ref - pl.duration(days=days))
+        aggs += [
+            in_window.sum().alias(f'{prefix}_actions_{suffix}'),
+            (in_window & (pl.col('action') == ORDER_ACTION)).sum().alias(f'{prefix}_orders_{suffix}'),
+            (in_window & (pl.col('action') == CART_ACTION)).sum().alias(f'{prefix}_cart_{suffix}'),
+            pl.col('weight').filter(in_window).sum().alias(f'{prefix}_total_weight_{suffix}'),
+        ]
+    aggs.append(time.filter(upper).max().alias(f'{prefix}_last_ts'))
+    return aggs
+
+def days_since(last_ts, ref):
+    return ((ref - last_ts).dt.total_seconds() / 86400).cast(pl.Float32)
+
+def ratio_features(windows):
+    """{фича: (числитель, знаменатель)}, значение = числитель / (знаменатель + 1)"""
+    ratios = {}
+    for suffix in windows:
+        ratios[f'share_ui_cart_in_user_cart_{suffix}'] = (f'ui_cart_{suffix}', f'user_cart_{suffix}')
+        ratios[f'share_ui_orders_in_user_orders_{suffix}'] = (f'ui_orders_{suffix}', f'user_orders_{suffix}')
+        ratios[f'item_conv_rate_{suffix}'] = (f'item_orders_{suffix}', f'item_actions_{suffix}')
+        ratios[f'user_conv_rate_{suffix}'] = (f'user_orders_{suffix}', f'user_actions_{suffix}')
+    return ratios
+
+def item_features_at(events, ref, windows):
+    """
+    item фичи по всем пользователям на один срез ref (события до ref включительно) - submit.
+    pl.DataFrame(item_id, item_ref, ...)
+    """
+    time = pl.col('timestamp')
+    ref = pl.lit(ref).cast(events.collect_schema()['timestamp'])
+    upper = time <= ref
+    unique_users = [
+        pl.col('user_id').filter(upper if days is None else upper & (time >= ref - pl.duration(days=days)))
+        .n_unique().cast(pl.UInt32).alias(f'item_unique_users_{suffix}')
+        for suffix, days in windows.items()
+    ]
+    item = (
+        events.filter(upper)
+        .group_by('item_id')
+        .agg(*window_aggs('item', ref, upper, windows), *unique_users)
+        .collect(engine='streaming')
+    )
+    return item.select(
+        'item_id', ref.alias('item_ref'), pl.exclude('item_id', 'item_last_ts'),
+        days_since(pl.col('item_last_ts'), ref).alias('item_days_since_last'),
+    )
+
+def as_of(frame, at, table, columns, suffix=''):
+    """К строкам frame (item_id, ...) - columns из последней строки table (item_id, day, ...) с day <= at"""
+    lookup = table.select('item_id', pl.col('day').alias('at'), *[pl.col(col).alias(f'{col}{suffix}') for col in columns])
+    return (
+        frame.with_columns(at.alias('at')).sort('at')
+        .join_asof(lookup.sort('at'), on='at', by='item_id', strategy='backward', check_sortedness=False)
+        .drop('at')
+    )
+
+def item_features_by_day(events, refs, windows):
+    """
+    item фичи по всем пользователям на начало каждого дня из refs (события строго раньше) - train:
+    у каждого пользователя свой срез, как и в submit, без заглядывания в будущее.
+    Дневные счетчики item копятся cum_sum, окно [D - days, D) - разность накопленного до D и до D - days.
+    Уникальные пользователи - разностный массив: активный день d пользователя покрывает срезы (d, d + days]
+    до его следующего активного дня, так что куски не пересекаются и пользователь считается один раз.
+    pl.DataFrame(item_id, item_ref, ...)
+    """
+    time = pl.col('timestamp')
+    one_day = pl.duration(days=1)
+    events = events.filter(time < refs.max()).with_columns(time.dt.truncate('1d').alias('day'))
+    daily = (
+        events.group_by(['item_id', 'day'])
+        .agg(
+            pl.len().alias('actions'),
+            (pl.col('action') == ORDER_ACTION).sum().alias('orders'),
+            (pl.col('action') == CART_ACTION).sum().alias('cart'),
+            pl.col('weight').cast(pl.Float64).sum().alias('total_weight'),
+            time.max().alias('last_ts'),
+        )
+        .collect(engine='streaming')
+        .sort(['item_id', 'day'])
+        .with_columns(pl.col(ITEM_COUNTERS).cum_sum().over('item_id'))
+    )
+    user_days = (
+        events.select('item_id', 'user_id', 'day').unique()
+        .collect(engine='streaming')
+        .sort(['item_id', 'user_id', 'day'])
+        .with_columns(pl.col('day').shift(-1).over(['item_id', 'user_id']).alias('next_day'))
+    )
+
+    # строки только для items, у которых к срезу уже были события
+    item = (
+        daily.group_by('item_id').agg(pl.col('day').min().alias('first_day'))
+        .join(pl.DataFrame({'item_ref': refs.unique()}), how='cross')
+        .filter(pl.col('first_day') < pl.col('item_ref'))
+        .drop('first_day')
+    )
+    before = pl.col('item_ref') - one_day
+    item = as_of(item, before, daily, ITEM_COUNTERS + ['last_ts'])
+    for suffix, days in windows.items():
+        start = [0] * len(ITEM_COUNTERS)
+        if days is not None:
+            item = as_of(item, before - pl.duration(days=days), daily, ITEM_COUNTERS, '_start')
+            start = [pl.col(f'{col}_start').fill_null(0) for col in ITEM_COUNTERS]
+        end = pl.col('next_day') if days is None else pl.min_horizontal(pl.col('day') + pl.duration(days=days), pl.col('next_day'))
+        coverage = (
+            pl.concat([
+                user_days.select('item_id', (pl.col('day') + one_day).alias('day'), pl.lit(1, pl.Int32).alias('delta')),
+                user_days.select('item_id', (end + one_day).alias('day'), pl.lit(-1, pl.Int32).alias('delta')).drop_nulls('day'),
+            ])
+            .group_by(['item_id', 'day']).agg(pl.col('delta').sum())
+            .sort(['item_id', 'day'])
+            .select('item_id', 'day', pl.col('delta').cum_sum().over('item_id').alias('unique_users'))
+        )
+        item = as_of(item, pl.col('item_ref'), coverage, ['unique_users']).with_columns(
+            *[
+                (pl.col(col) - value).cast(pl.Float32 if col == 'total_weight' else pl.UInt32).alias(f'item_{col}_{suffix}')
+                for col, value in zip(ITEM_COUNTERS, start)
+            ],
+            pl.col('unique_users').fill_null(0).cast(pl.UInt32).alias(f'item_unique_users_{suffix}'),
+        ).drop('unique_users', *[f'{col}_start' for col in ITEM_COUNTERS if days is not None])
+    return item.select(
+        'item_id', 'item_ref',
+        *[f'item_{col}_{suffix}' for suffix in windows for col in ITEM_COUNTERS],
+        *[f'item_unique_users_{suffix}' for suffix in windows],
+        days_since(pl.col('last_ts'), pl.col('item_ref')).alias('item_days_since_last'),
+    ).sort(['item_id', 'item_ref'])
+
+
+#################
+@telemetry.instrumented()
+def compute_features(events, user_cutoff_time=None, ref_time=None, item_ref_time=None, user_ids=None, windows=WINDOWS):
+    """
+    events - LazyFrame из event_frame.
+    ui / user: train - user_cutoff_time pl.DataFrame(user_id, cutoff_time), события строго до cutoff
+    пользователя, окна от него; submit - окна от ref_time (по умолчанию последний timestamp), user_ids - фильтр.
+    item - по всем пользователям (популярность не зависит от того, кого скорим) на срез item_ref:
+    train - начало дня cutoff каждого пользователя; submit - item_ref_time (по умолчанию ref_time).
+    Возвращает {'ui', 'user', 'item', 'item_refs'} - pl.DataFrame, item_refs - (user_id, item_ref)
+    """
+    schema = events.collect_schema()
+    id_dtype, time_dtype = schema['user_id'], schema['timestamp']
+    time = pl.col('timestamp')
+    if user_cutoff_time is not None:
+        if item_ref_time is not None:
+            raise ValueError('item_ref_time - только для submit: в train item фичи считаются на cutoff каждого пользователя')
+        cutoffs = user_cutoff_time.select(pl.col('user_id').cast(id_dtype), pl.col('cutoff_time').cast(time_dtype).alias('ref'))
+        user_events = events.join(cutoffs.lazy(), on='user_id')
+        user_upper = time < pl.col('ref')
+        item_refs = cutoffs.select('user_id', pl.col('ref').dt.truncate('1d').alias('item_ref'))
+        item = item_features_by_day(events, item_refs['item_ref'], windows)
+    else:
+        if ref_time is None:
+            ref_time = events.select(time.max()).collect(engine='streaming').item()
+        item_ref_time = ref_time if item_ref_time is None else item_ref_time
+        user_events = events
+        if user_ids is not None:
+            user_events = events.filter(pl.col('user_id').is_in(pl.Series(user_ids).cast(id_dtype, strict=False)))
+        user_events = user_events.with_columns(pl.lit(ref_time).cast(time_dtype).alias('ref'))
+        user_upper = time <= pl.col('ref')
+        users = user_events.select(pl.col('user_id').unique()).collect(engine='streaming')
+        if user_ids is not None:
+            users = pl.DataFrame({'user_id': pl.Series(user_ids).cast(id_dtype, strict=False)}).drop_nulls().unique()
+        item_refs = users.with_columns(pl.lit(item_ref_time).cast(time_dtype).alias('item_ref'))
+        item = item_features_at(events, item_ref_time, windows)
+
+    pairs = (
+        user_events.group_by(['user_id', 'item_id'])
+        .agg(pl.col('ref').first(), *window_aggs('ui', pl.col('ref'), user_upper, windows))
+        .collect(engine='streaming')
+    )
+
+    ui_cols = [col for col in pairs.columns if col.startswith('ui_') and col != 'ui_last_ts']
+    ui = (
+        pairs.filter(pl.col('ui_last_ts').is_not_null())
+        .select('user_id', 'item_id', *ui_cols, days_since(pl.col('ui_last_ts'), pl.col('ref')).alias('ui_days_since_last'))
+        .sort(['user_id', 'item_id'])
+    )
+    user = (
+        ui.group_by('user_id')
+        .agg(
+            *[pl.col(col).sum().alias(col.replace('ui_', 'user_', 1)) for col in ui_cols],
+            *[(pl.col(f'ui_actions_{suffix}') > 0).sum().alias(f'user_unique_items_{suffix}') for suffix in windows],
+            pl.col('ui_days_since_last').min().alias('user_days_since_last'),
+        )
+        .sort('user_id')
+    )
+    return {'ui': ui, 'user': user, 'item': item.sort(['item_id', 'item_ref']), 'item_refs': item_refs.sort('user_id')}
+
+@telemetry.instrumented()
+def build_features(tracker_files, order_files, output_dir='features', user_cutoff_time=None, ref_time=None,
+                   item_ref_time=None, user_ids=None, min_date=None, type_codes=None, windows=WINDOWS, overwrite=False):
+    """
+    Считает фичи и пишет output_dir/<version>/{ui,user,item,item_refs}.parquet + meta.json.
+    version - хэш параметров (в том числе user_cutoff_time) и mtime/размера входных файлов:
+    повторный вызов с теми же входами открывает готовую версию без пересчета.
+    type_codes - {'tracker': {...}, 'orders': {...}} для файлов EventStore
+    """
+    type_codes = type_codes or {}
+    params = {
+        'schema': FEATURE_SCHEMA_VERSION, 'user_cutoff_time': user_cutoff_time, 'ref_time': ref_time,
+        'item_ref_time': item_ref_time, 'user_ids': None if user_ids is None else pl.Series(user_ids).to_numpy(),
+        'min_date': min_date, 'type_codes': type_codes, 'windows': windows,
+    }
+    version = cache_key('features', params, list(tracker_files) + list(order_files))
+    path = os.path.join(output_dir, version)
+    if os.path.exists(os.path.join(path, 'meta.json')) and not overwrite:
+        return FeatureStore(path)
+
+    events = pl.concat([
+        event_frame(tracker_files, 'action_type', 'timestamp', type_codes.get('tracker'), min_date),
+        event_frame(order_files, 'last_status', 'created_timestamp', type_codes.get('orders'), min_date),
+    ], how='vertical_relaxed')
+    blocks = compute_features(events, user_cutoff_time, ref_time, item_ref_time, user_ids, windows)
+
+    # пишем во временную папку и переименовываем: читатели не видят недописанную версию
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, df in blocks.items():
+        df.write_parquet(os.path.join(tmp_path, f'{name}.parquet'))
+    meta = {
+        'version': version,
+        'windows': windows,
+        'blocks': {name: [col for col in df.columns if col not in BLOCK_KEYS[name]] for name, df in blocks.items()},
+        'rows': {name: df.height for name, df in blocks.items()},
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return FeatureStore(path)
+
+
+#################
+class FeatureStore:
+    """
+    Одна версия фичей на диске. join подклеивает к exploded кандидатам только нужные блоки:
+    ui (по user_id, item_id), user, item и ratio (отношения, считаются на лету из первых трех).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        self.ratios = ratio_features(self.meta['windows'])
+        self.blocks = dict(self.meta['blocks'], ratio=list(self.ratios))
+
+    def fingerprint(self):
+        return f'FeatureStore({self.version})'
+
+    @property
+    def feature_names(self):
+        return [col for columns in self.blocks.values() for col in columns]
+
+    def block_of(self, feature):
+        for name, columns in self.blocks.items():
+            if feature in columns:
+                return name
+        raise KeyError(f'unknown feature {feature!r}')
+
+    def scan(self, block, columns=None):
+        """LazyFrame блока: ключи + columns (по умолчанию все фичи блока)"""
+        columns = self.blocks[block] if columns is None else columns
+        return pl.scan_parquet(os.path.join(self.path, f'{block}.parquet')).select(*BLOCK_KEYS[block], *columns)
+
+    def join(self, candidates, features=None, blocks=None):
+        """
+        candidates - pl.DataFrame / LazyFrame (user_id, item_id, ...) в кодах того же пространства id.
+        features - список фичей (например FEATURE_COLS ранкера), по нему выбираются блоки;
+        иначе blocks - имена блоков (по умолчанию все). Фичи, которые уже есть в candidates (fusion_rank и т.п.),
+        не подклеиваются. Счетчики пар без событий = 0, давность - null.
+        item фичи берутся на срез пользователя из item_refs.
+        Возвращает тот же тип, что candidates
+        """
+        if features is None:
+            blocks = list(self.blocks) if blocks is None else list(blocks)
+            features = [col for block in blocks for col in self.blocks[block]]
+        lazy = isinstance(candidates, pl.LazyFrame)
+        result = candidates.lazy()
+        schema = result.collect_schema()
+        features = [feature for feature in features if feature not in schema]
+
+        # ratio читает свои числитель и знаменатель из остальных блоков
+        needed = {}
+        for feature in features:
+            sources = self.ratios[feature] if feature in self.ratios else (feature,)
+            for col in sources:
+                if col in schema:
+                    continue
+                needed.setdefault(self.block_of(col), []).append(col)
+
+        if 'item' in needed:
+            refs = self.scan('item_refs', []).with_columns(pl.col('user_id').cast(schema['user_id']))
+            result = result.join(refs, on='user_id', how='left', maintain_order='left')
+            schema = result.collect_schema()
+
+        for block, columns in needed.items():
+            keys = BLOCK_KEYS[block]
+            table = self.scan(block, list(dict.fromkeys(columns)))
+            if not lazy and 'user_id' in keys and candidates.height:
+                # таблицы отсортированы по user_id: для чанка кандидатов читаются только его row groups
+                table = table.filter(pl.col('user_id').is_between(candidates['user_id'].min(), candidates['user_id'].max()))
+            table = table.with_columns(pl.col(key).cast(schema[key]) for key in keys)
+            result = result.join(table, on=keys, how='left', maintain_order='left')
+            counters = [col for col in dict.fromkeys(columns) if not col.endswith('_days_since_last')]
+            result = result.with_columns(pl.col(counters).fill_null(0))
+
+        result = result.with_columns(
+            (pl.col(numerator) / (pl.col(denominator) + 1)).cast(pl.Float32).alias(feature)
+            for feature, (numerator, denominator) in self.ratios.items() if feature in features
+        )
+        extra = [col for cols in needed.values() for col in cols if col not in features]
+        if 'item' in needed:
+            extra.append('item_ref')
+        result = result.drop(list(dict.fromkeys(extra)))
+        return result if lazy else result.collect(engine='streaming')
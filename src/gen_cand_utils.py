@@ -1,286 +1,276 @@
+import os
+
+import numpy as np
 import polars as pl
-import pandas as pd
-from tqdm import tqdm
-from collections import defaultdict
-import glob
 
-tracker_files = glob.glob('data/final_apparel_tracker_data_08_action_widget/*/*.parquet')
-order_files = glob.glob('data/final_apparel_orders_data_07/*/*.parquet')
-test_user_ids = pd.read_parquet('data/ml_ozon_recsys_test.snappy.parquet')
-test_user_ids_set = set(test_user_ids['user_id'].to_list())
+from src.scan import ScanSpec, scan_events, parse_date
+from src.cooccurrence import CooccurNeighborIndex
+from src.ann import CatalogIVFIndex, IVFIndex
+from src.cache import cached, cache_key, fingerprint, files_fingerprint, load_cached, save_cached
+from src.datasets import configure_datasets, datasets
+from src.event_store import ID_DICTIONARIES, EventStore
+from src.features import build_features
+from src.submission import SubmissionWriter, write_submission
+from src import telemetry
+from src.ranking import rank_candidates
+from src.split import UserCutoffs, leave_last_n_split
+
+event_store = None
+# Параллельное чтение файлов в scan_events; меняется через configure_scan, на результат не влияет
+SCAN_SETTINGS = {
+    'n_workers': 1,
+    'max_in_flight': None,
+    'use_processes': False,
+}
+
+def configure_scan(n_workers=None, max_in_flight=None, use_processes=None):
+    """
+    n_workers - сколько файлов обрабатывается одновременно,
+    max_in_flight - максимум файлов в работе (ограничение памяти, по умолчанию 2 * n_workers),
+    use_processes - пул процессов вместо потоков
+    """
+    if n_workers is not None:
+        SCAN_SETTINGS['n_workers'] = n_workers
+    if max_in_flight is not None:
+        SCAN_SETTINGS['max_in_flight'] = max_in_flight
+    if use_processes is not None:
+        SCAN_SETTINGS['use_processes'] = use_processes
+
+def __getattr__(name):
+    """
+    Старые имена модуля (tracker_files, order_files, test_user_ids, test_user_ids_set) - из реестра datasets(),
+    при первом обращении, а не при импорте
+    """
+    registry = datasets()
+    if name == 'tracker_files':
+        return registry.tracker_files
+    if name == 'order_files':
+        return registry.order_files
+    if name == 'test_user_ids':
+        return registry.test_user_ids.to_frame().to_pandas()
+    if name == 'test_user_ids_set':
+        return set(registry.test_user_ids.to_list())
+    if name == 'TEST_USERS_PATH':
+        return registry.test_users_path
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def use_event_store(store_root='event_store'):
+    """Генераторы читают партиции EventStore вместо сырых parquet; None - вернуться к сырым файлам"""
+    global event_store
+    event_store = EventStore(store_root) if store_root is not None else None
+
+def source_files(source, min_date=None):
+    """
+    Файлы источника ('tracker' / 'orders') и коды action_type / last_status.
+    Из EventStore берутся только партиции после min_date
+    """
+    if event_store is None:
+        return datasets().files(source), None
+    return event_store.files(source, min_date=min_date), event_store.type_codes(source)
 
-#################
-def get_last_favorite_items(mode, n=50, user_cutoff_time=None, min_date='2025-05-21'):
+def source_stats(source):
     """
-    mode == 'train' - для отладки, берем данные до cutoff_time
-    mode == 'submit' - для сабмита, берем все данные и в соответствии с test_user_ids_list
-    n - количество последних добавленных в favorite items
+    Статистики EventStore для досрочной остановки scan_events: диапазоны времени партиций
+    и события пользователей по дням. Для сырых файлов - None (диапазоны берутся из футеров parquet)
     """
-    user_last_purchases = defaultdict(list)
-    year, month, day = map(int, min_date.split('-'))
-    min_date = pl.datetime(year, month, day)
-    for i in tqdm(range(len(tracker_files)-1, -1, -1), desc='Gen last favorite items'):
-        file_path = tracker_files[i]
-        
-        if mode == 'train':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'action_type', 'timestamp']
-            ).join(user_cutoff_time, on='user_id'
-            ).filter(
-                pl.col('action_type').is_in(['to_cart', 'favorite']) & 
-                (pl.col('timestamp') > min_date) &
-                (pl.col('timestamp') < pl.col('cutoff_time')) # только из обучающей части
-            )
-        elif mode == 'submit':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'action_type', 'timestamp']
-            ).filter(
-                pl.col('action_type').is_in(['to_cart', 'favorite']) & 
-                pl.col('user_id').is_in(test_user_ids_set) &
-                (pl.col('timestamp') > min_date)
-            )
+    if event_store is None:
+        return {'time_ranges': None, 'activity': None}
+    return {'time_ranges': event_store.time_ranges(source), 'activity': event_store.activity(source)}
+
+def test_users():
+    """Тестовые пользователи в текущем пространстве id: коды EventStore или исходные user_id"""
+    user_ids = datasets().test_user_ids
+    if event_store is not None and event_store.users is not None:
+        return event_store.users.encode_series(user_ids).drop_nulls()
+    return user_ids
+
+def test_user_files():
+    """
+    Файлы, от которых зависит test_users(): parquet тестовых пользователей и словарь user_id EventStore -
+    входы кэша генераторов, которые в submit фильтруют / дополняют тестовыми пользователями
+    """
+    files = [datasets().test_users_path]
+    if event_store is not None and event_store.users is not None:
+        files.append(os.path.join(event_store.store_root, ID_DICTIONARIES['user_id']))
+    return [path for path in files if os.path.exists(path)]
 
-        grouped = (
-            df.group_by('user_id')
-            .agg(pl.col('timestamp'), pl.col('item_id'))
-        )
-        
-        for row in grouped.iter_rows(named=True):
-            user_id = row['user_id']
-            timestamps = row['timestamp']
-            items = row['item_id']
+def train_val_split(leave_last_n=3, status='delivered_orders'):
+    """
+    leave_last_n_split по заказам текущего источника: user_cutoff_time, val_n_orders и cutoffs за один проход.
+    С EventStore cutoffs - массив по кодам пользователей, генераторы train применяют его без join
+    """
+    files, type_codes = source_files('orders')
+    n_codes = len(event_store.users) if event_store is not None and event_store.users is not None else None
+    return leave_last_n_split(files, leave_last_n, status, type_codes, n_codes)
 
-            existing = user_last_purchases[user_id]
-            combined = existing + list(zip(timestamps, items))
+#################
+def add_missing_test_users(result_df):
+    """Добавляем тестовых пользователей без кандидатов с пустым списком item_id"""
+    test_user_ids_pl = test_users().to_frame()
+    missing_users = test_user_ids_pl.join(
+    result_df.select('user_id'),
+    on='user_id',
+    how='anti'
+    )
 
-            combined.sort(key=lambda x: x[0], reverse=True)
-            user_last_purchases[user_id] = combined[:n]
-        
-        if len(user_last_purchases) >= len(test_user_ids_set) and all(
-            len(views) >= n for views in user_last_purchases.values()
-        ):
-            break        
-
-    result_data = []
-    for user_id, purchases in user_last_purchases.items():
-
-        purchase_items = [item for _, item in purchases]
-        result_data.append({
-            'user_id': user_id,
-            'item_id': purchase_items
-        })
+    missing_users = missing_users.with_columns(
+        pl.col('user_id').cast(result_df.schema['user_id'])
+    )
+    missing_df = missing_users.with_columns(
+        pl.Series('item_id', [[]] * missing_users.height)
+    )
+    return pl.concat([result_df, missing_df])
 
-    result_df = pl.DataFrame(result_data)
-    test_user_ids_pl = pl.from_pandas(test_user_ids)
+#################
+@telemetry.instrumented()
+def scan_events_cached(source, specs, mode, user_cutoff_time=None, type_col='action_type', time_col='timestamp', desc='Scan events'):
+    """
+    scan_events с кэшем на каждый spec: ключ - spec, mode, хэш user_cutoff_time и mtime/размер входных файлов.
+    Файлы читаются только для генераторов, которых нет в кэше
+    """
+    files, type_codes = source_files(source, min(spec.min_date for spec in specs))
+    inputs = files_fingerprint(list(files) + ([datasets().test_users_path] if mode == 'submit' else []))
+    users = fingerprint(user_cutoff_time) if mode == 'train' else None
+    keys = {
+        spec.name: cache_key(spec.name, {
+            'spec': spec, 'mode': mode, 'user_cutoff_time': users,
+            'type_col': type_col, 'time_col': time_col, 'inputs': inputs
+        })
+        for spec in specs
+    }
 
-    if mode == 'train':
-        return result_df
-    
-    elif mode == 'submit':
-        missing_users = test_user_ids_pl.join(
-        result_df.select('user_id'),
-        on='user_id',
-        how='anti'
+    results = {spec.name: load_cached(keys[spec.name]) for spec in specs}
+    missing_specs = [spec for spec in specs if results[spec.name] is None]
+    telemetry.current_stage().record(rows_in=len(files), cache_hits=len(specs) - len(missing_specs))
+    if missing_specs:
+        scanned = scan_events(
+            files, missing_specs, mode,
+            user_ids=test_users(),
+            user_cutoff_time=user_cutoff_time,
+            type_col=type_col,
+            time_col=time_col,
+            type_codes=type_codes,
+            desc=desc + ': ' + ', '.join(spec.name for spec in missing_specs),
+            **source_stats(source),
+            **SCAN_SETTINGS
         )
+        for name, df in scanned.items():
+            save_cached(keys[name], df)
+            results[name] = df
+    return results
 
-        missing_users = missing_users.with_columns(
-            pl.col('user_id').cast(result_df.schema['user_id'])
-        )
-        missing_df = missing_users.with_columns(
-            pl.Series('item_id', [[]] * missing_users.height)
-        )
-        result_df_favotites = pl.concat([result_df, missing_df])
+def get_tracker_candidates(mode, specs, user_cutoff_time=None):
+    """
+    Общий проход по tracker_files для нескольких генераторов сразу
+    specs - список ScanSpec (name, actions, n, min_date)
+    Возвращает {spec.name: pl.DataFrame(user_id, item_id)}; в submit дополнено тестовыми пользователями
+    """
+    results = scan_events_cached(
+        'tracker', specs, mode, user_cutoff_time,
+        type_col='action_type',
+        time_col='timestamp',
+        desc='Gen tracker candidates'
+    )
+    if mode == 'submit':
+        results = {name: add_missing_test_users(df) for name, df in results.items()}
+    return results
 
-        return result_df_favotites
-    
-#################
-def get_last_viewed_def_items(mode, n=50, user_cutoff_time=None, min_date='2025-05-21'):
+def get_order_candidates(mode, specs, user_cutoff_time=None):
     """
-    mode == 'train' - для отладки, берем данные до cutoff_time
-    mode == 'submit' - для сабмита, берем все данные и в соответствии с test_user_ids_list
-    n - количество последних добавленных в favorite items
+    Общий проход по order_files для нескольких генераторов сразу
+    specs - список ScanSpec, actions - значения last_status
     """
-    user_last_purchases = defaultdict(list)
-    year, month, day = map(int, min_date.split('-'))
-    min_date = pl.datetime(year, month, day)
-    for i in tqdm(range(len(tracker_files)-1, -1, -1), desc='Gen last favorite items'):
-        file_path = tracker_files[i]
-        
-        if mode == 'train':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'action_type', 'timestamp']
-            ).join(user_cutoff_time, on='user_id'
-            ).filter(
-                pl.col('action_type').is_in(['review_view', 'view_description']) & 
-                (pl.col('timestamp') > min_date) &
-                (pl.col('timestamp') < pl.col('cutoff_time')) # только из обучающей части
-            )
-        elif mode == 'submit':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'action_type', 'timestamp']
-            ).filter(
-                pl.col('action_type').is_in(['to_cart', 'favorite']) & 
-                pl.col('user_id').is_in(test_user_ids_set) &
-                (pl.col('timestamp') > min_date)
-            )
+    results = scan_events_cached(
+        'orders', specs, mode, user_cutoff_time,
+        type_col='last_status',
+        time_col='created_timestamp',
+        desc='Gen order candidates'
+    )
+    if mode == 'submit':
+        results = {name: add_missing_test_users(df) for name, df in results.items()}
+    return results
 
-        grouped = (
-            df.group_by('user_id')
-            .agg(pl.col('timestamp'), pl.col('item_id'))
-        )
-        
-        for row in grouped.iter_rows(named=True):
-            user_id = row['user_id']
-            timestamps = row['timestamp']
-            items = row['item_id']
+def last_favorite_spec(n=50, min_date='2025-05-21'):
+    return ScanSpec('last_favorite_items', ['to_cart', 'favorite'], n, min_date)
 
-            existing = user_last_purchases[user_id]
-            combined = existing + list(zip(timestamps, items))
+def last_viewed_def_spec(n=50, min_date='2025-05-21'):
+    return ScanSpec('last_viewed_def_items', ['review_view', 'view_description'], n, min_date)
 
-            combined.sort(key=lambda x: x[0], reverse=True)
-            user_last_purchases[user_id] = combined[:n]
-        
-        if len(user_last_purchases) >= len(test_user_ids_set) and all(
-            len(views) >= n for views in user_last_purchases.values()
-        ):
-            break        
-
-    result_data = []
-    for user_id, purchases in user_last_purchases.items():
-
-        purchase_items = [item for _, item in purchases]
-        result_data.append({
-            'user_id': user_id,
-            'item_id': purchase_items
-        })
+def last_viewed_spec(n=3, min_date='2025-05-21'):
+    return ScanSpec('last_viewed_items', ['review_view', 'view_description'], n, min_date)
 
-    result_df = pl.DataFrame(result_data)
-    test_user_ids_pl = pl.from_pandas(test_user_ids)
+def last_delivered_spec(n_last=1, min_date='2025-05-21'):
+    return ScanSpec('last_delivered_items', ['delivered_orders'], n_last, min_date)
 
-    if mode == 'train':
-        return result_df
-    
-    elif mode == 'submit':
-        missing_users = test_user_ids_pl.join(
-        result_df.select('user_id'),
-        on='user_id',
-        how='anti'
-        )
+def processed_spec(n_last=30, min_date='2025-05-21'):
+    return ScanSpec('processed_items', ['proccesed_orders'], n_last, min_date)
 
-        missing_users = missing_users.with_columns(
-            pl.col('user_id').cast(result_df.schema['user_id'])
-        )
-        missing_df = missing_users.with_columns(
-            pl.Series('item_id', [[]] * missing_users.height)
-        )
-        result_df_favotites = pl.concat([result_df, missing_df])
+def to_wide_items(result_df, n):
+    """user_id, item_id: list -> user_id, item_1 ... item_n (пропуски = 0)"""
+    return result_df.select(
+        'user_id',
+        *[pl.col('item_id').list.get(i, null_on_oob=True).alias(f'item_{i+1}') for i in range(n)]
+    ).fill_null(0)
 
-        return result_df_favotites
+#################
+@telemetry.instrumented()
+def get_last_favorite_items(mode, n=50, user_cutoff_time=None, min_date='2025-05-21'):
+    """
+    mode == 'train' - для отладки, берем данные до cutoff_time
+    mode == 'submit' - для сабмита, берем все данные и в соответствии с test_user_ids_list
+    n - количество последних добавленных в favorite items
+    """
+    spec = last_favorite_spec(n, min_date)
+    return get_tracker_candidates(mode, [spec], user_cutoff_time)[spec.name]
+    
+#################
+@telemetry.instrumented()
+def get_last_viewed_def_items(mode, n=50, user_cutoff_time=None, min_date='2025-05-21'):
+    """
+    mode == 'train' - для отладки, берем данные до cutoff_time
+    mode == 'submit' - для сабмита, берем все данные и в соответствии с test_user_ids_list
+    n - количество последних просмотров описания / отзывов
+    """
+    spec = last_viewed_def_spec(n, min_date)
+    return get_tracker_candidates(mode, [spec], user_cutoff_time)[spec.name]
 ###############
+@telemetry.instrumented()
 def get_last_viewed_items(mode, n=3, user_cutoff_time=None, min_date='2025-05-21'):
     """
     mode == 'train' - для отладки, берем данные до cutoff_time
     mode == 'submit' - для сабмита, берем все данные и в соответствии с test_user_ids_list
     n - количество последни просматриваемых items
+    Возвращает широкий формат user_id, item_1 ... item_n
     """
-    user_last_views = defaultdict(list)
-    year, month, day = map(int, min_date.split('-')) 
-    min_date = pl.datetime(year, month, day)
-    valid_actions = ['review_view', 'view_description']
-
-    for i in tqdm(range(len(tracker_files)-1, -1, -1), desc='Gen last viewed items'):
-        file_path = tracker_files[i]
-        
-        if mode == 'train':
-
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'action_type', 'timestamp']
-            ).join(user_cutoff_time, on='user_id'
-            ).filter(
-                pl.col('action_type').is_in(valid_actions) & 
-                (pl.col('timestamp') < pl.col('cutoff_time')) &
-                (pl.col('timestamp') > min_date)
-            )
-        elif mode == 'submit':
-
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'action_type', 'timestamp']
-            ).filter(
-                pl.col('action_type').is_in(valid_actions) & 
-                pl.col('user_id').is_in(test_user_ids_set) &
-                (pl.col('timestamp') > min_date)
-            )
-        grouped = (
-            df.sort('timestamp', descending=True)
-            .group_by('user_id')
-            .agg([
-                pl.col('timestamp').head(n).alias('timestamps'),
-                pl.col('item_id').head(n).alias('items')
-            ])
-        )
-
-        for row in grouped.iter_rows(named=True):
-            user_id = row['user_id']
-            timestamps = row['timestamps']
-            items = row['items']
-            
-            # Объединяем с существующими данными
-            new_views = list(zip(timestamps, items))
-            combined = user_last_views[user_id] + new_views
-            
-            # Сортируем и берем n самых новых
-            combined.sort(key=lambda x: x[0], reverse=True)
-            user_last_views[user_id] = combined[:n]
-
-
-        # latest_per_user = df.sort('timestamp').group_by('user_id').tail(n)
-
-        # for row in latest_per_user.iter_rows(named=True):
-        #     user_id = row['user_id']
-        #     user_last_views[user_id].append((row['timestamp'], row['item_id']))
-        
-        # for user_id in list(user_last_views.keys()):
-        #     user_last_views[user_id].sort(key=lambda x: x[0])
-        #     user_last_views[user_id] = user_last_views[user_id][-n:]
-        
-    
-        if len(user_last_views) >= len(test_user_ids_set) and all(
-            len(views) >= n for views in user_last_views.values()
-        ):
-            break
-
-    user_last_views = {
-        user_id: [item for _, item in items] 
-        for user_id, items in user_last_views.items()
-    }
-
-    data = []
-    for user_id, items in user_last_views.items():
-        row = {"user_id": user_id}
-        for i in range(n):
-            row[f"item_{i+1}"] = items[i] if i < len(items) else None
-        data.append(row)
-
-    result_df = pl.DataFrame(data).fill_null(0)
-
-    return result_df
+    spec = last_viewed_spec(n, min_date)
+    results = scan_events_cached(
+        'tracker', [spec], mode, user_cutoff_time,
+        desc='Gen last viewed items'
+    )
+    return to_wide_items(results[spec.name], n)
 
 #################
-def get_neighbors_of_viewed_items(last_viewed_items, nn_df, k_values, mode='submit'):
-    
+@telemetry.instrumented()
+@cached(input_files=test_user_files)
+def get_neighbors_of_viewed_items(last_viewed_items, nn_df, k_values, mode='submit', n_probe=8):
+    """
+    nn_df - таблица nearest_neighbors (item_id, neighbor_item_id, rank)
+    или индекс src.ann (CatalogIVFIndex / IVFIndex): тогда соседи ищутся только для просмотренных items,
+    n_probe - сколько кластеров индекса просматривается на запрос
+    """
     max_k = max(k_values.values())
 
-    all_neighbors_df = (
-        nn_df.filter(pl.col('rank') <= max_k)
-        .group_by('item_id')
-        .agg(pl.col('neighbor_item_id').alias('all_neighbors'))
-    )
+    if isinstance(nn_df, (CatalogIVFIndex, IVFIndex)):
+        viewed_items = pl.concat([last_viewed_items[column] for column in k_values]).drop_nulls().unique()
+        all_neighbors_df = nn_df.neighbors_frame(
+            viewed_items.to_numpy(), max_k, n_probe
+        ).rename({'neighbors': 'all_neighbors'})
+    else:
+        all_neighbors_df = (
+            nn_df.filter(pl.col('rank') <= max_k)
+            .group_by('item_id')
+            .agg(pl.col('neighbor_item_id').alias('all_neighbors'))
+        )
 
     user_last_views = last_viewed_items
     
@@ -311,9 +301,9 @@ def get_neighbors_of_viewed_items(last_viewed_items, nn_df, k_values, mode='subm
     
     elif mode == 'submit':
         
-        test_user_ids_pl = pl.from_pandas(test_user_ids)
+        test_user_ids_pl = test_users().to_frame()
         user_last_views = user_last_views.filter(
-            pl.col('user_id').is_in(test_user_ids_set)
+            pl.col('user_id').is_in(test_user_ids_pl['user_id'].cast(user_last_views.schema['user_id']))
         )
         missing_users = test_user_ids_pl.join(
         user_last_views.select('user_id'),
@@ -332,126 +322,76 @@ def get_neighbors_of_viewed_items(last_viewed_items, nn_df, k_values, mode='subm
         return user_last_views
 
 #################
-def get_cooccur_neighbors_of_last_delivered_items(cooccurrence_neighbors_of_all_items, mode, n_last=1, user_cutoff_time=None, min_date='2025-05-21'):
-    user_last_purchases = defaultdict(list)
-
-    year, month, day = map(int, min_date.split('-')) 
-    min_date = pl.datetime(year, month, day)
-    for i in tqdm(range(len(order_files)-1, -1, -1), desc='Gen cooccur neighbors of delivered items'):
-        file_path = order_files[i]
-
-        if mode == 'train':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'last_status', 'created_timestamp']
-            ).join(user_cutoff_time, on='user_id'
-            ).filter(
-                pl.col('last_status').is_in(['delivered_orders']) & 
-                (pl.col('created_timestamp') < pl.col('cutoff_time')) &
-                (pl.col('created_timestamp') > min_date)
-            )
-
-        elif mode == 'submit':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'last_status', 'created_timestamp']
-            ).filter(
-                pl.col('last_status').is_in(['delivered_orders']) & 
-                pl.col('user_id').is_in(test_user_ids_set) &
-                (pl.col('created_timestamp') > min_date)
-            )
-        grouped = (
-            df.sort('created_timestamp', descending=True)
-            .group_by('user_id')
-            .agg([
-                pl.col('created_timestamp').head(n_last).alias('timestamps'),
-                pl.col('item_id').head(n_last).alias('items')
-            ])
-        )
+@telemetry.instrumented()
+def get_cooccur_neighbors_of_last_delivered_items(cooccurrence_neighbors_of_all_items, mode, n_last=1, user_cutoff_time=None, min_date='2025-05-21', k=3):
+    """
+    Соседи по co-occurrence для n_last последних доставленных items пользователя
+    cooccurrence_neighbors_of_all_items - pl.DataFrame(item_id, neighbors) или CooccurNeighborIndex
+    k - сколько первых соседей берем от каждого item
+    """
+    spec = last_delivered_spec(n_last, min_date)
+    last_delivered = scan_events_cached(
+        'orders', [spec], mode, user_cutoff_time,
+        type_col='last_status',
+        time_col='created_timestamp',
+        desc='Gen cooccur neighbors of delivered items'
+    )[spec.name]
+    return cooccur_neighbors_of_items(cooccurrence_neighbors_of_all_items, last_delivered, mode, k)
+
+def cooccur_neighbors_of_items(cooccurrence_neighbors_of_all_items, last_items, mode, k=3):
+    """
+    last_items - user_id, item_id: list (например, результат last_delivered_spec)
+    Один join по всем (user, item) вместо поиска по таблице соседей для каждого item.
+    Пользователи, у items которых нет соседей, остаются с пустым списком
+    """
+    user_items = last_items.select('user_id', 'item_id').explode('item_id').drop_nulls('item_id')
 
-        for row in grouped.iter_rows(named=True):
-            user_id = row['user_id']
-            timestamps = row['timestamps']
-            items = row['items']
-            
-            # Объединяем с существующими данными
-            new_purchases = list(zip(timestamps, items))
-            combined = user_last_purchases[user_id] + new_purchases
-            
-            # Сортируем и берем n_last самых новых
-            combined.sort(key=lambda x: x[0], reverse=True)
-            user_last_purchases[user_id] = combined[:n_last]
-
-        # for row in df.iter_rows(named=True):
-        #     user_id = row['user_id']
-        #     user_last_purchases[user_id].append((row['created_timestamp'], row['item_id']))
-        
-        # for user_id in user_last_purchases:
-        #     user_last_purchases[user_id].sort(key=lambda x: x[0], reverse=True)
-        #     user_last_purchases[user_id] = user_last_purchases[user_id][:n_last]
-        
-        # Проверяем, есть ли у всех пользователей достаточно покупок
-        if len(user_last_purchases) >= len(test_user_ids_set) and all(
-            len(views) >= n_last for views in user_last_purchases.values()
-        ):
-            break
-    result_data = []
-    for user_id, purchases in user_last_purchases.items():
-
-        purchase_items = [item for _, item in purchases]
-
-        all_neighbors = set()
-        for item in purchase_items:
-
-            neighbors = cooccurrence_neighbors_of_all_items.filter(
-                pl.col('item_id') == item
-            )['neighbors'].to_list()
-            
-            if neighbors:
-                all_neighbors.update(neighbors[0][:3])
-
-        result_data.append({
-            'user_id': user_id,
-            'item_id': list(all_neighbors)
+    if isinstance(cooccurrence_neighbors_of_all_items, CooccurNeighborIndex):
+        rows, neighbors = cooccurrence_neighbors_of_all_items.lookup(user_items['item_id'].to_numpy(), k)
+        user_neighbors = pl.DataFrame({
+            'user_id': user_items['user_id'].gather(rows),
+            'neighbors': neighbors,
         })
+    else:
+        user_neighbors = user_items.join(
+            cooccurrence_neighbors_of_all_items.select(
+                'item_id', pl.col('neighbors').list.head(k)
+            ),
+            on='item_id',
+            how='inner'
+        ).select('user_id', 'neighbors').explode('neighbors')
+
+    result_df = last_items.select('user_id').join(
+        user_neighbors.group_by('user_id', maintain_order=True).agg(
+            pl.col('neighbors').drop_nulls().unique(maintain_order=True).alias('item_id')
+        ),
+        on='user_id',
+        how='left'
+    ).with_columns(pl.col('item_id').fill_null([]))
 
-    result_df = pl.DataFrame(result_data)
     if mode == 'train':
         return result_df
     
     elif mode == 'submit':
-
-        test_user_ids_pl = pl.from_pandas(test_user_ids)
-        missing_users = test_user_ids_pl.join(
-        result_df.select('user_id'),
-        on='user_id',
-        how='anti'
-        )
-
-        missing_users = missing_users.with_columns(
-            pl.col('user_id').cast(result_df.schema['user_id'])
-        )
-        missing_df = missing_users.with_columns(
-            pl.Series('item_id', [[]] * missing_users.height)
-        )
-        result_df = pl.concat([result_df, missing_df])
-
-        return result_df
+        return add_missing_test_users(result_df)
     
 #################
+@telemetry.instrumented()
+@cached(input_files=lambda: source_files('orders')[0])
 def get_popular_items(n=500, min_date='2025-05-21'):
 
-    year, month, day = map(int, min_date.split('-')) 
-    min_date = pl.datetime(year, month, day)
+    files, type_codes = source_files('orders', min_date)
+    delivered = 'delivered_orders' if type_codes is None else type_codes['delivered_orders']
+    min_date = parse_date(min_date)
 
     orders_df = (
-        pl.scan_parquet(order_files, extra_columns='ignore')
+        pl.scan_parquet(files, extra_columns='ignore')
         .filter(pl.col('created_timestamp') > min_date)
         .select(['item_id', 'last_status'])
-        .collect()
+        .collect(engine='streaming')
         )
     popular_items = (
-        orders_df.filter(pl.col('last_status') == 'delivered_orders')
+        orders_df.filter(pl.col('last_status') == delivered)
         .get_column('item_id')
         .value_counts(sort=True)
         .head(n)
@@ -461,214 +401,211 @@ def get_popular_items(n=500, min_date='2025-05-21'):
     return popular_items
 
 #################
+@telemetry.instrumented()
 def get_processed_items(mode, n_last=30, user_cutoff_time=None, min_date='2025-05-21'):
-    user_last_purchases = defaultdict(list)
+    spec = processed_spec(n_last, min_date)
+    return get_order_candidates(mode, [spec], user_cutoff_time)[spec.name]
     
-    year, month, day = map(int, min_date.split('-')) 
-    min_date = pl.datetime(year, month, day)
-
-    for i in tqdm(range(len(order_files)-1, -1, -1), desc='Gen processed items'):
-        file_path = order_files[i]
-
-        if mode == 'train':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'last_status', 'created_timestamp']
-            ).join(user_cutoff_time, on='user_id'
-            ).filter(
-                pl.col('last_status').is_in(['proccesed_orders']) & 
-                (pl.col('created_timestamp') < pl.col('cutoff_time')) &
-                (pl.col('created_timestamp') > min_date)
-            )
-        elif mode == 'submit':
-            df = pl.read_parquet(
-                file_path, 
-                columns=['user_id', 'item_id', 'last_status', 'created_timestamp']
-            ).filter(
-                pl.col('last_status').is_in(['proccesed_orders']) & 
-                pl.col('user_id').is_in(test_user_ids_set) &
-                (pl.col('created_timestamp') > min_date)
-            )
-        
-        grouped = (
-            df.sort('created_timestamp', descending=True)
-            .group_by('user_id')
-            .agg([
-                pl.col('created_timestamp').head(n_last).alias('timestamps'),
-                pl.col('item_id').head(n_last).alias('items')
-            ])
+#################
+def to_long_candidates(df, source):
+    """
+    Кандидаты генератора -> long формат (user_id, item_id, source, source_rank).
+    df - user_id + list-колонка item_id или wide-колонки item_1..item_n; source_rank с 1 в порядке колонок/списка
+    """
+    item_columns = [col for col in df.columns if col != 'user_id' and 'item' in col.lower()]
+    return (
+        df.lazy()
+        .select(
+            'user_id',
+            pl.concat_list([pl.col(col).fill_null([]) if isinstance(df.schema[col], pl.List) else pl.col(col) for col in item_columns]).alias('item_id'),
         )
+        .with_columns(source_rank=pl.int_ranges(1, pl.col('item_id').list.len() + 1, dtype=pl.Int32))
+        .explode(['item_id', 'source_rank'])
+        .drop_nulls('item_id')
+        .with_columns(pl.lit(source).alias('source'))
+    )
 
-        for row in grouped.iter_rows(named=True):
-            user_id = row['user_id']
-            timestamps = row['timestamps']
-            items = row['items']
-            
-            # Объединяем с существующими данными
-            new_purchases = list(zip(timestamps, items))
-            combined = user_last_purchases[user_id] + new_purchases
-            
-            # Сортируем и берем n_last самых новых
-            combined.sort(key=lambda x: x[0], reverse=True)
-            user_last_purchases[user_id] = combined[:n_last]
-
-        # for row in df.iter_rows(named=True):
-        #     user_id = row['user_id']
-        #     user_last_purchases[user_id].append((row['created_timestamp'], row['item_id']))
-        
-        # for user_id in user_last_purchases:
-        #     user_last_purchases[user_id].sort(key=lambda x: x[0], reverse=True)
-        #     user_last_purchases[user_id] = user_last_purchases[user_id][:n_last]
-
-        if len(user_last_purchases) >= len(test_user_ids_set) and all(
-            len(views) >= n_last for views in user_last_purchases.values()
-        ):
-            break
-
-    result_data = []
-    for user_id, purchases in user_last_purchases.items():
-        # Получаем item_id покупок (без timestamp)
-        purchase_items = [item for _, item in purchases]
-
-        result_data.append({
-            'user_id': user_id,
-            'item_id': purchase_items
-        })
-
-    result_df = pl.DataFrame(result_data)
+def rrf_scores(weights=None, k=60):
+    """Reciprocal rank fusion: сумма по источникам weight / (k + source_rank)"""
+    weights = weights or {}
+    def score(position, name):
+        return weights.get(name, 1.0) / (k + pl.col('source_rank')), 'sum'
+    return score
 
-    if mode == 'train':
-        return result_df
-    
-    elif mode == 'submit':
+def order_scores():
+    """Приоритет по порядку источников, внутри - по source_rank (как прежний concat + unique)"""
+    def score(position, name):
+        return -(position * 2**32 + pl.col('source_rank').cast(pl.Int64)), 'max'
+    return score
 
-        test_user_ids_pl = pl.from_pandas(test_user_ids)
-        missing_users = test_user_ids_pl.join(
-        result_df.select('user_id'),
-        on='user_id',
-        how='anti'
-        )
-
-        missing_users = missing_users.with_columns(
-            pl.col('user_id').cast(result_df.schema['user_id'])
-        )
-        missing_df = missing_users.with_columns(
-            pl.Series('item_id', [[]] * missing_users.height)
+def pad_with_popular(counts, chosen_popular, popular, n):
+    """
+    Добивка популярными без cross join: позиции списка популярных для каждого пользователя строятся в numpy,
+    уже выбранные пары (user_id, item_id) вычеркиваются (anti join по позиции).
+    counts - (user_id, n_fused, n_overlap), отсортирован по user_id
+    """
+    n_fused = counts['n_fused'].to_numpy().astype(np.int64)
+    lengths = np.minimum(n - n_fused + counts['n_overlap'].to_numpy().astype(np.int64), popular.height)
+    starts = np.cumsum(lengths) - lengths
+    user_pos = np.repeat(np.arange(counts.height), lengths)
+    rank_popular = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+
+    keep = np.ones(len(user_pos), dtype=bool)
+    overlap = chosen_popular.join(counts.select('user_id').with_row_index('pos'), on='user_id')
+    if overlap.height:
+        pos = overlap['pos'].to_numpy().astype(np.int64)
+        rank = overlap['rank_popular'].to_numpy().astype(np.int64) - 1
+        inside = rank < lengths[pos]
+        keep[starts[pos[inside]] + rank[inside]] = False
+    user_pos, rank_popular = user_pos[keep], rank_popular[keep]
+
+    kept = np.bincount(user_pos, minlength=counts.height)
+    fusion_rank = n_fused[user_pos] + np.arange(len(user_pos)) - np.repeat(np.cumsum(kept) - kept, kept) + 1
+    rows = fusion_rank <= n
+    return pl.DataFrame({
+        'user_id': counts['user_id'].gather(user_pos[rows]),
+        'item_id': popular['item_id'].gather(rank_popular[rows]),
+        'fusion_rank': fusion_rank[rows].astype(np.int32),
+        'rank_popular': (rank_popular[rows] + 1).astype(np.int32),
+    })
+
+@telemetry.instrumented()
+def fuse_candidates(sources, popular_items, n=300, scoring=None):
+    """
+    Слияние генераторов в long формате.
+    sources - {имя: df генератора} (порядок важен для order_scores), popular_items - список для добивки до n.
+    scoring - rrf_scores(weights) (по умолчанию) или order_scores(): вклад строки источника и агрегат,
+    счет считается одним group_by по (user_id, item_id), там же остаются rank_<источник> как признаки ранкера.
+    Добивка популярными - через anti join, без списков в каждой строке.
+    Возвращает pl.DataFrame(user_id, item_id, fusion_score, rank_<источник>..., fusion_rank, rank_popular), fusion_rank с 1,
+    у добивки fusion_score пустой
+    """
+    scoring = scoring or rrf_scores()
+    names = list(sources)
+    st = telemetry.current_stage()
+    st.record(rows_in=sum(df.height for df in sources.values()))
+    parts = []
+    for position, (name, df) in enumerate(sources.items()):
+        contribution, agg = scoring(position, name)
+        parts.append(
+            to_long_candidates(df, name)
+            .select('user_id', 'item_id', contribution.alias('fusion_score'), pl.col('source_rank').alias(f'rank_{name}'))
         )
-        result_df = pl.concat([result_df, missing_df])
-
-        return result_df
-    
-#################    
-def unite_candidates(dfs_to_merge, popular_items, n=300):
-
-    all_user_ids = pl.concat([
-        df.select('user_id') for df in dfs_to_merge
-    ]).unique().sort('user_id')
-
-    base_df = all_user_ids
-
-    for i, df in enumerate(dfs_to_merge):
-        if i == 0:
-            merged_df = base_df.join(
-                df, 
-                on='user_id', 
-                how='left'
-            )
-        else:
-            merged_df = merged_df.join(
-                df, 
-                on='user_id', 
-                how='left',
-                suffix=f"_{i}"
+    long = pl.concat(parts, how='diagonal_relaxed')
+    all_users = pl.concat([df.lazy().select('user_id') for df in sources.values()], how='vertical_relaxed').unique()
+
+    with st.timer('group_by'):
+        fused = (
+            long.group_by(['user_id', 'item_id'])
+            .agg(
+                getattr(pl.col('fusion_score'), agg)(),
+                *[pl.col(f'rank_{name}').min() for name in names],
             )
+            # при равном счете - меньший item_id, чтобы порядок не зависел от group_by
+            .sort(['user_id', 'fusion_score', 'item_id'], descending=[False, True, False])
+            .with_columns(fusion_rank=pl.int_range(1, pl.len() + 1, dtype=pl.Int32).over('user_id'))
+            .filter(pl.col('fusion_rank') <= n)
+            .collect(engine='streaming')
+        )
 
-    recommendation_columns = [
-        col for col in merged_df.columns 
-        if col != 'user_id' and ('item' in col.lower() or col.startswith('item'))
-    ]
-
-    merged_df = merged_df.with_columns(
-        *[pl.col(col).fill_null([]) for col in recommendation_columns]
-    ).with_columns(
-        combined=pl.concat_list(recommendation_columns)
-    )
-
-    merged_df = merged_df.with_columns(
-        unique_combined=pl.col('combined').list.unique(maintain_order=True)
+    # добивка: пользователю с недобором нужно n - n_fused популярных, которых нет среди выбранных;
+    # достаточно первых need + (сколько популярных уже выбрано) позиций списка
+    popular = pl.DataFrame({
+        'item_id': popular_items[:n],
+        'rank_popular': pl.int_range(1, len(popular_items[:n]) + 1, dtype=pl.Int32, eager=True),
+    }).with_columns(pl.col('item_id').cast(fused.schema['item_id']))
+    chosen_popular = fused.select('user_id', 'item_id').join(popular, on='item_id')
+    counts = (
+        all_users
+        .join(fused.lazy().group_by('user_id').agg(n_fused=pl.len()), on='user_id', how='left')
+        .join(chosen_popular.lazy().group_by('user_id').agg(n_overlap=pl.len()), on='user_id', how='left')
+        .with_columns(pl.col('n_fused', 'n_overlap').fill_null(0))
+        .filter(pl.col('n_fused') < n)
+        .sort('user_id')
+        .collect(engine='streaming')
     )
-    
-    final_df = merged_df.with_columns(
-        final_items=pl.col('unique_combined').list.concat(
-            pl.lit(popular_items)
-        ).list.eval(
-            pl.element().unique(maintain_order=True)
-        ).list.head(n)
-    ).select(['user_id', 'final_items'])
-
-    final_df = final_df.rename({'final_items': 'item_id'})
-    user_pd = final_df.to_pandas()
-
-    return user_pd
-
-def unite_candidates_exploded(dfs_to_merge, popular_items, n=300):
-
-    all_user_ids = pl.concat([
-        df.select('user_id') for df in dfs_to_merge
-    ]).unique().sort('user_id')
-
-    base_df = all_user_ids
-
-    for i, df in enumerate(dfs_to_merge):
-        if i == 0:
-            merged_df = base_df.join(
-                df, 
-                on='user_id', 
-                how='left'
-            )
-        else:
-            merged_df = merged_df.join(
-                df, 
-                on='user_id', 
-                how='left',
-                suffix=f"_{i}"
-            )
-
-    recommendation_columns = [
-        col for col in merged_df.columns 
-        if col != 'user_id' and ('item' in col.lower() or col.startswith('item'))
-    ]
+    with st.timer('padding'):
+        padding = pad_with_popular(counts, chosen_popular, popular, n)
+
+    fused = fused.join(popular, on='item_id', how='left', maintain_order='left')
+    padding = padding.select([
+        pl.col(col) if col in padding.columns else pl.lit(None, fused.schema[col]).alias(col) for col in fused.columns
+    ]).cast(fused.schema)
+    # у каждого пользователя сначала выбранные, потом добивка
+    return fused.merge_sorted(padding, key='user_id')
+
+@telemetry.instrumented()
+def unite_candidates(dfs_to_merge, popular_items, n=300, scoring=None):
+    """
+    Список кандидатов на пользователя: pd.DataFrame(user_id, item_id: list).
+    По умолчанию порядок как раньше - по порядку dfs_to_merge (order_scores)
+    """
+    sources = {f'source_{i}': df for i, df in enumerate(dfs_to_merge)}
+    fused = fuse_candidates(sources, popular_items, n, scoring or order_scores())
+    final_df = fused.group_by('user_id', maintain_order=True).agg('item_id')
+    return final_df.to_pandas()
+
+@telemetry.instrumented()
+def unite_candidates_exploded(dfs_to_merge, popular_items, n=300, scoring=None):
+    """Кандидаты в long формате для ранжирования: user_id, item_id и признаки слияния (fusion_score, rank_*)"""
+    sources = {f'source_{i}': df for i, df in enumerate(dfs_to_merge)}
+    fused = fuse_candidates(sources, popular_items, n, scoring or order_scores())
+    return fused.to_pandas()
 
-    merged_df = merged_df.with_columns(
-        *[pl.col(col).fill_null([]) for col in recommendation_columns]
-    ).with_columns(
-        combined=pl.concat_list(recommendation_columns)
+#################
+@telemetry.instrumented()
+def get_ranker_features(mode, user_cutoff_time=None, min_date=None, output_dir='features', **kwargs):
+    """
+    FeatureStore для ранкера по tracker и orders: train - окна от user_cutoff_time,
+    submit - по тестовым пользователям до конца данных. kwargs передаются в build_features
+    """
+    tracker, tracker_codes = source_files('tracker', min_date)
+    orders, order_codes = source_files('orders', min_date)
+    type_codes = {'tracker': tracker_codes, 'orders': order_codes} if event_store is not None else None
+    if isinstance(user_cutoff_time, UserCutoffs):
+        user_cutoff_time = user_cutoff_time.frame
+    return build_features(
+        tracker, orders, output_dir,
+        user_cutoff_time=user_cutoff_time if mode == 'train' else None,
+        user_ids=test_users() if mode == 'submit' else None,
+        min_date=min_date,
+        type_codes=type_codes,
+        **kwargs
     )
 
-    merged_df = merged_df.with_columns(
-        unique_combined=pl.col('combined').list.unique(maintain_order=True)
+#################
+@telemetry.instrumented()
+def gen_submit(res_pd, name='submission', validate=True):
+    """
+    res_pd - pd/pl.DataFrame(user_id, item_id: list из 100 items).
+    Пишется чанками через SubmissionWriter; validate - проверка 100 уникальных items и всех тестовых пользователей.
+    С EventStore коды user_id / item_id переводятся в исходные id здесь
+    """
+    return write_submission(
+        res_pd, f'submits/{name}.csv',
+        decode=event_store.decode_ids if event_store is not None else None,
+        expected_users=datasets().test_user_ids,
+        validate=validate
     )
-    
-    final_df = merged_df.with_columns(
-        final_items=pl.col('unique_combined').list.concat(
-            pl.lit(popular_items)
-        ).list.eval(
-            pl.element().unique(maintain_order=True)
-        ).list.head(n)
-    ).select(['user_id', 'final_items'])
-
 
-    exploded = final_df.explode('final_items')\
-                        .rename({'final_items': 'item_id'})
-    return exploded.to_pandas()
-
-#################
-def gen_submit(res_pd, name='submission'):
-    submission_data = []
-    for _, row in tqdm(res_pd.iterrows(), total=len(res_pd), desc="Формирование submission"):
-        submission_data.append({
-            'user_id': row['user_id'],
-            'item_id_1 item_id_2 ... item_id_100': ' '.join(map(str, row['item_id']))
-        })
-    submission_df = pd.DataFrame(submission_data)
-    submission_df.to_csv(f'submits/{name}.csv', index=False)
\ No newline at end of file
+@telemetry.instrumented()
+def gen_ranked_submit(candidates, model, feature_store=None, name='submission', feature_cols=None,
+                      chunk_rows=2_000_000, thread_count=-1, validate=True):
+    """
+    Ранжирование exploded кандидатов (путь к parquet, отсортированному по user_id) моделью и запись top-100
+    тестовых пользователей прямо в сабмит: в памяти один чанк кандидатов, а не весь скоринг
+    """
+    with SubmissionWriter(
+        f'submits/{name}.csv',
+        expected_users=datasets().test_user_ids,
+        decode=event_store.decode_ids if event_store is not None else None,
+        validate=validate
+    ) as writer:
+        rank_candidates(
+            candidates, model, feature_store, writer,
+            feature_cols=feature_cols,
+            users=test_users(),
+            chunk_rows=chunk_rows,
+            thread_count=thread_count
+        )
+    return writer.rows
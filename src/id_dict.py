@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+
+
+#################
+class IdDictionary:
+    """
+    Постоянный словарь id -> плотный int32 код.
+    ids - исходные id в порядке кодов (код i = ids[i]); новые id только дописываются в конец,
+    поэтому коды уже сохраненных артефактов не меняются.
+    order - argsort(ids): по нему работает searchsorted-кодирование без python-словаря
+    """
+    def __init__(self, ids, order=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.order = np.argsort(self.ids, kind='stable') if order is None else order
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(np.unique(np.asarray(values, dtype=np.int64)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, values):
+        """Дописываем новые id; возвращает число добавленных"""
+        values = np.unique(np.asarray(values, dtype=np.int64))
+        new = values[self.encode(values) < 0]
+        if len(new):
+            self.ids = np.concatenate([self.ids, new])
+            self.order = np.argsort(self.ids, kind='stable')
+        return len(new)
+
+    def encode(self, values):
+        """Массив id -> int32 коды; -1 для id, которых нет в словаре"""
+        values = np.asarray(values, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(len(values), -1, dtype=np.int32)
+        sorted_ids = self.ids[self.order]
+        pos = np.minimum(np.searchsorted(sorted_ids, values), len(sorted_ids) - 1)
+        return np.where(sorted_ids[pos] == values, self.order[pos], -1).astype(np.int32)
+
+    def decode(self, codes):
+        """Массив кодов -> исходные id"""
+        return self.ids[np.asarray(codes)]
+
+    def encode_series(self, series):
+        """pl.Series id (или list[id]) -> Int32 коды; неизвестные id -> null"""
+        return self._map_series(series, lambda values: self.encode(values), pl.Int32)
+
+    def decode_series(self, series):
+        """pl.Series кодов (или list[код]) -> Int64 id"""
+        return self._map_series(series, lambda codes: self.decode(codes), pl.Int64)
+
+    def _map_series(self, series, fn, dtype):
+        if series.dtype == pl.List:
+            lengths = series.list.len().fill_null(0).to_numpy()
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            flat = self._map_series(series.explode(empty_as_null=False, keep_nulls=False), fn, dtype)
+            return pl.from_arrow(
+                pa.LargeListArray.from_arrays(pa.array(offsets), flat.to_arrow())
+            ).cast(pl.List(dtype)).alias(series.name)
+
+        valid = series.is_not_null().to_numpy()
+        mapped = fn(series.fill_null(0).to_numpy()) if len(series) else np.zeros(0, dtype=np.int64)
+        if dtype == pl.Int32:
+            valid = valid & (mapped >= 0)
+        return pl.from_arrow(pa.array(mapped, mask=~valid)).cast(dtype).alias(series.name)
+
+    def encode_columns(self, df, columns):
+        """Кодируем колонки df (в том числе list-колонки)"""
+        return df.with_columns(self.encode_series(df[column]) for column in columns)
+
+    def decode_columns(self, df, columns):
+        return df.with_columns(self.decode_series(df[column]) for column in columns)
+
+    def save(self, path):
+        """
+        path - файл .npy; порядок сортировки хранится рядом.
+        Запись через временный файл и rename: уже открытые memory map читают старую версию
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        for target, array in ((path, self.ids), (path.replace('.npy', '_order.npy'), self.order)):
+            np.save(target + '.tmp.npy', array)
+            os.replace(target + '.tmp.npy', target)
+
+    @classmethod
+    def load(cls, path):
+        """Массивы открываются через memory map"""
+        return cls(np.load(path, mmap_mode='r'), np.load(path.replace('.npy', '_order.npy'), mmap_mode='r'))
@@ -0,0 +1,302 @@
+"""
+Векторизация каталога товаров с ограниченной памятью.
+
+1. partition_catalog - один потоковый проход по сырым parquet, раскладка по catalogid=<id>/
+2. vectorize_catalog - каждый catalogid читается батчами по BATCH_SIZE строк:
+   тексты -> HashingVectorizer (без словаря) -> randomized TruncatedSVD, обученный на выборке,
+   категории -> FeatureHasher, fclip_embed -> IncrementalPCA;
+   веса блоков как в Content-Based preprocessing.ipynb, затем стандартизация внутри catalogid.
+3. build_item_vectors - catalogid обрабатываются в пуле процессов, каждый пишет свой диапазон строк
+   общего vectors.npy (memory map) + item_ids.npy / catalog_ids.npy и индекс item_id -> строка.
+
+python -m src.item_vectors --items-glob 'data/ml_ozon_recsys_train_final_apparel_items_data/*.parquet' --output-dir item_vectors
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import polars as pl
+import pyarrow.dataset as ds
+from numpy.lib.format import open_memmap
+from scipy.sparse import vstack
+from sklearn.decomposition import IncrementalPCA, TruncatedSVD
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import HashingVectorizer
+from tqdm import tqdm
+
+BATCH_SIZE = 5000
+TEXT_DIM_REDUCTION = 50
+EMBED_DIM_REDUCTION = 50
+TEXT_HASH_FEATURES = 2**20
+CAT_HASH_FEATURES = 64
+SVD_SAMPLE_SIZE = 20_000
+CAT_COLUMNS = ['Type', 'Brand', 'ColorBase', 'Material']
+ATTRIBUTES = {'Annotation': 'annotation', 'Type': 'Type', 'Brand': 'Brand', 'ColorBase': 'ColorBase', 'Material': 'Material'}
+INPUT_COLUMNS = ['item_id', 'itemname', 'fclip_embed', 'catalogid', 'attributes']
+N_FEATURES = CAT_HASH_FEATURES + 2 * TEXT_DIM_REDUCTION + EMBED_DIM_REDUCTION
+
+
+#################
+def partition_catalog(items_files, partition_dir='catalog_tmp'):
+    """Сырые parquet -> partition_dir/catalogid=<id>/*.parquet; потоковая запись через pyarrow.dataset"""
+    dataset = ds.dataset(items_files, format='parquet')
+    ds.write_dataset(
+        dataset.scanner(columns=INPUT_COLUMNS, batch_size=BATCH_SIZE),
+        partition_dir,
+        format='parquet',
+        partitioning=['catalogid'],
+        partitioning_flavor='hive',
+        existing_data_behavior='overwrite_or_ignore',
+        preserve_order=True,  # одинаковый порядок строк в партициях между запусками
+    )
+
+def catalog_sizes(partition_dir='catalog_tmp'):
+    """{catalogid: число items} по партициям"""
+    counts = (
+        pl.scan_parquet(f'{partition_dir}/**/*.parquet', hive_partitioning=True)
+        .group_by('catalogid')
+        .len()
+        .sort('catalogid')
+        .collect(engine='streaming')
+    )
+    return dict(zip(counts['catalogid'].to_list(), counts['len'].to_list()))
+
+def iter_catalog_batches(partition_dir, catalog_id, batch_size=BATCH_SIZE):
+    """Батчи одного catalogid как pl.DataFrame с развернутыми атрибутами"""
+    dataset = ds.dataset(f'{partition_dir}/catalogid={catalog_id}', format='parquet')
+    for batch in dataset.to_batches(columns=['item_id', 'itemname', 'fclip_embed', 'attributes'], batch_size=batch_size):
+        if batch.num_rows:
+            yield extract_attributes(pl.from_arrow(batch))
+
+
+#################
+def extract_attributes(df):
+    """Колонки annotation / Type / Brand / ColorBase / Material из списка attributes без python-цикла"""
+    return df.with_columns(
+        pl.col('attributes').list.eval(
+            pl.element().filter(pl.element().struct.field('attribute_name') == name)
+            .struct.field('attribute_value').cast(pl.String).first()
+        ).list.first().alias(column)
+        for name, column in ATTRIBUTES.items()
+    ).drop('attributes')
+
+def embeddings(df):
+    """fclip_embed -> (n, dim) float32; пустые эмбеддинги - нули"""
+    dim = df['fclip_embed'].drop_nulls().list.len().max() or 1
+    return (
+        df['fclip_embed']
+        .fill_null(pl.lit([0.0] * dim))
+        .cast(pl.List(pl.Float32))
+        .list.to_array(dim)
+        .to_numpy()
+    )
+
+class CatalogVectorizer:
+    """Преобразователи одного catalogid: обучаются потоково, словарь не нужен"""
+    def __init__(self, n_rows, seed=0):
+        self.seed = seed
+        self.text_hasher = HashingVectorizer(n_features=TEXT_HASH_FEATURES, alternate_sign=False, norm='l2')
+        self.cat_hasher = FeatureHasher(n_features=CAT_HASH_FEATURES, input_type='string', alternate_sign=False)
+        self.n_rows = n_rows
+        self.pca = None
+        self.pca_fitted = False
+        self.svd = {}
+        self.sample_rate = min(1.0, SVD_SAMPLE_SIZE / max(n_rows, 1))
+
+    def text_features(self, df, column):
+        return self.text_hasher.transform(df[column].fill_null('').to_list())
+
+    def partial_fit(self, df, rng):
+        """Первый проход: IncrementalPCA по эмбеддингам, выборка хэшированных текстов для SVD"""
+        embed = embeddings(df)
+        if self.pca is None:
+            self.pca = IncrementalPCA(n_components=max(1, min(EMBED_DIM_REDUCTION, self.n_rows, embed.shape[1])))
+        if len(embed) >= self.pca.n_components:
+            self.pca.partial_fit(embed)
+            self.pca_fitted = True
+        sample = rng.random(df.height) < self.sample_rate
+        return {column: self.text_features(df.filter(pl.Series(sample)), column) for column in ('itemname', 'annotation')}
+
+    def fit_text(self, samples):
+        """
+        Randomized SVD по выборке. Хэш-пространство большое, поэтому SVD считается только по колонкам,
+        которые встретились в выборке: у остальных нулевые веса в компонентах
+        """
+        for column, parts in samples.items():
+            matrix = vstack(parts).tocsr()
+            n_components = min(TEXT_DIM_REDUCTION, matrix.shape[0] - 1)
+            if n_components > 0 and matrix.nnz:
+                used = np.unique(matrix.indices)
+                svd = TruncatedSVD(min(n_components, len(used)), algorithm='randomized', random_state=self.seed)
+                self.svd[column] = (used, svd.fit(matrix[:, used]))
+
+    def transform(self, df):
+        """Батч -> (n, N_FEATURES) float32; недостающие компоненты дополняются нулями"""
+        out = np.zeros((df.height, N_FEATURES), dtype=np.float32)
+        cat_tokens = df.select(
+            pl.concat_list(pl.lit(f'{column}=') + pl.col(column).fill_null('UNK') for column in CAT_COLUMNS)
+        ).to_series().to_list()
+        out[:, :CAT_HASH_FEATURES] = self.cat_hasher.transform(cat_tokens).toarray()
+
+        start = CAT_HASH_FEATURES
+        for column, weight in (('itemname', 0.5), ('annotation', 0.3)):
+            if column in self.svd:
+                used, svd = self.svd[column]
+                reduced = svd.transform(self.text_features(df, column)[:, used])
+                out[:, start:start + reduced.shape[1]] = reduced * weight
+            start += TEXT_DIM_REDUCTION
+
+        if self.pca_fitted:
+            reduced = self.pca.transform(embeddings(df))
+            out[:, start:start + reduced.shape[1]] = reduced
+        return out
+
+
+#################
+def vectorize_catalog(partition_dir, catalog_id, n_rows, row_start, output_dir, seed=0):
+    """
+    Векторы одного catalogid в строки [row_start, row_start + n_rows) общих массивов output_dir.
+    Два прохода по партиции батчами; стандартизация (x - mean) / std внутри catalogid
+    """
+    vectorizer = CatalogVectorizer(n_rows, seed)
+    rng = np.random.default_rng(seed)
+    samples = {'itemname': [], 'annotation': []}
+    for df in iter_catalog_batches(partition_dir, catalog_id):
+        for column, part in vectorizer.partial_fit(df, rng).items():
+            samples[column].append(part)
+    vectorizer.fit_text(samples)
+
+    # второй проход: сырые векторы во временный float32 memmap, статистика для стандартизации
+    raw_path = f'{output_dir}/tmp_{catalog_id}.npy'
+    raw = open_memmap(raw_path, mode='w+', dtype=np.float32, shape=(n_rows, N_FEATURES))
+    item_ids = open_memmap(f'{output_dir}/item_ids.npy', mode='r+')
+    catalog_ids = open_memmap(f'{output_dir}/catalog_ids.npy', mode='r+')
+    total = np.zeros(N_FEATURES, dtype=np.float64)
+    total_sq = np.zeros(N_FEATURES, dtype=np.float64)
+    pos = 0
+    for df in iter_catalog_batches(partition_dir, catalog_id):
+        vectors = vectorizer.transform(df)
+        raw[pos:pos + len(vectors)] = vectors
+        item_ids[row_start + pos:row_start + pos + len(vectors)] = df['item_id'].to_numpy()
+        total += vectors.sum(axis=0, dtype=np.float64)
+        total_sq += (vectors.astype(np.float64) ** 2).sum(axis=0)
+        pos += len(vectors)
+    catalog_ids[row_start:row_start + n_rows] = catalog_id
+
+    mean = total / max(n_rows, 1)
+    std = np.sqrt(np.maximum(total_sq / max(n_rows, 1) - mean ** 2, 0))
+    std = np.where(std < 1e-8, 1.0, std)
+
+    vectors_out = open_memmap(f'{output_dir}/vectors.npy', mode='r+')
+    for start in range(0, n_rows, BATCH_SIZE):
+        end = min(start + BATCH_SIZE, n_rows)
+        vectors_out[row_start + start:row_start + end] = (raw[start:end] - mean) / std
+    vectors_out.flush()
+    item_ids.flush()
+    catalog_ids.flush()
+    del raw
+    os.remove(raw_path)
+    return catalog_id, n_rows
+
+def _vectorize_catalog_task(args):
+    return vectorize_catalog(*args)
+
+def build_item_vectors(partition_dir='catalog_tmp', output_dir='item_vectors', catalog_ids=None,
+                       dtype='float16', n_workers=1, seed=0):
+    """
+    Векторы всех items: output_dir/vectors.npy (n_items, N_FEATURES), item_ids.npy, catalog_ids.npy,
+    index_item_ids.npy + index_rows.npy (item_id по возрастанию -> строка) и meta.json.
+    catalogid раздаются пулу из n_workers процессов, от больших к маленьким
+    """
+    sizes = catalog_sizes(partition_dir)
+    if catalog_ids is not None:
+        sizes = {catalog_id: sizes[catalog_id] for catalog_id in catalog_ids}
+    n_items = sum(sizes.values())
+
+    os.makedirs(output_dir, exist_ok=True)
+    open_memmap(f'{output_dir}/vectors.npy', mode='w+', dtype=dtype, shape=(n_items, N_FEATURES)).flush()
+    open_memmap(f'{output_dir}/item_ids.npy', mode='w+', dtype=np.int64, shape=(n_items,)).flush()
+    open_memmap(f'{output_dir}/catalog_ids.npy', mode='w+', dtype=np.int32, shape=(n_items,)).flush()
+
+    tasks = []
+    row_start = 0
+    for catalog_id, n_rows in sizes.items():
+        tasks.append((partition_dir, catalog_id, n_rows, row_start, output_dir, seed))
+        row_start += n_rows
+    tasks.sort(key=lambda task: -task[2])
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            list(tqdm(pool.map(_vectorize_catalog_task, tasks), total=len(tasks), desc='Vectorize catalogs'))
+    else:
+        for task in tqdm(tasks, desc='Vectorize catalogs'):
+            _vectorize_catalog_task(task)
+
+    item_ids = np.load(f'{output_dir}/item_ids.npy', mmap_mode='r')
+    order = np.argsort(item_ids, kind='stable')
+    np.save(f'{output_dir}/index_item_ids.npy', item_ids[order])
+    np.save(f'{output_dir}/index_rows.npy', order)
+
+    meta = {
+        'n_items': n_items,
+        'n_features': N_FEATURES,
+        'dtype': str(np.dtype(dtype)),
+        'catalogs': {str(task[1]): [task[3], task[3] + task[2]] for task in tasks},
+    }
+    with open(f'{output_dir}/meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+#################
+class ItemVectors:
+    """
+    Чтение результата build_item_vectors через memory map.
+    catalogs - {catalogid: (start, end)}: строки catalogid в vectors идут подряд
+    """
+    def __init__(self, output_dir='item_vectors'):
+        with open(f'{output_dir}/meta.json') as f:
+            self.catalogs = {catalog_id: tuple(rows) for catalog_id, rows in json.load(f)['catalogs'].items()}
+        self.vectors = np.load(f'{output_dir}/vectors.npy', mmap_mode='r')
+        self.item_ids = np.load(f'{output_dir}/item_ids.npy', mmap_mode='r')
+        self.catalog_ids = np.load(f'{output_dir}/catalog_ids.npy', mmap_mode='r')
+        self.index_item_ids = np.load(f'{output_dir}/index_item_ids.npy', mmap_mode='r')
+        self.index_rows = np.load(f'{output_dir}/index_rows.npy', mmap_mode='r')
+
+    def rows_of(self, items):
+        """Строки vectors для items; -1 для отсутствующих"""
+        items = np.asarray(items)
+        if len(self.index_item_ids) == 0:
+            return np.full(len(items), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.index_item_ids, items), len(self.index_item_ids) - 1)
+        return np.where(self.index_item_ids[pos] == items, self.index_rows[pos], -1)
+
+    def get(self, items):
+        """Векторы items (float32); отсутствующие - нули"""
+        rows = self.rows_of(items)
+        out = np.zeros((len(rows), self.vectors.shape[1]), dtype=np.float32)
+        out[rows >= 0] = self.vectors[rows[rows >= 0]]
+        return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Векторизация каталога товаров')
+    parser.add_argument('--items-glob', default='data/ml_ozon_recsys_train_final_apparel_items_data/*.parquet')
+    parser.add_argument('--partition-dir', default='catalog_tmp')
+    parser.add_argument('--output-dir', default='item_vectors')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--n-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--skip-partition', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_partition:
+        partition_catalog(sorted(glob.glob(args.items_glob)), args.partition_dir)
+    build_item_vectors(args.partition_dir, args.output_dir, dtype=args.dtype, n_workers=args.n_workers)
+
+
+if __name__ == '__main__':
+    main()
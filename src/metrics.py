@@ -1,5 +1,8 @@
 from collections import defaultdict
 import numpy as np
+import polars as pl
+
+from src import telemetry
 
 def precision_at_k(y_true, y_pred, k=100):
     """Precision@K - доля релевантных среди топ-K рекомендаций"""
@@ -54,37 +57,109 @@ def ndcg_at_k(y_true, y_pred, k=100, item_relevance=None):
     
     return dcg / idcg if idcg > 0 else 0.0
 
+def explode_ranked(df, list_col='item_id'):
+    """user_id, list_col: list -> user_id, item_id, rank (позиция в списке с 1)"""
+    return (
+        df.select(
+            'user_id',
+            pl.col(list_col).alias('item_id'),
+            pl.int_ranges(1, pl.col(list_col).list.len() + 1).alias('rank')
+        )
+        .explode(['item_id', 'rank'])
+        .filter(pl.col('rank').is_not_null())
+    )
+
+@telemetry.instrumented()
+def ranking_metrics(predictions, truth, k_values=[10, 20, 50, 100], users=None):
+    """
+    Колоночный расчет P/R/HR/MRR/nDCG сразу для всех K.
+    predictions - pl.DataFrame(user_id, item_id, rank), rank с 1
+    truth - pl.DataFrame(user_id, item_id), по строке на покупку (повторы допустимы)
+    users - pl.DataFrame(user_id), для кого и в каком порядке считать метрики;
+            по умолчанию пользователи из truth (как right merge в validate_recommendations).
+    Возвращает (aggregated_results, results) в том же формате, что calculate_metrics_for_all_users
+    """
+    max_k = max(k_values)
+    # колонка из одних пустых списков (нет ни одного предсказания / покупки) выводится как List(Null),
+    # item_id получается типа Null и join с ним падает - приводим к типу второй таблицы
+    item_dtype = next((df.schema['item_id'] for df in (predictions, truth) if df.schema['item_id'] != pl.Null), pl.Int64)
+    predictions = predictions.with_columns(pl.col('item_id').cast(item_dtype))
+    truth = truth.with_columns(pl.col('item_id').cast(item_dtype))
+    # discount[r] = 1 / log2(r + 1), ideal_dcg[m] = сумма discount для первых m позиций
+    discount = np.zeros(max_k + 1)
+    discount[1:] = 1.0 / np.log2(np.arange(2, max_k + 2))
+    ideal_dcg = np.cumsum(discount)
+
+    if users is None:
+        users = truth.select('user_id').unique(maintain_order=True)
+    users = users.select('user_id').with_row_index('row_id')
+    truth_stats = truth.group_by('user_id').agg(
+        n_true=pl.len(),
+        n_relevant=pl.col('item_id').n_unique()
+    )
+    predictions = predictions.filter(pl.col('rank') <= max_k).join(users.select('user_id'), on='user_id', how='semi')
+    n_pred = predictions.group_by('user_id').agg(n_pred=pl.len())
+
+    hits = predictions.join(
+        truth.select('user_id', 'item_id').unique(),
+        on=['user_id', 'item_id'],
+        how='semi'
+    ).with_columns(
+        discount=pl.lit(pl.Series(discount)).gather(pl.col('rank'))
+    )
+    hit_stats = hits.group_by('user_id').agg(
+        pl.col('rank').min().alias('first_hit'),
+        *[(pl.col('rank') <= k).sum().alias(f'hits@{k}') for k in k_values],
+        *[pl.col('discount').filter(pl.col('rank') <= k).sum().alias(f'dcg@{k}') for k in k_values],
+    )
+
+    per_user = (
+        users
+        .join(truth_stats, on='user_id', how='left')
+        .join(n_pred, on='user_id', how='left')
+        .join(hit_stats, on='user_id', how='left')
+        .fill_null(0)
+        .sort('row_id')
+    )
+
+    columns = {}
+    for k in k_values:
+        hits_k = pl.col(f'hits@{k}')
+        n_pred_k = pl.min_horizontal(pl.col('n_pred'), k)
+        idcg_k = pl.lit(pl.Series(ideal_dcg)).gather(pl.min_horizontal(pl.col('n_true'), k))
+        columns[f'P@{k}'] = pl.when(n_pred_k > 0).then(hits_k / n_pred_k).otherwise(0.0)
+        columns[f'R@{k}'] = pl.when(pl.col('n_relevant') > 0).then(hits_k / pl.col('n_relevant')).otherwise(1.0)
+        columns[f'HR@{k}'] = (hits_k > 0).cast(pl.Float64)
+        columns[f'MRR@{k}'] = pl.when(hits_k > 0).then(1.0 / pl.col('first_hit')).otherwise(0.0)
+        columns[f'nDCG@{k}'] = pl.when(idcg_k > 0).then(pl.col(f'dcg@{k}') / idcg_k).otherwise(0.0)
+
+    metric_names = ['P', 'R', 'HR', 'MRR', 'nDCG']
+    order = [f'{metric}@{k}' for metric in metric_names for k in k_values]
+    per_user = per_user.select(**{name: columns[name] for name in order})
+    telemetry.current_stage().record(rows_in=predictions.height, rows_out=per_user.height)
+
+    results = {name: per_user[name].to_list() for name in order}
+    aggregated_results = {name: float(np.mean(values)) for name, values in results.items()}
+    return aggregated_results, results
+
+@telemetry.instrumented()
 def calculate_metrics_for_all_users(validation_df, k_values=[10, 20, 50, 100]):
     """Вычисляет метрики для всех пользователей по нескольким K"""
     
-    # Инициализация результатов
-    metric_names = ['P', 'R', 'HR', 'MRR', 'nDCG']
-    results = {}
-    for metric in metric_names:
-        for k in k_values:
-            results[f'{metric}@{k}'] = []
-    
-    # Вычисляем метрики для каждого пользователя
-    for index, row in validation_df.iterrows():
-        y_true = row['true_items']
-        y_pred = row['predicted_items'] if isinstance(row['predicted_items'], (list, np.ndarray)) else []
-        
-        for k in k_values:
-            # Вычисление всех метрик для одного K
-            metrics = {
-                f'P@{k}': precision_at_k(y_true, y_pred, k),
-                f'R@{k}': recall_at_k(y_true, y_pred, k),
-                f'HR@{k}': hit_rate_at_k(y_true, y_pred, k),
-                f'MRR@{k}': mrr_at_k(y_true, y_pred, k),
-                f'nDCG@{k}': ndcg_at_k(y_true, y_pred, k)
-            }
-            
-            for metric_name, value in metrics.items():
-                results[metric_name].append(value)
-    
-    # Агрегируем результаты (среднее по пользователям)
-    aggregated_results = {}
-    for metric_name, values in results.items():
-        aggregated_results[metric_name] = np.mean(values)
-    
-    return aggregated_results, results
\ No newline at end of file
+    # validation_df (pandas): user_id, true_items, predicted_items (может быть NaN после merge)
+    validation_pl = pl.DataFrame({
+        'true_items': [list(items) for items in validation_df['true_items']],
+        'predicted_items': [
+            list(items) if isinstance(items, (list, np.ndarray)) else []
+            for items in validation_df['predicted_items']
+        ],
+    })
+    # каждая строка - отдельный "пользователь", как в построчном расчете
+    validation_pl = validation_pl.with_row_index('user_id')
+
+    return ranking_metrics(
+        explode_ranked(validation_pl, 'predicted_items'),
+        validation_pl.select('user_id', pl.col('true_items').alias('item_id')).explode('item_id').drop_nulls(),
+        k_values,
+        users=validation_pl.select('user_id')
+    )
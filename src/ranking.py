@@ -0,0 +1,110 @@
+"""
+Потоковое ранжирование exploded кандидатов: чанки по границам пользователей,
+фичи подклеиваются к чанку, скор - многопоточный predict модели (CatBoostRanker),
+от чанка остается только top-k на пользователя и сразу уходит в SubmissionWriter.
+В памяти одновременно один чанк кандидатов, а не весь набор.
+"""
+import polars as pl
+import pyarrow.parquet as pq
+
+from src import telemetry
+
+
+#################
+def iter_user_chunks(candidates, chunk_rows=2_000_000, columns=None, batch_rows=250_000):
+    """
+    candidates - путь к parquet или pl.DataFrame (user_id, item_id, ...), строки одного пользователя подряд
+    по возрастанию user_id (как у unite_candidates_exploded).
+    Отдает pl.DataFrame примерно по chunk_rows строк; пользователь никогда не делится между чанками
+    """
+    if isinstance(candidates, str):
+        parquet = pq.ParquetFile(candidates)
+        batches = (pl.from_arrow(batch) for batch in parquet.iter_batches(batch_size=batch_rows, columns=columns))
+    else:
+        batches = candidates.select(columns or candidates.columns).iter_slices(batch_rows)
+
+    pending, pending_rows, last_user = [], 0, None
+    for batch in batches:
+        if batch.height == 0:
+            continue
+        if not batch['user_id'].is_sorted() or (last_user is not None and batch['user_id'][0] < last_user):
+            raise ValueError('candidates must be sorted by user_id')
+        last_user = batch['user_id'][-1]
+        pending.append(batch)
+        pending_rows += batch.height
+        if pending_rows < chunk_rows:
+            continue
+
+        # последний пользователь может продолжиться в следующем батче - переносим его
+        chunk = pl.concat(pending)
+        tail = chunk['user_id'] == last_user
+        ready = chunk.filter(~tail)
+        pending = [chunk.filter(tail)]
+        pending_rows = pending[0].height
+        if ready.height:
+            yield ready
+    if pending_rows:
+        yield pl.concat(pending)
+
+def top_k_per_user(scored, k=100, score_col='score'):
+    """
+    pl.DataFrame(user_id, item_id: list) - k items с наибольшим score, от лучшего к худшему.
+    Сначала отсекаются строки с рангом > k внутри пользователя, сортируется только остаток
+    """
+    return (
+        scored
+        .filter(pl.col(score_col).rank('ordinal', descending=True).over('user_id') <= k)
+        .sort(['user_id', score_col], descending=[False, True], maintain_order=True)
+        .group_by('user_id', maintain_order=True)
+        .agg(pl.col('item_id'))
+    )
+
+def score_chunk(chunk, model, feature_cols, feature_store=None, thread_count=-1):
+    """Фичи из feature_store, которых нет в чанке, + predict; возвращает (user_id, item_id, score)"""
+    st = telemetry.current_stage()
+    if feature_store is not None:
+        with st.timer('join'):
+            chunk = feature_store.join(chunk, features=feature_cols)
+    with st.timer('predict'):
+        scores = model.predict(chunk.select(feature_cols).to_pandas(), thread_count=thread_count)
+    return chunk.select('user_id', 'item_id').with_columns(pl.Series('score', scores, pl.Float32))
+
+@telemetry.instrumented()
+def rank_candidates(candidates, model, feature_store=None, writer=None, k=100, feature_cols=None,
+                    users=None, chunk_rows=2_000_000, thread_count=-1):
+    """
+    candidates - путь к exploded parquet или pl.DataFrame, отсортированные по user_id.
+    feature_cols - фичи модели в порядке обучения (по умолчанию model.feature_names_);
+    колонки, которых нет в кандидатах, берутся из feature_store (src/features.py).
+    users - оставить только этих пользователей (например тестовых).
+    writer - SubmissionWriter: top-k каждого чанка пишется сразу, функция возвращает число пользователей;
+    без writer возвращает pl.DataFrame(user_id, item_id: list) целиком
+    """
+    feature_cols = list(feature_cols if feature_cols is not None else model.feature_names_)
+    columns = None
+    if isinstance(candidates, str):
+        available = pq.read_schema(candidates).names
+        columns = ['user_id', 'item_id'] + [col for col in feature_cols if col in available and col not in ('user_id', 'item_id')]
+
+    results, n_users = [], 0
+    for chunk in iter_user_chunks(candidates, chunk_rows, columns):
+        if users is not None:
+            chunk = chunk.filter(pl.col('user_id').is_in(pl.Series(users).cast(chunk.schema['user_id'], strict=False)))
+            if chunk.height == 0:
+                continue
+        with telemetry.stage('rank_chunk') as st:
+            scored = score_chunk(chunk, model, feature_cols, feature_store, thread_count)
+            with st.timer('top_k'):
+                top = top_k_per_user(scored, k)
+            st.record(rows_in=chunk.height, rows_out=top.height)
+        n_users += top.height
+        if writer is not None:
+            writer.write(top)
+        else:
+            results.append(top)
+
+    if writer is not None:
+        return n_users
+    if not results:
+        return pl.DataFrame(schema={'user_id': pl.Int64, 'item_id': pl.List(pl.Int64)})
+    return pl.concat(results)
@@ -0,0 +1,364 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import islice
+
+import polars as pl
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from src import telemetry
+from src.split import UserCutoffs
+
+
+def parse_date(date):
+    """'2025-05-21' -> pl.datetime(2025, 5, 21)"""
+    year, month, day = map(int, date.split('-'))
+    return pl.datetime(year, month, day)
+
+
+@dataclass
+class ScanSpec:
+    """
+    Описание генератора для общего прохода по файлам событий
+    name - ключ, под которым вернется результат
+    actions - значения action_type / last_status, которые берет генератор
+    n - сколько последних items храним для каждого пользователя
+    min_date - берем события строго после этой даты
+    """
+    name: str
+    actions: list
+    n: int
+    min_date: str = '2025-05-21'
+
+
+class TopNAccumulator:
+    """
+    Колоночный аккумулятор n последних (по time_col) items на пользователя.
+    Состояние - pl.DataFrame(user_id, item_id, time_col), батчи мерджатся внутри polars.
+    При равных timestamp раньше идут события, пришедшие раньше (как стабильная сортировка).
+    Насыщенные пользователи (freeze) уходят из state в frozen: их top-n больше не меняется,
+    поэтому каждый следующий update работает только с теми, кто еще набирает события
+    """
+    def __init__(self, n, time_col='timestamp'):
+        self.n = n
+        self.time_col = time_col
+        self.state = None
+        self.frozen = []
+        self.saturated = set()
+        self._saturated_ids = None
+
+    def update(self, batch):
+        """batch - pl.DataFrame(user_id, item_id, time_col)"""
+        batch = batch.select('user_id', 'item_id', self.time_col)
+        if self._saturated_ids is not None:
+            batch = batch.filter(~pl.col('user_id').is_in(self._saturated_ids))
+        combined = batch if self.state is None else pl.concat([self.state, batch], how='vertical_relaxed')
+        self.state = combined.filter(
+            pl.col(self.time_col).rank('ordinal', descending=True).over('user_id') <= self.n
+        )
+
+    def freeze(self, bound=None):
+        """
+        Переносит в frozen пользователей с n событиями, которых не вытеснят непрочитанные файлы:
+        самое старое событие их top-n не старше bound - максимального timestamp оставшихся файлов.
+        bound=None - файлы идут строго от новых к старым, достаточно n событий.
+        Возвращает число новых насыщенных пользователей
+        """
+        if self.state is None or self.state.height < self.n:
+            return 0
+        full = pl.len().over('user_id') >= self.n
+        if bound is not None:
+            full = full & (pl.col(self.time_col).min().over('user_id') >= bound)
+        is_new = self.state.select(full)[:, 0]
+        if not is_new.any():
+            return 0
+
+        self.frozen.append(self.state.filter(is_new))
+        self.state = self.state.filter(~is_new)
+        new_ids = self.frozen[-1]['user_id'].unique()
+        self.saturated.update(new_ids.to_list())
+        self._saturated_ids = new_ids if self._saturated_ids is None else pl.concat([self._saturated_ids, new_ids])
+        return new_ids.len()
+
+    def is_saturated(self, n_users):
+        """Все n_users пользователей уже насыщены (счетчик, без прохода по состоянию)"""
+        return len(self.saturated) >= n_users
+
+    def result(self):
+        """pl.DataFrame(user_id, item_id: list), items от новых к старым"""
+        parts = self.frozen + ([self.state] if self.state is not None else [])
+        if not parts:
+            return pl.DataFrame(schema={'user_id': pl.Int64, 'item_id': pl.List(pl.Int64)})
+        return (
+            pl.concat(parts, how='vertical_relaxed')
+            .sort(self.time_col, descending=True, maintain_order=True)
+            .group_by('user_id', maintain_order=True)
+            .agg(pl.col('item_id'))
+        )
+
+
+def file_time_ranges(files, time_col):
+    """
+    {файл: (min, max)} time_col по статистикам row groups из футера parquet - сами данные не читаются.
+    (None, None), если статистик нет
+    """
+    ranges = {}
+    for file_path in files:
+        metadata = pq.read_metadata(file_path)
+        lows, highs = [], []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            column = next(
+                (row_group.column(j) for j in range(row_group.num_columns) if row_group.column(j).path_in_schema == time_col),
+                None
+            )
+            stats = column.statistics if column is not None else None
+            if stats is None or not stats.has_min_max:
+                lows = None
+                break
+            lows.append(stats.min)
+            highs.append(stats.max)
+        ranges[file_path] = (min(lows), max(highs)) if lows else (None, None)
+    return ranges
+
+def order_newest_first(files, time_ranges):
+    """
+    Файлы от новых к старым и верхняя граница времени непрочитанных файлов после каждого.
+    Без статистик хотя бы у одного файла - files в обратном порядке, границы None
+    """
+    if any(time_ranges.get(file_path, (None, None))[1] is None for file_path in files):
+        return files[::-1], [None] * len(files)
+    ordered = sorted(files[::-1], key=lambda file_path: time_ranges[file_path][1], reverse=True)
+    bounds = [time_ranges[file_path][1] for file_path in ordered[1:]] + [None]
+    return ordered, bounds
+
+def needed_days(activity, actions, n, min_date, type_col, mode, user_ids=None, user_cutoff_time=None):
+    """
+    activity - pl.DataFrame(user_id, type_col, date, events) (EventStore.activity) -> множество дней,
+    события которых могут попасть в top-n хотя бы одного пользователя прохода: день нужен пользователю,
+    пока в более новых днях у него меньше n событий. В train день cutoff_time не считается полным
+    """
+    days = activity.filter(pl.col(type_col).is_in(actions) & (pl.col('date') >= datetime.fromisoformat(min_date).date()))
+    id_dtype = days.schema['user_id']
+    if mode == 'train':
+        cutoffs = user_cutoff_time.select(pl.col('user_id').cast(id_dtype), pl.col('cutoff_time').dt.date().alias('cutoff_date'))
+        days = days.join(cutoffs, on='user_id').filter(pl.col('date') <= pl.col('cutoff_date'))
+        complete = pl.col('date') < pl.col('cutoff_date')
+    else:
+        days = days.filter(pl.col('user_id').is_in(user_ids.cast(id_dtype, strict=False)))
+        complete = pl.lit(True)
+
+    counted = pl.col('events') * pl.col('complete')
+    return set(
+        days
+        .group_by('user_id', 'date')
+        .agg(pl.col('events').sum(), complete.first().alias('complete'))
+        .sort(['user_id', 'date'], descending=[False, True])
+        .filter((counted.cum_sum() - counted).over('user_id') < n)
+        ['date'].unique().to_list()
+    )
+
+
+#################
+def scan_file(file_path, task):
+    """
+    Фильтр одного файла и частичный top-n для каждого генератора.
+    task - параметры прохода из scan_events (словарь из простых значений, чтобы его можно было передать в процесс)
+    Возвращает {name: pl.DataFrame(user_id, item_id, time_col)} - не больше n строк на пользователя
+    """
+    with telemetry.stage('scan_file', parent=task.get('telemetry_parent'), file=file_path) as st:
+        st.record(bytes_read=os.path.getsize(file_path) if st.enabled else None)
+        return _scan_file(file_path, task, st)
+
+def _scan_file(file_path, task, st):
+    type_col, time_col = task['type_col'], task['time_col']
+
+    # фильтры по action и дате проталкиваются в scan_parquet: row groups вне окна
+    # (по статистикам timestamp) и лишние колонки не декодируются
+    window_filter = pl.col(type_col).is_in(task['all_actions']) & (pl.col(time_col) > parse_date(task['scan_min_date']))
+    if task['max_cutoff'] is not None:
+        window_filter = window_filter & (pl.col(time_col) < task['max_cutoff'])
+
+    lf = pl.scan_parquet(file_path).select(
+        ['user_id', 'item_id', type_col, time_col]
+    ).filter(window_filter)
+    # в EventStore id могут быть Int32
+    id_dtype = lf.collect_schema()['user_id']
+
+    if task['mode'] == 'train':
+        lf = task['cutoffs'].apply(lf, time_col) # только из обучающей части
+    elif task['mode'] == 'submit':
+        lf = lf.filter(pl.col('user_id').is_in(task['user_ids'].cast(id_dtype, strict=False)))
+
+    # decode - чтение parquet с фильтрами и отсечкой по cutoff, topn - частичные top-n генераторов
+    with st.timer('decode'):
+        df = lf.collect(engine='streaming')
+
+    partials = {}
+    with st.timer('topn'):
+        for name, actions, n, min_date in task['specs']:
+            acc = TopNAccumulator(n, time_col)
+            acc.update(df.filter(pl.col(type_col).is_in(actions) & (pl.col(time_col) > parse_date(min_date))))
+            partials[name] = acc.state
+    st.record(rows_in=df.height, rows_out=sum(partial.height for partial in partials.values()))
+    return partials
+
+_WORKER_TASK = None
+
+def _init_worker(task):
+    global _WORKER_TASK
+    _WORKER_TASK = task
+    telemetry.configure_telemetry(**task['telemetry'])
+
+def _scan_file_in_worker(file_path):
+    return scan_file(file_path, _WORKER_TASK)
+
+def iter_partials(files, task, n_workers=1, max_in_flight=None, use_processes=False):
+    """
+    Частичные результаты scan_file по files в том же порядке.
+    n_workers > 1 - файлы обрабатываются в пуле потоков (или процессов при use_processes=True),
+    одновременно в работе не больше max_in_flight файлов (по умолчанию 2 * n_workers)
+    """
+    if n_workers <= 1:
+        for file_path in files:
+            yield scan_file(file_path, task)
+        return
+
+    if use_processes:
+        executor = ProcessPoolExecutor(
+            n_workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(task,)
+        )
+        submit = lambda file_path: executor.submit(_scan_file_in_worker, file_path)
+    else:
+        executor = ThreadPoolExecutor(n_workers)
+        submit = lambda file_path: executor.submit(scan_file, file_path, task)
+
+    files = iter(files)
+    pending = deque()
+    try:
+        for file_path in islice(files, max_in_flight or 2 * n_workers):
+            pending.append(submit(file_path))
+        while pending:
+            partials = pending.popleft().result()
+            for file_path in islice(files, 1):
+                pending.append(submit(file_path))
+            yield partials
+    finally:
+        # досрочная остановка: не запускаем оставшиеся файлы
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def scan_events(files, specs, mode, user_ids=None, user_cutoff_time=None,
+                type_col='action_type', time_col='timestamp', type_codes=None, desc='Scan events',
+                n_workers=1, max_in_flight=None, use_processes=False, time_ranges=None, activity=None):
+    """
+    Один проход по files (от новых к старым) сразу для нескольких генераторов.
+    Каждый файл читается один раз, фильтр по пользователям / cutoff применяется один раз,
+    дальше каждый генератор получает свой срез по actions и min_date.
+
+    mode == 'train' - берем события до cutoff_time из user_cutoff_time
+    (pl.DataFrame(user_id, cutoff_time) или UserCutoffs из src/split.py - для кодов EventStore без join)
+    mode == 'submit' - берем события пользователей из user_ids
+    type_codes - {action: код}, если type_col закодирован (EventStore)
+    n_workers, max_in_flight, use_processes - параллельная обработка файлов (см. iter_partials);
+    частичные top-n сливаются в порядке файлов, поэтому результат совпадает с последовательным
+
+    Досрочная остановка: файлы упорядочиваются по time_ranges ({файл: (min, max)}, по умолчанию
+    из футеров parquet), пользователь насыщается, когда его n событий не вытеснят оставшиеся файлы;
+    проход заканчивается, когда насыщены все пользователи (счетчик, а не проверка каждого).
+    activity - события пользователей по дням (EventStore.activity): файл не читается, если ни в одном
+    его дне нет событий, нужных для top-n хоть одного пользователя (needed_days), так что пользователи,
+    которым не хватает событий, не заставляют читать всю историю.
+    Файлы целиком после max cutoff_time (train) или до min_date всех генераторов пропускаются.
+    Возвращает {spec.name: pl.DataFrame(user_id, item_id: list)}, items от новых к старым
+    """
+    actions = {
+        spec.name: spec.actions if type_codes is None else [type_codes[action] for action in spec.actions if action in type_codes]
+        for spec in specs
+    }
+    cutoffs = None
+    if mode == 'train':
+        cutoffs = user_cutoff_time if isinstance(user_cutoff_time, UserCutoffs) else UserCutoffs(user_cutoff_time)
+    task = {
+        'mode': mode,
+        'type_col': type_col,
+        'time_col': time_col,
+        'specs': [(spec.name, actions[spec.name], spec.n, spec.min_date) for spec in specs],
+        'all_actions': sorted({action for spec in specs for action in actions[spec.name]}),
+        'scan_min_date': min(spec.min_date for spec in specs),
+        'max_cutoff': cutoffs.max() if mode == 'train' else None,
+        'cutoffs': cutoffs,
+        'user_ids': (user_ids if isinstance(user_ids, pl.Series) else pl.Series('user_id', list(user_ids))) if mode == 'submit' else None,
+    }
+
+    states = {spec.name: TopNAccumulator(spec.n, time_col) for spec in specs}
+    done = {spec.name: False for spec in specs}
+    n_users = len(user_ids) if mode == 'submit' else cutoffs.height
+    min_dates = {spec.name: datetime.fromisoformat(spec.min_date) for spec in specs}
+    days = {
+        spec.name: needed_days(activity, actions[spec.name], spec.n, spec.min_date, type_col, mode, task['user_ids'], cutoffs.frame if cutoffs is not None else None)
+        for spec in specs
+    } if activity is not None else {}
+
+    if time_ranges is None:
+        time_ranges = file_time_ranges(files, time_col)
+    ordered, bounds = order_newest_first(files, time_ranges)
+    max_cutoff = task['max_cutoff']
+
+    def spec_needs(name, min_ts, max_ts):
+        if done[name] or max_ts <= min_dates[name]:
+            return False
+        if name not in days:
+            return True
+        first_day = min_ts.date()
+        return any(first_day + timedelta(days=i) in days[name] for i in range((max_ts.date() - first_day).days + 1))
+
+    submitted = deque()
+
+    def needed_files():
+        # читается iter_partials в момент постановки файла в работу: решение по текущим насыщениям
+        for file_path, bound in zip(ordered, bounds):
+            min_ts, max_ts = time_ranges.get(file_path, (None, None))
+            if max_ts is not None and (
+                (max_cutoff is not None and min_ts >= max_cutoff) or not any(spec_needs(spec.name, min_ts, max_ts) for spec in specs)
+            ):
+                continue
+            submitted.append(bound)
+            yield file_path
+
+    with telemetry.stage('scan_events', desc=desc, specs=[spec.name for spec in specs], n_files=len(files), n_workers=n_workers) as st:
+        # файлы могут обрабатываться в других потоках / процессах: родитель передается явно
+        task['telemetry_parent'] = st.path if st.enabled else None
+        task['telemetry'] = telemetry.worker_settings()
+
+        partials_iter = iter_partials(needed_files(), task, n_workers, max_in_flight, use_processes)
+        n_scanned = 0
+        for partials in tqdm(partials_iter, total=len(files), desc=desc):
+            # результаты приходят в порядке постановки: граница времени файлов, оставшихся после этого
+            bound = submitted.popleft()
+            n_scanned += 1
+            with st.timer('merge'):
+                for spec in specs:
+                    if done[spec.name]:
+                        continue
+
+                    states[spec.name].update(partials[spec.name])
+                    states[spec.name].freeze(bound)
+                    if states[spec.name].is_saturated(n_users):
+                        done[spec.name] = True
+
+            if all(done.values()):
+                break
+        partials_iter.close()
+
+        results = {name: state.result() for name, state in states.items()}
+        st.record(
+            files_scanned=n_scanned, files_skipped=len(files) - n_scanned,
+            saturated_users={name: len(state.saturated) for name, state in states.items()},
+            rows_out=sum(df.height for df in results.values()),
+        )
+    return results
@@ -0,0 +1,367 @@
+"""
+Онлайн-рекомендации для одного пользователя по тем же правилам, что пакетный сабмит gen_candidates.ipynb:
+последние favorite / processed / view_description, соседи последних просмотров (nearest_neighbors),
+co-occurrence соседи последних доставленных, слияние в порядке источников (order_scores) и добивка популярными.
+Офлайн-артефакты (build_serving_artifacts) - массивы .npy, открываются через memory map:
+состояние пользователей и таблицы соседей - CooccurNeighborIndex (ключ -> список), популярные - один массив.
+Recommender.recommend считает сразу пачку пользователей в numpy, RecommendationService собирает
+одновременные запросы asyncio в такие пачки, serve - HTTP поверх asyncio.start_server.
+
+build_serving_artifacts('serving', nn_df, pl.read_parquet('cooccurrence_neighbors.parquet'))
+python -m src.serving serve --artifacts serving --port 8000
+curl 'localhost:8000/recommend?user_id=123&n=100'
+"""
+import argparse
+import asyncio
+import json
+import os
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import polars as pl
+
+from src import telemetry
+from src.cooccurrence import CooccurNeighborIndex
+from src.scan import ScanSpec
+
+META = 'meta.json'
+# порядок источников слияния, как dfs_to_merge в gen_candidates.ipynb
+SOURCES = ['last_favorite_items', 'processed_items', 'last_viewed_def_items', 'viewed_neighbors', 'cooccur_neighbors']
+
+
+#################
+def state_specs(n_favorite=200, n_viewed_def=200, n_processed=100, n_viewed=3, n_delivered=1):
+    """Состояние пользователей для сервиса - те же ScanSpec, что у генераторов сабмита"""
+    return {
+        'tracker': [
+            ScanSpec('last_favorite_items', ['to_cart', 'favorite'], n_favorite, '2025-05-07'),
+            ScanSpec('last_viewed_def_items', ['review_view', 'view_description'], n_viewed_def, '2025-06-15'),
+            ScanSpec('last_viewed_items', ['review_view', 'view_description'], n_viewed, '2025-06-15'),
+        ],
+        'orders': [
+            ScanSpec('processed_items', ['proccesed_orders'], n_processed, '2025-06-15'),
+            ScanSpec('last_delivered_items', ['delivered_orders'], n_delivered, '2025-06-21'),
+        ],
+    }
+
+def neighbor_lists(nn_df, max_k):
+    """nearest_neighbors (item_id, neighbor_item_id, rank) -> (item_id, neighbors: list) первых max_k по rank"""
+    return (
+        nn_df.filter(pl.col('rank') <= max_k)
+        .sort(['item_id', 'rank'])
+        .group_by('item_id', maintain_order=True)
+        .agg(pl.col('neighbor_item_id').alias('neighbors'))
+    )
+
+def key_lists(df, key, values):
+    """Таблица key -> values: list в формате CooccurNeighborIndex.from_frame"""
+    return df.select(pl.col(key).alias('item_id'), pl.col(values).alias('neighbors'))
+
+@telemetry.instrumented()
+def build_serving_artifacts(output_dir, nn_df, cooccurrence_neighbors, popular_items=None, mode='submit',
+                            user_cutoff_time=None, specs=None, k_values=(6, 3, 2), cooccur_k=3):
+    """
+    Офлайн-часть сервиса в output_dir: состояние пользователей одним проходом по tracker и заказам
+    (scan_events_cached, как генераторы), таблицы соседей и популярные (get_popular_items(400) по умолчанию).
+    k_values - сколько соседей nearest_neighbors брать от 1-го, 2-го ... последнего просмотра,
+    cooccur_k - сколько co-occurrence соседей от каждого доставленного item.
+    nn_df - nearest_neighbors (item_id, neighbor_item_id, rank) в исходных id, cooccurrence_neighbors - таблица
+    build_cooccurrence_neighbors в id генераторов: с EventStore коды состояния, соседей и популярных декодируются
+    """
+    from src import gen_cand_utils as g
+
+    specs = specs or state_specs(n_viewed=len(k_values))
+    state = {}
+    for source, source_specs in specs.items():
+        type_col, time_col = ('action_type', 'timestamp') if source == 'tracker' else ('last_status', 'created_timestamp')
+        state.update(g.scan_events_cached(
+            source, source_specs, mode, user_cutoff_time, type_col=type_col, time_col=time_col,
+            desc='Serving state'
+        ))
+    if popular_items is None:
+        popular_items = g.get_popular_items(n=400)
+    popular = pl.DataFrame({'item_id': popular_items})
+    if g.event_store is not None and g.event_store.users is not None:
+        state = {name: g.event_store.decode_ids(df) for name, df in state.items()}
+        popular = g.event_store.decode_ids(popular)
+        cooccurrence_neighbors = g.event_store.decode_ids(cooccurrence_neighbors, item_cols=('item_id', 'neighbors'))
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, df in state.items():
+        CooccurNeighborIndex.from_frame(key_lists(df, 'user_id', 'item_id')).save(f'{output_dir}/state/{name}')
+    CooccurNeighborIndex.from_frame(neighbor_lists(nn_df, max(k_values))).save(f'{output_dir}/nearest_neighbors')
+    CooccurNeighborIndex.from_frame(
+        cooccurrence_neighbors.select('item_id', pl.col('neighbors').list.head(cooccur_k))
+    ).save(f'{output_dir}/cooccurrence')
+    np.save(f'{output_dir}/popular.npy', popular['item_id'].to_numpy())
+    with open(f'{output_dir}/{META}', 'w') as f:
+        json.dump({'k_values': list(k_values), 'cooccur_k': cooccur_k, 'mode': mode}, f, indent=1)
+    telemetry.current_stage().record(rows_out=sum(df.height for df in state.values()))
+
+
+#################
+def _within(rows):
+    """Позиция элемента внутри своей строки; rows не убывают"""
+    return np.arange(len(rows)) - np.searchsorted(rows, rows)
+
+class Recommender:
+    """
+    Артефакты build_serving_artifacts в memory map. recommend(user_ids, n) - top-n сразу для пачки пользователей:
+    кандидаты всех источников собираются плоскими массивами (строка пользователя, ключ порядка, item),
+    первое вхождение (пользователь, item) по ключу и первые n на пользователя - сортировками numpy, без циклов
+    """
+    def __init__(self, artifacts_dir):
+        with open(f'{artifacts_dir}/{META}') as f:
+            self.meta = json.load(f)
+        self.state = {
+            name: CooccurNeighborIndex.load(f'{artifacts_dir}/state/{name}')
+            for name in sorted(os.listdir(f'{artifacts_dir}/state'))
+        }
+        self.nearest_neighbors = CooccurNeighborIndex.load(f'{artifacts_dir}/nearest_neighbors')
+        self.cooccurrence = CooccurNeighborIndex.load(f'{artifacts_dir}/cooccurrence')
+        self.popular = np.load(f'{artifacts_dir}/popular.npy', mmap_mode='r')
+        self.k_values = np.asarray(self.meta['k_values'], dtype=np.int64)
+
+    def user_ids(self):
+        """Пользователи, у которых есть хоть какое-то состояние"""
+        return np.unique(np.concatenate([np.asarray(index.item_ids) for index in self.state.values()]))
+
+    def _viewed_neighbors(self, user_ids):
+        # i-й просмотр (от новых) дает первые k_values[i] соседей
+        rows, viewed = self.state['last_viewed_items'].lookup(user_ids, len(self.k_values))
+        neighbor_rows, neighbors = self.nearest_neighbors.lookup(viewed, int(self.k_values.max()))
+        keep = _within(neighbor_rows) < self.k_values[_within(rows)[neighbor_rows]]
+        return rows[neighbor_rows[keep]], neighbors[keep]
+
+    def _cooccur_neighbors(self, user_ids):
+        rows, delivered = self.state['last_delivered_items'].lookup(user_ids)
+        neighbor_rows, neighbors = self.cooccurrence.lookup(delivered, self.meta['cooccur_k'])
+        return rows[neighbor_rows], neighbors
+
+    def candidates(self, user_ids):
+        """{источник: (rows, items)} - rows - номер пользователя в user_ids, items по порядку источника"""
+        parts = {}
+        for name in SOURCES:
+            if name == 'viewed_neighbors':
+                parts[name] = self._viewed_neighbors(user_ids)
+            elif name == 'cooccur_neighbors':
+                parts[name] = self._cooccur_neighbors(user_ids)
+            else:
+                parts[name] = self.state[name].lookup(user_ids)
+        return parts
+
+    def recommend(self, user_ids, n=100):
+        """
+        Top-n для каждого пользователя user_ids: (offsets, items), items user_ids[i] - items[offsets[i]:offsets[i+1]].
+        Порядок как у unite_candidates (order_scores): источник, позиция в источнике, затем популярные
+        """
+        user_ids = np.asarray(user_ids)
+        popular = np.asarray(self.popular[:n])
+        parts = list(self.candidates(user_ids).values())
+        parts.append((np.repeat(np.arange(len(user_ids)), len(popular)), np.tile(popular, len(user_ids))))
+
+        rows = np.concatenate([part_rows for part_rows, _ in parts]).astype(np.int64)
+        items = np.concatenate([part_items.astype(popular.dtype) for _, part_items in parts])
+        key = np.concatenate([
+            position * 2**32 + _within(part_rows) for position, (part_rows, _) in enumerate(parts)
+        ])
+
+        order = np.lexsort((key, items, rows))
+        rows, items, key = rows[order], items[order], key[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (items[1:] != items[:-1])
+        rows, items, key = rows[first], items[first], key[first]
+
+        order = np.lexsort((key, rows))
+        rows, items = rows[order], items[order]
+        keep = _within(rows) < n
+        offsets = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(user_ids)), out=offsets[1:])
+        return offsets, items[keep]
+
+
+#################
+class RecommendationService:
+    """
+    Асинхронный фронт Recommender: запросы копятся в очереди и считаются пачками до max_batch,
+    первый запрос пачки ждет остальные не дольше max_wait_ms. Пачка считается в потоке, цикл событий не блокируется
+    """
+    def __init__(self, recommender, max_batch=256, max_wait_ms=1.0):
+        self.recommender = recommender
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = []
+        self._queue = None
+        self._worker = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+
+    async def recommend(self, user_id, n=100):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((user_id, n, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.batch_sizes.append(len(batch))
+            user_ids = np.array([user_id for user_id, _, _ in batch])
+            n = max(n for _, n, _ in batch)
+            try:
+                offsets, items = await loop.run_in_executor(None, self.recommender.recommend, user_ids, n)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for i, (_, user_n, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(items[offsets[i]:min(offsets[i + 1], offsets[i] + user_n)].tolist())
+
+
+#################
+def _response(writer, status, body, keep_alive):
+    payload = json.dumps(body).encode()
+    writer.write(
+        f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload
+    )
+
+def parse_recommend_query(query):
+    """(user_id, n) из query /recommend; ValueError - некорректные параметры (ответ 400)"""
+    try:
+        user_id = int(query['user_id'][0])
+        n = int(query.get('n', ['100'])[0])
+    except (KeyError, ValueError):
+        raise ValueError('user_id and n must be integers') from None
+    if not -2**63 <= user_id < 2**63:
+        raise ValueError('user_id out of int64 range')
+    if n < 1:
+        raise ValueError('n must be >= 1')
+    return user_id, n
+
+async def handle_http(service, reader, writer):
+    """
+    GET /recommend?user_id=...&n=100 -> {"user_id": ..., "items": [...]}, GET /health.
+    Некорректный запрос или параметры - 400, в пачку сервиса они не попадают.
+    Соединения keep-alive: нагрузочный тест не открывает соединение на каждый запрос
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip().lower()
+            parts = request_line.decode('latin-1').split()
+            if len(parts) != 3:
+                _response(writer, '400 Bad Request', {'error': 'malformed request line'}, False)
+                await writer.drain()
+                break
+            method, target, version = parts
+            keep_alive = headers.get('connection', 'keep-alive' if version == 'HTTP/1.1' else 'close') != 'close'
+
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            if method != 'GET':
+                _response(writer, '405 Method Not Allowed', {'error': 'only GET'}, keep_alive)
+            elif url.path == '/health':
+                _response(writer, '200 OK', {'status': 'ok'}, keep_alive)
+            elif url.path == '/recommend':
+                try:
+                    user_id, n = parse_recommend_query(query)
+                except ValueError as e:
+                    _response(writer, '400 Bad Request', {'error': str(e)}, keep_alive)
+                else:
+                    items = await service.recommend(user_id, n)
+                    _response(writer, '200 OK', {'user_id': user_id, 'items': items}, keep_alive)
+            else:
+                _response(writer, '404 Not Found', {'error': 'unknown path'}, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_server(artifacts_dir, host='127.0.0.1', port=8000, max_batch=256, max_wait_ms=1.0):
+    """Сервис и HTTP-сервер в текущем цикле событий: (server, service)"""
+    service = RecommendationService(Recommender(artifacts_dir), max_batch, max_wait_ms)
+    await service.start()
+    server = await asyncio.start_server(lambda reader, writer: handle_http(service, reader, writer), host, port)
+    return server, service
+
+async def serve(artifacts_dir, host='127.0.0.1', port=8000, max_batch=256, max_wait_ms=1.0):
+    server, _ = await start_server(artifacts_dir, host, port, max_batch, max_wait_ms)
+    print(f'serving {artifacts_dir} on http://{host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Онлайн-рекомендации по офлайн-артефактам')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='артефакты сервиса')
+    build.add_argument('--output-dir', default='serving')
+    build.add_argument('--data-root', default='data')
+    build.add_argument('--event-store', default=None)
+    build.add_argument('--nearest-neighbors', default='nearest_neighbors')
+    build.add_argument('--cooccurrence', default='cooccurrence_neighbors.parquet')
+    build.add_argument('--k-values', type=int, nargs='+', default=[6, 3, 2])
+    build.add_argument('--cooccur-k', type=int, default=3)
+
+    run = commands.add_parser('serve', help='HTTP-сервис')
+    run.add_argument('--artifacts', default='serving')
+    run.add_argument('--host', default='127.0.0.1')
+    run.add_argument('--port', type=int, default=8000)
+    run.add_argument('--max-batch', type=int, default=256)
+    run.add_argument('--max-wait-ms', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from src import gen_cand_utils as g
+        from src.datasets import configure_datasets
+        configure_datasets(args.data_root)
+        if args.event_store is not None:
+            g.use_event_store(args.event_store)
+        nn_df = pl.read_parquet(f'{args.nearest_neighbors}/*.parquet', columns=['item_id', 'neighbor_item_id', 'rank'])
+        build_serving_artifacts(
+            args.output_dir, nn_df, pl.read_parquet(args.cooccurrence),
+            k_values=tuple(args.k_values), cooccur_k=args.cooccur_k
+        )
+    else:
+        asyncio.run(serve(args.artifacts, args.host, args.port, args.max_batch, args.max_wait_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Train / validation разбиение по последним заказам пользователя (leave_last_n, как в gen_candidates.ipynb)
+за один проход по заказам: cutoff_time каждого пользователя и val_n_orders сразу.
+Cutoff хранится массивом UserCutoffs: для плотных кодов EventStore позиция в массиве - код пользователя,
+и в scan_file отсечка - gather + сравнение вместо hash join с каждым файлом событий.
+
+split = leave_last_n_split(order_files, leave_last_n=3)
+get_last_favorite_items('train', user_cutoff_time=split.user_cutoff_time)
+validate_recommendations(candidates, split.val_n_orders)
+"""
+from dataclasses import dataclass
+
+import polars as pl
+
+from src.cache import fingerprint
+
+
+class UserCutoffs:
+    """
+    cutoff_time пользователей. n_codes - размер словаря плотных кодов (EventStore.users):
+    массив длины n_codes с null для пользователей без cutoff, отсечка - gather по user_id.
+    Без n_codes (исходные разреженные user_id) - таблица и join, как раньше
+    """
+    def __init__(self, user_cutoff_time, n_codes=None):
+        self.frame = user_cutoff_time.select('user_id', 'cutoff_time')
+        self.n_codes = n_codes
+        self.times = None
+        if n_codes is not None:
+            self.times = (
+                pl.Series('cutoff_time', [None] * n_codes, dtype=self.frame.schema['cutoff_time'])
+                .scatter(self.frame['user_id'].to_numpy(), self.frame['cutoff_time'])
+            )
+
+    @property
+    def height(self):
+        return self.frame.height
+
+    def max(self):
+        return self.frame['cutoff_time'].max()
+
+    def fingerprint(self):
+        # тот же ключ кэша, что у исходной таблицы user_cutoff_time
+        return fingerprint(self.frame)
+
+    def expr(self, user_col='user_id'):
+        """cutoff_time пользователя строки (null - пользователя нет в разбиении); только для плотных кодов"""
+        user = pl.col(user_col)
+        return pl.when(user < self.n_codes).then(pl.lit(self.times).gather(user.clip(0, self.n_codes - 1)))
+
+    def apply(self, lf, time_col):
+        """Только события до cutoff_time своего пользователя"""
+        if self.times is not None:
+            return lf.filter(pl.col(time_col) < self.expr())
+        id_dtype = lf.collect_schema()['user_id']
+        return lf.join(
+            self.frame.lazy().with_columns(pl.col('user_id').cast(id_dtype)), on='user_id'
+        ).filter(
+            pl.col(time_col) < pl.col('cutoff_time')
+        ).drop('cutoff_time')
+
+
+@dataclass
+class TrainValSplit:
+    """
+    user_cutoff_time - pl.DataFrame(user_id, cutoff_time), val_n_orders - pl.DataFrame(user_id, item_ids: list),
+    cutoffs - те же cutoff_time массивом для scan_events
+    """
+    user_cutoff_time: pl.DataFrame
+    val_n_orders: pl.DataFrame
+    cutoffs: UserCutoffs
+
+
+def leave_last_n_split(order_files, leave_last_n=3, status='delivered_orders', type_codes=None, n_codes=None):
+    """
+    cutoff_time - самый ранний из последних leave_last_n заказов со статусом status,
+    val_n_orders - items заказов начиная с cutoff_time, от старых к новым.
+    type_codes / n_codes - коды last_status и размер словаря пользователей EventStore
+    """
+    status_value = status if type_codes is None else type_codes[status]
+    per_user = (
+        pl.scan_parquet(order_files, extra_columns='ignore')
+        .filter(pl.col('last_status') == status_value)
+        .select('user_id', 'item_id', 'created_timestamp')
+        .sort(['user_id', 'created_timestamp'], maintain_order=True)
+        .group_by('user_id', maintain_order=True)
+        .agg(
+            pl.col('created_timestamp').tail(leave_last_n).min().alias('cutoff_time'),
+            pl.col('item_id').filter(
+                pl.col('created_timestamp') >= pl.col('created_timestamp').tail(leave_last_n).min()
+            ).alias('item_ids'),
+        )
+        .collect(engine='streaming')
+    )
+    user_cutoff_time = per_user.select('user_id', 'cutoff_time')
+    return TrainValSplit(
+        user_cutoff_time=user_cutoff_time,
+        val_n_orders=per_user.select('user_id', 'item_ids'),
+        cutoffs=UserCutoffs(user_cutoff_time, n_codes),
+    )
@@ -0,0 +1,132 @@
+import gzip
+import os
+
+import pandas as pd
+import polars as pl
+import pyarrow.parquet as pq
+
+from src import telemetry
+
+SUBMISSION_COLUMN = 'item_id_1 item_id_2 ... item_id_100'
+
+
+#################
+def format_submission(df, items_col='item_id'):
+    """user_id + строка items через пробел, без python-циклов"""
+    return df.select(
+        pl.col('user_id'),
+        pl.col(items_col).cast(pl.List(pl.String)).list.join(' ').alias(SUBMISSION_COLUMN),
+    )
+
+def invalid_rows(df, items_col='item_id', n_items=100):
+    """Строки, где items не ровно n_items уникальных непустых значений"""
+    items = pl.col(items_col)
+    return df.filter(
+        items.is_null() |
+        (items.list.len() != n_items) |
+        (items.list.drop_nulls().list.n_unique() != n_items)
+    )
+
+
+#################
+class SubmissionWriter:
+    """
+    Пишет сабмит чанками по мере поступления: csv, csv.gz (по расширению path) или parquet.
+    Каждый чанк проверяется на ровно n_items уникальных items у пользователя,
+    при закрытии - что нет повторных пользователей и все expected_users присутствуют.
+    decode - функция df -> df, переводящая коды id в исходные (EventStore.decode_ids).
+
+    with SubmissionWriter('submits/submission.csv', expected_users=test_user_ids['user_id']) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    """
+    def __init__(self, path, expected_users=None, items_col='item_id', n_items=100, validate=True, decode=None):
+        self.path = path
+        self.decode = decode
+        self.items_col = items_col
+        self.n_items = n_items
+        self.validate = validate
+        self.expected_users = None if expected_users is None else pl.Series('user_id', expected_users)
+        self.format = 'parquet' if path.endswith('.parquet') else 'csv'
+        self.written_users = []
+        self.rows = 0
+        self._file = None
+        self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(check=exc_type is None)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = gzip.open(self.path, 'wb') if self.path.endswith('.gz') else open(self.path, 'wb')
+
+    def write(self, chunk):
+        """chunk - pl.DataFrame / pd.DataFrame (user_id, items_col: list)"""
+        with telemetry.stage('submission_write', path=self.path) as st:
+            self._write(chunk)
+            st.record(rows_in=len(chunk), rows_out=len(chunk))
+
+    def _write(self, chunk):
+        if isinstance(chunk, pd.DataFrame):
+            chunk = pl.from_pandas(chunk)
+        if self.decode is not None:
+            chunk = self.decode(chunk)
+        if self.validate:
+            bad = invalid_rows(chunk, self.items_col, self.n_items)
+            if bad.height:
+                raise ValueError(
+                    f'{bad.height} users without exactly {self.n_items} unique items, '
+                    f'e.g. user_id={bad["user_id"][0]}'
+                )
+
+        formatted = format_submission(chunk, self.items_col)
+        if self.format == 'parquet':
+            table = formatted.to_arrow()
+            if self._parquet_writer is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            if self._file is None:
+                self._open()
+                formatted.write_csv(self._file, include_header=True)
+            else:
+                formatted.write_csv(self._file, include_header=False)
+
+        self.written_users.append(chunk['user_id'])
+        self.rows += chunk.height
+
+    def check_users(self):
+        """Повторные и пропущенные пользователи по всем записанным чанкам"""
+        written = pl.concat(self.written_users) if self.written_users else pl.Series('user_id', [], pl.Int64)
+        n_duplicated = written.len() - written.n_unique()
+        if n_duplicated:
+            raise ValueError(f'{n_duplicated} duplicated users in submission')
+        if self.expected_users is not None:
+            missing = self.expected_users.cast(written.dtype, strict=False).is_in(written).not_().sum()
+            if missing:
+                raise ValueError(f'{missing} expected users missing from submission')
+
+    def close(self, check=True):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if check and self.validate:
+            self.check_users()
+
+
+@telemetry.instrumented()
+def write_submission(df, path, expected_users=None, items_col='item_id', n_items=100, chunk_rows=500_000, validate=True, decode=None):
+    """Весь df через SubmissionWriter чанками по chunk_rows строк; возвращает число записанных строк"""
+    if isinstance(df, pd.DataFrame):
+        df = pl.from_pandas(df)
+    with SubmissionWriter(path, expected_users, items_col, n_items, validate, decode) as writer:
+        for chunk in df.iter_slices(chunk_rows):
+            writer.write(chunk)
+    return writer.rows
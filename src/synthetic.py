@@ -0,0 +1,284 @@
+"""
+Синтетический датасет со схемой исходных данных хакатона для бенчмарков без 38 ГБ с Kaggle:
+tracker (user_id, item_id, action_type, timestamp, action_widget), заказы
+(user_id, item_id, created_timestamp, last_status, last_status_timestamp), каталог
+(item_id, itemname, catalogid, attributes, fclip_embed) и тестовые пользователи.
+
+Популярность items и активность пользователей - степенные (Zipf по рангу), события идут
+сессиями: пользователь выбирает catalogid (чаще свой любимый), просматривает несколько items
+подряд, часть просмотров продолжается просмотром описания / отзывов, корзиной, избранным,
+часть корзин становится заказами.
+
+python -m src.synthetic --root synthetic/data --users 100000 --items 50000 --days 90
+"""
+import argparse
+import os
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+TRACKER_DIR = 'final_apparel_tracker_data_08_action_widget'
+ORDERS_DIR = 'final_apparel_orders_data_07'
+ITEMS_DIR = 'ml_ozon_recsys_train_final_apparel_items_data'
+TEST_USERS_FILE = 'ml_ozon_recsys_test.snappy.parquet'
+WIDGETS = ['main', 'search', 'similar', 'cart', 'favorites']
+WORDS = [
+    'платье', 'джинсы', 'куртка', 'футболка', 'рубашка', 'юбка', 'брюки', 'свитер', 'пальто', 'шорты',
+    'женский', 'мужской', 'детский', 'зимний', 'летний', 'хлопок', 'лен', 'шерсть', 'синий', 'черный',
+    'белый', 'красный', 'oversize', 'classic', 'slim', 'basic',
+]
+COLORS = ['черный', 'белый', 'синий', 'красный', 'зеленый', 'бежевый']
+MATERIALS = ['хлопок', 'лен', 'шерсть', 'полиэстер', 'вискоза']
+
+
+@dataclass
+class SyntheticConfig:
+    """
+    Масштаб и поведение синтетики. Вероятности действий - на один просмотр,
+    order_rate - доля корзин, ставших заказами, status_probs - delivered / processed / canceled
+    """
+    n_users: int = 20_000
+    n_items: int = 20_000
+    n_catalogs: int = 30
+    n_days: int = 90
+    start_date: str = '2025-04-01'
+    sessions_per_user_day: float = 0.15
+    mean_session_length: float = 6.0
+    item_alpha: float = 0.9
+    user_alpha: float = 0.8
+    favorite_catalog_share: float = 0.7
+    description_rate: float = 0.3
+    review_rate: float = 0.15
+    cart_rate: float = 0.08
+    favorite_rate: float = 0.04
+    order_rate: float = 0.5
+    status_probs: tuple = (0.7, 0.15, 0.15)
+    test_user_share: float = 0.5
+    embed_dim: int = 32
+    items_per_file: int = 100_000
+    seed: int = 0
+
+
+def zipf_weights(n, alpha):
+    """Вероятности по рангу 1 / rank**alpha"""
+    weights = 1.0 / np.arange(1, n + 1) ** alpha
+    return weights / weights.sum()
+
+def sparse_ids(n, rng):
+    """n разных несплошных int64 id в случайном порядке (как реальные id, а не 0..n-1)"""
+    ids = np.unique(rng.integers(1, 2**40, int(n * 1.05) + 16))[:n]
+    while len(ids) < n:
+        ids = np.unique(np.concatenate([ids, rng.integers(1, 2**40, n)]))[:n]
+    return rng.permutation(ids)
+
+
+#################
+class SyntheticWorld:
+    """
+    Неизменная часть датасета: id, catalogid и популярность items, активность и любимый catalogid пользователей.
+    sample_items тянет items внутри catalogid с вероятностями по популярности
+    """
+    def __init__(self, config):
+        self.config = config
+        rng = np.random.default_rng(config.seed)
+        self.user_ids = sparse_ids(config.n_users, rng)
+        self.item_ids = sparse_ids(config.n_items, rng)
+
+        # catalogid: размеры тоже степенные, популярность item - Zipf по глобальному рангу
+        catalog_weights = zipf_weights(config.n_catalogs, 1.0)
+        self.catalog_ids = np.arange(1, config.n_catalogs + 1) * 1000 + rng.integers(0, 1000, config.n_catalogs)
+        self.item_catalog = rng.choice(config.n_catalogs, config.n_items, p=catalog_weights)
+        self.item_popularity = zipf_weights(config.n_items, config.item_alpha)[rng.permutation(config.n_items)]
+
+        self.catalog_items, self.catalog_probs = [], []
+        for catalog in range(config.n_catalogs):
+            items = np.flatnonzero(self.item_catalog == catalog)
+            probs = self.item_popularity[items]
+            self.catalog_items.append(items)
+            self.catalog_probs.append(probs / probs.sum() if len(items) else probs)
+        catalog_mass = np.array([self.item_popularity[items].sum() for items in self.catalog_items])
+        self.catalog_share = catalog_mass / catalog_mass.sum()
+
+        self.user_activity = zipf_weights(config.n_users, config.user_alpha)[rng.permutation(config.n_users)]
+        self.user_catalog = rng.choice(config.n_catalogs, config.n_users, p=self.catalog_share)
+
+    def sample_items(self, catalogs, rng):
+        """Для каждого элемента catalogs - позиция item (индекс в item_ids) из этого catalogid"""
+        positions = np.empty(len(catalogs), dtype=np.int64)
+        for catalog in np.unique(catalogs):
+            mask = catalogs == catalog
+            items = self.catalog_items[catalog]
+            if len(items) == 0:
+                positions[mask] = rng.choice(self.config.n_items, mask.sum(), p=self.item_popularity)
+            else:
+                positions[mask] = rng.choice(items, mask.sum(), p=self.catalog_probs[catalog])
+        return positions
+
+    def test_users(self):
+        rng = np.random.default_rng(self.config.seed + 1)
+        n_test = int(self.config.n_users * self.config.test_user_share)
+        return np.sort(rng.choice(self.user_ids, n_test, replace=False))
+
+
+def generate_day(world, day, rng):
+    """
+    События одного дня: (tracker pl.DataFrame, orders pl.DataFrame).
+    Заказы датируются по created_timestamp и могут попасть на следующий день
+    """
+    config = world.config
+    n_sessions = rng.poisson(config.n_users * config.sessions_per_user_day)
+    users = rng.choice(config.n_users, n_sessions, p=world.user_activity)
+    catalogs = np.where(
+        rng.random(n_sessions) < config.favorite_catalog_share,
+        world.user_catalog[users],
+        rng.choice(config.n_catalogs, n_sessions, p=world.catalog_share),
+    )
+    lengths = rng.geometric(1.0 / config.mean_session_length, n_sessions)
+    starts = rng.integers(0, 86_400 * 10**6, n_sessions)
+
+    # просмотры: сессия - последовательность items одного catalogid с паузами ~1 минута
+    session = np.repeat(np.arange(n_sessions), lengths)
+    offsets = np.arange(len(session)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    gaps = rng.exponential(60 * 10**6, len(session)).astype(np.int64)
+    view_time = starts[session] + offsets * 60 * 10**6 + gaps
+    view_user = users[session]
+    view_item = world.sample_items(catalogs[session], rng)
+
+    # продолжения просмотра - отдельные события через несколько секунд / минут после него
+    parts = [(view_user, view_item, view_time, np.zeros(len(session), dtype=np.int8))]
+    for code, rate, delay in ((1, config.description_rate, 20), (2, config.review_rate, 60),
+                              (3, config.cart_rate, 120), (4, config.favorite_rate, 90)):
+        mask = rng.random(len(session)) < rate
+        delays = rng.exponential(delay * 10**6, mask.sum()).astype(np.int64)
+        parts.append((view_user[mask], view_item[mask], view_time[mask] + delays, np.full(mask.sum(), code, dtype=np.int8)))
+    user_idx, item_idx, times, codes = (np.concatenate(columns) for columns in zip(*parts))
+
+    day_start = np.datetime64(day, 'us')
+    tracker = pl.DataFrame({
+        'user_id': world.user_ids[user_idx],
+        'item_id': world.item_ids[item_idx],
+        'action_type': pl.Series(np.array(['view', 'view_description', 'review_view', 'to_cart', 'favorite'])[codes]),
+        'timestamp': day_start + times.astype('timedelta64[us]'),
+        'action_widget': pl.Series(np.array(WIDGETS)[rng.integers(0, len(WIDGETS), len(codes))]),
+    }).sort('timestamp')
+
+    carts = np.flatnonzero((codes == 3) & (rng.random(len(codes)) < config.order_rate))
+    created = times[carts] + rng.exponential(3600 * 10**6, len(carts)).astype(np.int64)
+    statuses = rng.choice(['delivered_orders', 'proccesed_orders', 'canceled_orders'], len(carts), p=config.status_probs)
+    status_delay = rng.exponential(2 * 86_400 * 10**6, len(carts)).astype(np.int64)
+    orders = pl.DataFrame({
+        'user_id': world.user_ids[user_idx[carts]],
+        'item_id': world.item_ids[item_idx[carts]],
+        'created_timestamp': day_start + created.astype('timedelta64[us]'),
+        'last_status': pl.Series(statuses),
+        'last_status_timestamp': day_start + (created + status_delay).astype('timedelta64[us]'),
+    })
+    return tracker, orders
+
+def generate_catalog(world, rng):
+    """Итератор по частям каталога (items_per_file строк): itemname, attributes, fclip_embed"""
+    config = world.config
+    words = np.array(WORDS)
+    # эмбеддинги похожи внутри catalogid: центр catalogid + шум
+    centers = rng.normal(size=(config.n_catalogs, config.embed_dim))
+    for start in range(0, config.n_items, config.items_per_file):
+        positions = np.arange(start, min(start + config.items_per_file, config.n_items))
+        n = len(positions)
+        names = [' '.join(row) for row in words[rng.integers(0, len(words), (n, 3))]]
+        annotations = [' '.join(row) for row in words[rng.integers(0, len(words), (n, 8))]]
+        types = words[:10][rng.integers(0, 10, n)]
+        colors = np.array(COLORS)[rng.integers(0, len(COLORS), n)]
+        materials = np.array(MATERIALS)[rng.integers(0, len(MATERIALS), n)]
+        brands = [f'brand_{b}' for b in rng.zipf(1.5, n) % 500]
+        attributes = [
+            [
+                {'attribute_name': 'Type', 'attribute_value': types[i]},
+                {'attribute_name': 'Brand', 'attribute_value': brands[i]},
+                {'attribute_name': 'ColorBase', 'attribute_value': colors[i]},
+                {'attribute_name': 'Material', 'attribute_value': materials[i]},
+                {'attribute_name': 'Annotation', 'attribute_value': annotations[i]},
+            ]
+            for i in range(n)
+        ]
+        embeds = (centers[world.item_catalog[positions]] + rng.normal(scale=0.5, size=(n, config.embed_dim))).astype(np.float32)
+        yield pl.DataFrame({
+            'item_id': world.item_ids[positions],
+            'itemname': names,
+            'catalogid': world.catalog_ids[world.item_catalog[positions]],
+            'attributes': attributes,
+            'fclip_embed': pl.Series(embeds).cast(pl.List(pl.Float32)),
+        })
+
+
+#################
+def generate_dataset(root='synthetic/data', config=None):
+    """
+    Пишет датасет в root в раскладке исходных данных (файлы по дням */part.parquet),
+    так что gen_cand_utils / event_store / item_vectors читают его без изменений.
+    Генерация по дням: в памяти события одного дня. Возвращает {'tracker': n, 'orders': n, 'items': n, 'test_users': n}
+    """
+    config = config or SyntheticConfig()
+    world = SyntheticWorld(config)
+    rng = np.random.default_rng(config.seed + 3)
+    start = datetime.fromisoformat(config.start_date)
+    end = np.datetime64(start + timedelta(days=config.n_days), 'us')
+    counts = {'tracker': 0, 'orders': 0, 'items': 0}
+
+    pending_orders = []
+    for day_index in tqdm(range(config.n_days), desc='Synthetic events'):
+        day = start + timedelta(days=day_index)
+        tracker, orders = generate_day(world, day, rng)
+        day_dir = os.path.join(root, TRACKER_DIR, f'{day:%Y%m%d}')
+        os.makedirs(day_dir, exist_ok=True)
+        tracker.write_parquet(os.path.join(day_dir, 'part.parquet'))
+        counts['tracker'] += tracker.height
+
+        # заказы пишутся по дню created_timestamp, остаток уходит в следующий день
+        orders = pl.concat([*pending_orders, orders])
+        next_day = np.datetime64(day + timedelta(days=1), 'us')
+        ready = orders.filter(pl.col('created_timestamp') < next_day)
+        pending_orders = [orders.filter((pl.col('created_timestamp') >= next_day) & (pl.col('created_timestamp') < end))]
+        day_dir = os.path.join(root, ORDERS_DIR, f'{day:%Y%m%d}')
+        os.makedirs(day_dir, exist_ok=True)
+        ready.sort('created_timestamp').write_parquet(os.path.join(day_dir, 'part.parquet'))
+        counts['orders'] += ready.height
+
+    items_dir = os.path.join(root, ITEMS_DIR)
+    os.makedirs(items_dir, exist_ok=True)
+    for i, part in enumerate(generate_catalog(world, rng)):
+        part.write_parquet(os.path.join(items_dir, f'part-{i:05d}.parquet'))
+        counts['items'] += part.height
+
+    test_users = world.test_users()
+    pl.DataFrame({'user_id': test_users}).write_parquet(os.path.join(root, TEST_USERS_FILE))
+    counts['test_users'] = len(test_users)
+    return counts
+
+
+def main():
+    defaults = SyntheticConfig()
+    parser = argparse.ArgumentParser(description='Синтетический датасет в формате данных хакатона')
+    parser.add_argument('--root', default='synthetic/data')
+    parser.add_argument('--users', type=int, default=defaults.n_users)
+    parser.add_argument('--items', type=int, default=defaults.n_items)
+    parser.add_argument('--catalogs', type=int, default=defaults.n_catalogs)
+    parser.add_argument('--days', type=int, default=defaults.n_days)
+    parser.add_argument('--start-date', default=defaults.start_date)
+    parser.add_argument('--sessions-per-user-day', type=float, default=defaults.sessions_per_user_day)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    config = SyntheticConfig(
+        n_users=args.users, n_items=args.items, n_catalogs=args.catalogs, n_days=args.days,
+        start_date=args.start_date, sessions_per_user_day=args.sessions_per_user_day, seed=args.seed,
+    )
+    counts = generate_dataset(args.root, config)
+    print(asdict(config))
+    print(counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Телеметрия этапов пайплайна: генераторы, scan по файлам, слияние кандидатов, метрики, сабмит.
+Каждый этап - запись JSON lines: wall / CPU время, строки на входе и выходе, прочитанные байты,
+пиковый RSS, вложенность (path) и произвольные атрибуты. По умолчанию выключено.
+
+configure_telemetry(path='telemetry.jsonl')                     # записи в файл
+configure_telemetry(profile='cprofile', profile_stages={'scan_events'})  # + профиль этапов
+with stage('my_step', file=path) as st:
+    ...
+    st.record(rows_in=df.height, rows_out=result.height)
+"""
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Меняются через configure_telemetry
+TELEMETRY_SETTINGS = {
+    'enabled': False,
+    'path': None,                 # JSON lines; None - только в памяти (recent_records)
+    'profile': None,              # None / 'cprofile' / 'sampling'
+    'profile_stages': None,       # имена профилируемых этапов; None - все этапы верхнего уровня
+    'profile_dir': 'telemetry_profiles',
+    'sample_interval': 0.01,      # секунды, для RSS и sampling-профиля
+}
+RECENT_RECORDS = deque(maxlen=10_000)
+_CURRENT_STAGE = contextvars.ContextVar('telemetry_stage', default=None)
+_WRITE_LOCK = threading.Lock()
+
+
+def configure_telemetry(enabled=True, path=None, profile=None, profile_stages=None, profile_dir=None, sample_interval=None):
+    TELEMETRY_SETTINGS['enabled'] = enabled
+    TELEMETRY_SETTINGS['path'] = path
+    TELEMETRY_SETTINGS['profile'] = profile
+    TELEMETRY_SETTINGS['profile_stages'] = set(profile_stages) if profile_stages is not None else None
+    if profile_dir is not None:
+        TELEMETRY_SETTINGS['profile_dir'] = profile_dir
+    if sample_interval is not None:
+        TELEMETRY_SETTINGS['sample_interval'] = sample_interval
+
+def worker_settings():
+    """Настройки для передачи в процесс пула (spawn не наследует configure_telemetry)"""
+    settings = dict(TELEMETRY_SETTINGS)
+    if settings['profile_stages'] is not None:
+        settings['profile_stages'] = sorted(settings['profile_stages'])
+    return settings
+
+def recent_records(stage_name=None):
+    return [record for record in RECENT_RECORDS if stage_name is None or record['stage'] == stage_name]
+
+
+#################
+def current_rss():
+    """RSS процесса в байтах; без /proc - ru_maxrss (пик за время жизни процесса)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def io_read_bytes():
+    """rchar из /proc/self/io (все read-вызовы процесса, включая кэш ОС); None, если недоступно"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler:
+    """
+    Один фоновый поток на процесс: раз в sample_interval обновляет пиковый RSS всех открытых этапов.
+    Запускается при первом этапе с включенной телеметрией
+    """
+    def __init__(self):
+        self.active = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, stage):
+        with self.lock:
+            self.active.add(stage)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='telemetry-rss')
+                self.thread.start()
+
+    def remove(self, stage):
+        with self.lock:
+            self.active.discard(stage)
+
+    def _run(self):
+        while True:
+            time.sleep(TELEMETRY_SETTINGS['sample_interval'])
+            rss = current_rss()
+            with self.lock:
+                for stage in self.active:
+                    stage.peak_rss = max(stage.peak_rss, rss)
+
+_MEMORY_SAMPLER = MemorySampler()
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профиль одного потока через sys._current_frames: стеки в формате collapsed
+    (строка 'a;b;c count', вход для flamegraph). Накладные расходы не зависят от числа вызовов функций
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='telemetry-profile')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+#################
+class Stage:
+    """
+    Открытый этап. record(rows_in=..., rows_out=..., bytes_read=..., **attrs) - счетчики суммируются,
+    прочие атрибуты перезаписываются; timer(key) - накапливает время подшага в attrs['<key>_s']
+    """
+    COUNTERS = ('rows_in', 'rows_out', 'bytes_read')
+
+    def __init__(self, name, parent=None, attrs=None, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.parent = parent if isinstance(parent, Stage) else None
+        parent_path = parent.path if isinstance(parent, Stage) else parent
+        self.path = f'{parent_path}/{name}' if parent_path else name
+        self.parent_path = parent_path
+        self.attrs = dict(attrs or {})
+        self.counters = {key: 0 for key in self.COUNTERS}
+        self.peak_rss = 0
+
+    def record(self, **values):
+        if not self.enabled:
+            return
+        for key, value in values.items():
+            if value is None:
+                continue
+            if key in self.counters:
+                self.counters[key] += int(value)
+            else:
+                self.attrs[key] = value
+
+    def timer(self, key):
+        return _StageTimer(self, key)
+
+    def _start(self):
+        self.started_at = datetime.now().isoformat(timespec='milliseconds')
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.io_start = io_read_bytes()
+        self.rss_start = current_rss()
+        self.peak_rss = self.rss_start
+        _MEMORY_SAMPLER.add(self)
+
+        self.profiler, self.profile_path = None, None
+        if self._should_profile():
+            os.makedirs(TELEMETRY_SETTINGS['profile_dir'], exist_ok=True)
+            base = os.path.join(
+                TELEMETRY_SETTINGS['profile_dir'],
+                f'{self.name}-{os.getpid()}-{datetime.now():%Y%m%d-%H%M%S-%f}'
+            )
+            if TELEMETRY_SETTINGS['profile'] == 'cprofile':
+                self.profiler, self.profile_path = cProfile.Profile(), base + '.prof'
+                self.profiler.enable()
+            elif TELEMETRY_SETTINGS['profile'] == 'sampling':
+                self.profiler = SamplingProfiler(threading.get_ident(), TELEMETRY_SETTINGS['sample_interval'])
+                self.profile_path = base + '.folded'
+                self.profiler.start()
+
+    def _should_profile(self):
+        # cProfile не вкладывается: внутри профилируемого этапа вложенные не профилируются
+        if TELEMETRY_SETTINGS['profile'] is None or any(stage.profiler is not None for stage in _open_stages()):
+            return False
+        stages = TELEMETRY_SETTINGS['profile_stages']
+        if stages is None:
+            return self.parent_path is None
+        return self.name in stages
+
+    def _finish(self, error):
+        if self.profiler is not None:
+            if isinstance(self.profiler, cProfile.Profile):
+                self.profiler.disable()
+                self.profiler.dump_stats(self.profile_path)
+            else:
+                self.profiler.stop(self.profile_path)
+        _MEMORY_SAMPLER.remove(self)
+        rss_end = current_rss()
+        io_end = io_read_bytes()
+
+        record = {
+            'ts': self.started_at,
+            'stage': self.name,
+            'path': self.path,
+            'pid': os.getpid(),
+            'wall_s': round(time.perf_counter() - self.wall_start, 6),
+            'cpu_s': round(time.process_time() - self.cpu_start, 6),
+            **self.counters,
+            'io_read_bytes': io_end - self.io_start if io_end is not None and self.io_start is not None else None,
+            'peak_rss_mb': round(max(self.peak_rss, rss_end) / 2**20, 1),
+            'rss_delta_mb': round((rss_end - self.rss_start) / 2**20, 1),
+            'error': error,
+            **({'profile': self.profile_path} if self.profile_path else {}),
+            **self.attrs,
+        }
+        emit(record)
+
+
+class _StageTimer:
+    def __init__(self, stage, key):
+        self.stage, self.key = stage, f'{key}_s'
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.stage.enabled:
+            self.stage.attrs[self.key] = round(self.stage.attrs.get(self.key, 0.0) + time.perf_counter() - self.start, 6)
+
+
+def emit(record):
+    RECENT_RECORDS.append(record)
+    path = TELEMETRY_SETTINGS['path']
+    if path is None:
+        return
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    # одна запись - один write в режиме append: строки процессов пула не перемешиваются
+    with _WRITE_LOCK, open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+@contextmanager
+def stage(name, parent=None, **attrs):
+    """
+    Этап пайплайна. parent - Stage или строка path (для потоков и процессов пула,
+    куда контекст не передается); по умолчанию - текущий открытый этап.
+    При выключенной телеметрии отдает Stage-заглушку: record и timer ничего не делают
+    """
+    if not TELEMETRY_SETTINGS['enabled']:
+        yield Stage(name, enabled=False)
+        return
+
+    current = Stage(name, parent if parent is not None else _CURRENT_STAGE.get(), attrs)
+    current._start()
+    token = _CURRENT_STAGE.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        _CURRENT_STAGE.reset(token)
+        current._finish(error)
+
+
+def _open_stages():
+    """Открытые этапы текущего контекста, от внутреннего к внешнему"""
+    stages, current = [], _CURRENT_STAGE.get()
+    while current is not None:
+        stages.append(current)
+        current = current.parent
+    return stages
+
+def current_stage():
+    """
+    Открытый этап текущего контекста: позволяет дописать счетчики из вложенной функции.
+    Без открытого этапа - заглушка, record которой ничего не делает
+    """
+    current = _CURRENT_STAGE.get()
+    return current if current is not None else Stage(None, enabled=False)
+
+def result_rows(result):
+    """Строки результата генератора: DataFrame / list / dict из DataFrame; кортежи и прочее - None"""
+    if hasattr(result, 'shape'):
+        return result.shape[0]
+    if isinstance(result, dict):
+        return sum(result_rows(value) or 0 for value in result.values())
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+def instrumented(name=None):
+    """Декоратор: вызов функции - этап name (по умолчанию имя функции), rows_out - строки результата"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__) as st:
+                result = func(*args, **kwargs)
+                st.record(rows_out=result_rows(result))
+                return result
+        return wrapper
+    return decorator
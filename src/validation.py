@@ -1,23 +1,31 @@
-from src.metrics import calculate_metrics_for_all_users
+from src.metrics import explode_ranked, ranking_metrics
+from src import telemetry
+import polars as pl
 import matplotlib.pyplot as plt
 
+@telemetry.instrumented()
 def validate_recommendations(candidates_df, val_n_orders, k_values=[10, 20, 50, 100]):
-   
-    # Объединяем данные
-    validation_df = candidates_df.merge(
-        val_n_orders, 
-        on='user_id', 
-        how='right'
+    """
+    candidates_df - user_id, item_id: list (pandas или polars)
+    val_n_orders - user_id, item_ids: list (pandas или polars)
+    Метрики считаются для всех пользователей из val_n_orders
+    """
+    if not isinstance(candidates_df, pl.DataFrame):
+        candidates_df = pl.from_pandas(candidates_df[['user_id', 'item_id']])
+    if not isinstance(val_n_orders, pl.DataFrame):
+        val_n_orders = pl.from_pandas(val_n_orders[['user_id', 'item_ids']])
+
+    predictions = explode_ranked(candidates_df, 'item_id')
+    truth = (
+        val_n_orders
+        .select('user_id', pl.col('item_ids').alias('item_id'))
+        .explode('item_id')
+        .drop_nulls('item_id')
     )
 
-    validation_df = validation_df.rename(columns={
-        'item_id': 'predicted_items',
-        'item_ids': 'true_items'
-    })
-    
     # Вычисляем метрики
-    aggregated_metrics, user_metrics = calculate_metrics_for_all_users(
-        validation_df, k_values
+    aggregated_metrics, user_metrics = ranking_metrics(
+        predictions, truth, k_values, users=val_n_orders.select('user_id')
     )
 
     
@@ -0,0 +1,36 @@
+"""Колоночные метрики против построчных функций src/metrics.py на краевых случаях"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.metrics import calculate_metrics_for_all_users, hit_rate_at_k, mrr_at_k, ndcg_at_k, precision_at_k, recall_at_k
+
+K_VALUES = [10, 20, 50, 100]
+SCALAR_METRICS = {'P': precision_at_k, 'R': recall_at_k, 'HR': hit_rate_at_k, 'MRR': mrr_at_k, 'nDCG': ndcg_at_k}
+
+
+def rowwise_metrics(validation_df):
+    """Прежний построчный расчет: NaN после merge - пустой список предсказаний"""
+    return {
+        f'{name}@{k}': np.mean([
+            metric(list(true_items), list(predicted) if isinstance(predicted, (list, np.ndarray)) else [], k)
+            for true_items, predicted in zip(validation_df['true_items'], validation_df['predicted_items'])
+        ])
+        for name, metric in SCALAR_METRICS.items()
+        for k in K_VALUES
+    }
+
+
+@pytest.mark.parametrize('validation_df', [
+    # ни у кого нет предсказаний
+    pd.DataFrame({'user_id': [1, 2], 'true_items': [[1, 2], [3]], 'predicted_items': [np.nan, np.nan]}),
+    # ни у кого нет покупок
+    pd.DataFrame({'user_id': [1, 2], 'true_items': [[], []], 'predicted_items': [[1, 2], np.nan]}),
+    # пусто и там, и там
+    pd.DataFrame({'user_id': [1, 2], 'true_items': [[], []], 'predicted_items': [np.nan, []]}),
+    pd.DataFrame({'user_id': [1, 2], 'true_items': [[1, 2, 2], [3]], 'predicted_items': [[2, 5, 1], [4]]}),
+])
+def test_all_empty_columns_match_rowwise(validation_df):
+    aggregated, _ = calculate_metrics_for_all_users(validation_df, K_VALUES)
+    expected = rowwise_metrics(validation_df)
+    assert aggregated == pytest.approx(expected)